@@ -20,7 +20,7 @@ SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'kin_bed_mesh.c', 'framebuffer.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
@@ -60,6 +60,9 @@ defs_itersolve = """
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    int32_t itersolve_set_closed_form(struct stepper_kinematics *sk
+        , int enable);
+    int32_t itersolve_set_batch(struct stepper_kinematics *sk, int enable);
 """
 
 defs_trapq = """
@@ -68,7 +71,15 @@ defs_trapq = """
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_arc(struct trapq *tq, double print_time
+        , double accel_t, double cruise_t, double decel_t
+        , double start_pos_x, double start_pos_y, double start_pos_z
+        , double center_x, double center_y
+        , double angle_r, double radius_r, double axis_r_z
+        , double start_v, double cruise_v, double accel);
     struct trapq *trapq_alloc(void);
+    int32_t trapq_set_accel_order(struct trapq *tq, int accel_order);
+    void trapq_set_transformed(struct trapq *tq, int is_transformed);
     void trapq_free(struct trapq *tq);
     void trapq_free_moves(struct trapq *tq, double print_time);
 """
@@ -132,6 +143,19 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_kin_bed_mesh = """
+    struct stepper_kinematics *bed_mesh_alloc(void);
+    void bed_mesh_free(struct stepper_kinematics *sk);
+    int bed_mesh_set_sk(struct stepper_kinematics *sk
+        , struct stepper_kinematics *orig_sk);
+    int bed_mesh_set_mesh(struct stepper_kinematics *sk, double *z_table
+        , int x_count, int y_count, double min_x, double min_y
+        , double max_x, double max_y);
+    void bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+        , double fade_end, double z_shift);
+    double bed_mesh_calc_z(struct stepper_kinematics *sk, double x, double y);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -167,6 +191,11 @@ defs_pyhelper = """
     double get_monotonic(void);
 """
 
+defs_framebuffer = """
+    int framebuffer_find_changes(uint8_t *new_data, uint8_t *old_data
+        , int len, int max_gap, int max_merge, int *regions);
+"""
+
 defs_std = """
     void free(void*);
 """
@@ -175,7 +204,8 @@ defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
     defs_itersolve, defs_trapq, defs_kin_cartesian, defs_kin_corexy,
     defs_kin_corexz, defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta,
-    defs_kin_winch, defs_kin_extruder, defs_kin_shaper,
+    defs_kin_winch, defs_kin_extruder, defs_kin_shaper, defs_kin_bed_mesh,
+    defs_framebuffer,
 ]
 
 # Update filenames to an absolute path
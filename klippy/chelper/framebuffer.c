@@ -0,0 +1,56 @@
+// Helper code for finding changes in lcd display framebuffers
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdint.h> // uint8_t
+#include "compiler.h" // __visible
+
+// Find the regions of a framebuffer that differ from the last
+// contents sent to the display.  Changes that are within 'max_gap'
+// bytes of each other are combined into a single region (as long as
+// the following region is less than 'max_merge' bytes long) so that
+// the number of position updates sent to the display is reduced.
+// Each region is stored as a (position, count) pair in 'regions'
+// (which must have room for 'len' pairs) in ascending position order.
+// Returns the number of regions found.
+int __visible
+framebuffer_find_changes(uint8_t *new_data, uint8_t *old_data, int len
+                         , int max_gap, int max_merge, int *regions)
+{
+    // Scan backwards so that the length limit applies to the region
+    // that follows each change
+    int count = 0, pos = -1, rcount = 0, i;
+    for (i = len - 1; i >= 0; i--) {
+        if (new_data[i] == old_data[i])
+            continue;
+        if (pos >= 0) {
+            if (i + max_gap >= pos && rcount < max_merge) {
+                rcount += pos - i;
+                pos = i;
+                continue;
+            }
+            regions[count*2] = pos;
+            regions[count*2 + 1] = rcount;
+            count++;
+        }
+        pos = i;
+        rcount = 1;
+    }
+    if (pos >= 0) {
+        regions[count*2] = pos;
+        regions[count*2 + 1] = rcount;
+        count++;
+    }
+    // Reverse the list so that regions are in ascending order
+    for (i = 0; i < count / 2; i++) {
+        int j = count - 1 - i;
+        int tpos = regions[i*2], tcount = regions[i*2 + 1];
+        regions[i*2] = regions[j*2];
+        regions[i*2 + 1] = regions[j*2 + 1];
+        regions[j*2] = tpos;
+        regions[j*2 + 1] = tcount;
+    }
+    return count;
+}
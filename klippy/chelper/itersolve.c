@@ -128,6 +128,335 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
 }
 
 
+/****************************************************************
+ * Closed form solver for linear kinematics
+ ****************************************************************/
+
+// Generate step times for a portion of a move on a stepper whose
+// position is a linear combination of the cartesian coordinates.
+// The stepper position is then a quadratic in time (and monotonic
+// within a move) so each step time can be calculated directly.
+static int32_t
+itersolve_gen_steps_linear(struct stepper_kinematics *sk, struct move *m
+                           , double abs_start, double abs_end)
+{
+    double start = abs_start - m->print_time, end = abs_end - m->print_time;
+    if (start < 0.)
+        start = 0.;
+    if (end > m->move_t)
+        end = m->move_t;
+    double *lc = sk->linear_coefs;
+    double move_r = lc[0]*m->axes_r.x + lc[1]*m->axes_r.y + lc[2]*m->axes_r.z;
+    double move_p = (lc[0]*m->start_pos.x + lc[1]*m->start_pos.y
+                     + lc[2]*m->start_pos.z);
+    double half_step = .5 * sk->step_dist, cp = sk->commanded_pos;
+    int sdir = stepcompress_get_step_dir(sk->sc);
+    if (end > start && move_r) {
+        double start_pos = move_p + move_r * move_get_distance(m, start);
+        double end_pos = move_p + move_r * move_get_distance(m, end);
+        double rel_dist = start_pos - cp;
+        if (sdir ? rel_dist >= 0. : rel_dist <= 0.)
+            // Avoid rollback if stepper fully reaches step position
+            stepcompress_commit(sk->sc);
+        int dir = move_r > 0.;
+        double step_dist = dir ? sk->step_dist : -sk->step_dist;
+        double target = cp + (dir ? half_step : -half_step);
+        double inv_r = 1. / move_r;
+        for (;;) {
+            double remaining = dir ? end_pos - target : target - end_pos;
+            if (remaining < -.000000001)
+                break;
+            double step_time = move_get_time(m, (target - move_p) * inv_r);
+            if (step_time < start)
+                step_time = start;
+            if (step_time > end)
+                step_time = end;
+            int ret = stepcompress_append(sk->sc, dir, m->print_time
+                                          , step_time);
+            if (ret)
+                return ret;
+            sdir = dir;
+            target += step_dist;
+        }
+        cp = target - (dir ? half_step : -half_step);
+        rel_dist = end_pos - cp;
+        if (sdir ? rel_dist >= 0. : rel_dist <= 0.)
+            stepcompress_commit(sk->sc);
+        sk->commanded_pos = cp;
+    }
+    if (sk->post_cb)
+        sk->post_cb(sk);
+    return 0;
+}
+
+
+/****************************************************************
+ * Batch solver
+ ****************************************************************/
+
+// The batch solver samples the stepper position at ITERSOLVE_BATCH
+// times with a single call to the kinematic batch callback.  Each
+// step found between two samples is then refined (also in batches)
+// using the "Illinois" variant of the regula falsi method.
+
+// Limit the sample spacing so that a brief excursion of the stepper
+// past a step position (just before a direction change) is not missed
+#define BATCH_MAX_SAMPLE_TIME (8. * SEEK_TIME_RESET)
+
+struct batch_step {
+    double target, time;
+    double low_time, low_dist, high_time, high_dist;
+    int dir, side;
+};
+
+// Calculate the next guess time for a step
+static inline double
+batch_step_guess(struct batch_step *bs)
+{
+    double low_time = bs->low_time, high_time = bs->high_time;
+    double guess = low_time - (bs->low_dist * (high_time - low_time)
+                               / (bs->high_dist - bs->low_dist));
+    if (!(guess > low_time && guess < high_time)) // or NaN
+        guess = (low_time + high_time) * .5;
+    return guess;
+}
+
+// Prepare a step bracketed by the 'low' and 'high' samples (the
+// sample 'before' is used to improve the first guess)
+static inline void
+batch_step_init(struct batch_step *bs, double target, int dir
+                , struct timepos *before, struct timepos *low
+                , struct timepos *high)
+{
+    bs->target = target;
+    bs->dir = dir;
+    bs->side = 0;
+    double da = dir ? before->position - target : target - before->position;
+    double db = dir ? low->position - target : target - low->position;
+    double dc = dir ? high->position - target : target - high->position;
+    bs->low_time = low->time;
+    bs->low_dist = db;
+    bs->high_time = bs->time = high->time;
+    bs->high_dist = dc;
+    if (fabs(dc) <= .000000001)
+        // Sample is close enough to the step position
+        return;
+    if (db >= 0.) {
+        // Step position already reached at start of search
+        bs->time = low->time;
+        bs->high_dist = 0.;
+        return;
+    }
+    // Use inverse quadratic interpolation for the first guess
+    double guess = (before->time * db * dc / ((da - db) * (da - dc))
+                    + low->time * da * dc / ((db - da) * (db - dc))
+                    + high->time * da * db / ((dc - da) * (dc - db)));
+    if (before->time < low->time && guess > low->time && guess < high->time)
+        bs->time = guess;
+    else
+        bs->time = batch_step_guess(bs);
+}
+
+// Update a step with the position at its last guess time (returns 1
+// when the step time has been found)
+static inline int
+batch_step_update(struct batch_step *bs, double position)
+{
+    double dist = bs->dir ? position - bs->target : bs->target - position;
+    if (fabs(dist) <= .000000001)
+        return 1;
+    if (dist > 0.) {
+        bs->high_time = bs->time;
+        bs->high_dist = dist;
+        if (bs->side > 0)
+            bs->low_dist *= .5;
+        bs->side = 1;
+    } else {
+        bs->low_time = bs->time;
+        bs->low_dist = dist;
+        if (bs->side < 0)
+            bs->high_dist *= .5;
+        bs->side = -1;
+    }
+    if (bs->high_time - bs->low_time <= .000000001)
+        return 1;
+    bs->time = batch_step_guess(bs);
+    return 0;
+}
+
+// Find the times of the steps bracketed by the batch samples
+static void
+batch_refine(struct stepper_kinematics *sk, struct move *m
+             , struct batch_step *steps, int count)
+{
+    double times[ITERSOLVE_BATCH], positions[ITERSOLVE_BATCH];
+    int pending[ITERSOLVE_BATCH], pcount = 0, i;
+    for (i = 0; i < count; i++)
+        if (fabs(steps[i].high_dist) > .000000001)
+            pending[pcount++] = i;
+    while (pcount) {
+        for (i = 0; i < pcount; i++)
+            times[i] = steps[pending[i]].time;
+        sk->calc_batch_cb(sk, m, times, positions, pcount);
+        int new_pcount = 0;
+        for (i = 0; i < pcount; i++)
+            if (!batch_step_update(&steps[pending[i]], positions[i]))
+                pending[new_pcount++] = pending[i];
+        pcount = new_pcount;
+    }
+}
+
+// Generate step times for a portion of a move using the batch solver
+static int32_t
+itersolve_gen_steps_batch(struct stepper_kinematics *sk, struct move *m
+                          , double abs_start, double abs_end)
+{
+    double half_step = .5 * sk->step_dist;
+    double start = abs_start - m->print_time, end = abs_end - m->print_time;
+    if (start < 0.)
+        start = 0.;
+    if (end > m->move_t)
+        end = m->move_t;
+    double times[ITERSOLVE_BATCH], positions[ITERSOLVE_BATCH];
+    struct batch_step steps[ITERSOLVE_BATCH];
+    struct timepos prev = {start, sk->commanded_pos}, before = {-1., 0.};
+    double cp = sk->commanded_pos, velocity = sk->batch_velocity;
+    double sample_time = SEEK_TIME_RESET / ITERSOLVE_BATCH;
+    if (velocity) {
+        // Use the velocity at the end of the last range as an estimate
+        sample_time = (half_step + half_step) / fabs(velocity);
+        if (sample_time > SEEK_TIME_RESET)
+            sample_time = SEEK_TIME_RESET;
+    }
+    int sdir = stepcompress_get_step_dir(sk->sc);
+    if (start < end)
+        sk->calc_batch_cb(sk, m, &prev.time, &prev.position, 1);
+    while (prev.time < end) {
+        // Sample the stepper position near the predicted upcoming steps
+        struct timepos last = prev;
+        double next_time = last.time + sample_time;
+        if (velocity) {
+            // Start at the predicted time of the next step
+            double dist = (velocity > 0. ? cp + half_step - last.position
+                           : last.position - (cp - half_step));
+            double step_time = dist / fabs(velocity);
+            if (step_time < .000000001)
+                step_time = .000000001;
+            if (step_time < sample_time)
+                next_time = last.time + step_time;
+        }
+        int scount = 0;
+        while (scount < ITERSOLVE_BATCH) {
+            if (next_time >= end) {
+                times[scount++] = end;
+                break;
+            }
+            times[scount++] = next_time;
+            next_time += sample_time;
+        }
+        sk->calc_batch_cb(sk, m, times, positions, scount);
+        // Locate the steps between samples
+        int count = 0, is_dir_change = 0, full = 0, i;
+        uint32_t commit_mask = 0;
+        for (i = 0; i < scount; i++) {
+            struct timepos cur = {times[i], positions[i]};
+            int prev_count = count, prev_sdir = sdir;
+            double prev_cp = cp;
+            for (;;) {
+                double fwd_dist = sdir ? cur.position - (cp + half_step)
+                                  : (cp - half_step) - cur.position;
+                int dir = sdir;
+                if (fwd_dist < -.000000001) {
+                    if (fwd_dist >= -(half_step + half_step + .000000010))
+                        break;
+                    // Found direction change
+                    dir = !sdir;
+                }
+                if (count >= ITERSOLVE_BATCH) {
+                    // Too many steps - resume search from previous sample
+                    count = prev_count;
+                    sdir = prev_sdir;
+                    cp = prev_cp;
+                    full = 1;
+                    break;
+                }
+                if (dir != sdir) {
+                    sdir = dir;
+                    is_dir_change = 1;
+                }
+                double target = sdir ? cp + half_step : cp - half_step;
+                batch_step_init(&steps[count++], target, sdir
+                                , &before, &prev, &cur);
+                cp = sdir ? cp + half_step + half_step
+                     : cp - half_step - half_step;
+            }
+            if (full) {
+                sample_time = (cur.time - prev.time) / ITERSOLVE_BATCH;
+                break;
+            }
+            if (sdir ? cur.position >= cp : cur.position <= cp)
+                // Avoid rollback if stepper fully reaches step position
+                commit_mask |= 1 << count;
+            before = prev;
+            prev = cur;
+        }
+        // Find the step times and submit them
+        batch_refine(sk, m, steps, count);
+        if (commit_mask & 1)
+            stepcompress_commit(sk->sc);
+        for (i = 0; i < count; i++) {
+            int ret = stepcompress_append(sk->sc, steps[i].dir, m->print_time
+                                          , steps[i].time);
+            if (ret)
+                return ret;
+            if (commit_mask & (1 << (i + 1)))
+                stepcompress_commit(sk->sc);
+        }
+        // Estimate the stepper velocity and step spacing for next batch
+        if (before.time >= start)
+            velocity = ((prev.position - before.position)
+                        / (prev.time - before.time));
+        if (full) {
+            velocity = 0.;
+        } else {
+            double max_sample_time = 2. * sample_time;
+            sample_time = max_sample_time;
+            if (velocity) {
+                sample_time = (half_step + half_step) / fabs(velocity);
+                if (sample_time > max_sample_time)
+                    sample_time = max_sample_time;
+            }
+            if (sample_time > BATCH_MAX_SAMPLE_TIME)
+                sample_time = BATCH_MAX_SAMPLE_TIME;
+        }
+        if (is_dir_change && sample_time > SEEK_TIME_RESET/ITERSOLVE_BATCH) {
+            velocity = 0.;
+            sample_time = SEEK_TIME_RESET / ITERSOLVE_BATCH;
+        }
+    }
+    sk->commanded_pos = cp;
+    sk->batch_velocity = velocity;
+    if (sk->post_cb)
+        sk->post_cb(sk);
+    return 0;
+}
+
+// Generate step times using the best solver for the kinematics
+static inline int32_t
+gen_steps_range(struct stepper_kinematics *sk, struct move *m
+                , double abs_start, double abs_end)
+{
+    if (unlikely(m->is_arc))
+        // Arc moves are only supported by the iterative solver
+        return itersolve_gen_steps_range(sk, m, abs_start, abs_end);
+    if (sk->use_closed_form && m->accel_order <= 2)
+        return itersolve_gen_steps_linear(sk, m, abs_start, abs_end);
+    if (sk->use_batch)
+        return itersolve_gen_steps_batch(sk, m, abs_start, abs_end);
+    return itersolve_gen_steps_range(sk, m, abs_start, abs_end);
+}
+
+
 /****************************************************************
  * Interface functions
  ****************************************************************/
@@ -137,8 +466,8 @@ static inline int
 check_active(struct stepper_kinematics *sk, struct move *m)
 {
     int af = sk->active_flags;
-    return ((af & AF_X && m->axes_r.x != 0.)
-            || (af & AF_Y && m->axes_r.y != 0.)
+    return ((af & AF_X && (m->axes_r.x != 0. || m->is_arc))
+            || (af & AF_Y && (m->axes_r.y != 0. || m->is_arc))
             || (af & AF_Z && m->axes_r.z != 0.));
 }
 
@@ -151,9 +480,7 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
     if (!sk->tq)
         return 0;
     trapq_check_sentinels(sk->tq);
-    struct move *m = list_first_entry(&sk->tq->moves, struct move, node);
-    while (last_flush_time >= m->print_time + m->move_t)
-        m = list_next_entry(m, node);
+    struct move *m = trapq_find_move(sk->tq, last_flush_time);
     double force_steps_time = sk->last_move_time + sk->gen_steps_post_active;
     int skip_count = 0;
     for (;;) {
@@ -170,16 +497,16 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
                 while (--skip_count && pm->print_time > abs_start)
                     pm = list_prev_entry(pm, node);
                 do {
-                    int32_t ret = itersolve_gen_steps_range(sk, pm, abs_start
-                                                            , flush_time);
+                    int32_t ret = gen_steps_range(sk, pm, abs_start
+                                                  , flush_time);
                     if (ret)
                         return ret;
                     pm = list_next_entry(pm, node);
                 } while (pm != m);
             }
             // Generate steps for this move
-            int32_t ret = itersolve_gen_steps_range(sk, m, last_flush_time
-                                                    , flush_time);
+            int32_t ret = gen_steps_range(sk, m, last_flush_time
+                                          , flush_time);
             if (ret)
                 return ret;
             if (move_end >= flush_time) {
@@ -195,8 +522,8 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
                 double abs_end = force_steps_time;
                 if (abs_end > flush_time)
                     abs_end = flush_time;
-                int32_t ret = itersolve_gen_steps_range(sk, m, last_flush_time
-                                                        , abs_end);
+                int32_t ret = gen_steps_range(sk, m, last_flush_time
+                                              , abs_end);
                 if (ret)
                     return ret;
                 skip_count = 1;
@@ -218,9 +545,7 @@ itersolve_check_active(struct stepper_kinematics *sk, double flush_time)
     if (!sk->tq)
         return 0.;
     trapq_check_sentinels(sk->tq);
-    struct move *m = list_first_entry(&sk->tq->moves, struct move, node);
-    while (sk->last_flush_time >= m->print_time + m->move_t)
-        m = list_next_entry(m, node);
+    struct move *m = trapq_find_move(sk->tq, sk->last_flush_time);
     for (;;) {
         if (check_active(sk, m))
             return m->print_time;
@@ -278,3 +603,45 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+// Declare that the stepper position is a linear combination of the
+// cartesian coordinates (and enable the closed form step solver)
+void
+itersolve_set_linear(struct stepper_kinematics *sk
+                     , double x_coef, double y_coef, double z_coef)
+{
+    sk->linear_coefs[0] = x_coef;
+    sk->linear_coefs[1] = y_coef;
+    sk->linear_coefs[2] = z_coef;
+    sk->use_closed_form = 1;
+}
+
+// Select between the closed form and iterative step solvers
+int32_t __visible
+itersolve_set_closed_form(struct stepper_kinematics *sk, int enable)
+{
+    double *lc = sk->linear_coefs;
+    if (enable && !lc[0] && !lc[1] && !lc[2])
+        return -1;
+    sk->use_closed_form = enable;
+    return 0;
+}
+
+// Register a kinematic batch callback (and enable the batch solver)
+void
+itersolve_set_batch_callback(struct stepper_kinematics *sk
+                             , sk_calc_batch_callback calc_batch_cb)
+{
+    sk->calc_batch_cb = calc_batch_cb;
+    sk->use_batch = 1;
+}
+
+// Select between the batch and iterative step solvers
+int32_t __visible
+itersolve_set_batch(struct stepper_kinematics *sk, int enable)
+{
+    if (enable && !sk->calc_batch_cb)
+        return -1;
+    sk->use_batch = enable;
+    return 0;
+}
@@ -11,6 +11,9 @@ struct stepper_kinematics;
 struct move;
 typedef double (*sk_calc_callback)(struct stepper_kinematics *sk, struct move *m
                                    , double move_time);
+typedef void (*sk_calc_batch_callback)(struct stepper_kinematics *sk
+                                       , struct move *m, double *move_times
+                                       , double *positions, int count);
 typedef void (*sk_post_callback)(struct stepper_kinematics *sk);
 struct stepper_kinematics {
     double step_dist, commanded_pos;
@@ -23,8 +26,21 @@ struct stepper_kinematics {
 
     sk_calc_callback calc_position_cb;
     sk_post_callback post_cb;
+
+    // Kinematics where the stepper position is a linear combination of
+    // the cartesian coordinates may use the closed form step solver
+    int use_closed_form;
+    double linear_coefs[3];
+
+    // Kinematics may calculate the position at several times per
+    // call (up to ITERSOLVE_BATCH) for use with the batch step solver
+    sk_calc_batch_callback calc_batch_cb;
+    int use_batch;
+    double batch_velocity;
 };
 
+#define ITERSOLVE_BATCH 8
+
 int32_t itersolve_generate_steps(struct stepper_kinematics *sk
                                  , double flush_time);
 double itersolve_check_active(struct stepper_kinematics *sk, double flush_time);
@@ -37,5 +53,11 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
 void itersolve_set_position(struct stepper_kinematics *sk
                             , double x, double y, double z);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+void itersolve_set_linear(struct stepper_kinematics *sk
+                          , double x_coef, double y_coef, double z_coef);
+int32_t itersolve_set_closed_form(struct stepper_kinematics *sk, int enable);
+void itersolve_set_batch_callback(struct stepper_kinematics *sk
+                                  , sk_calc_batch_callback calc_batch_cb);
+int32_t itersolve_set_batch(struct stepper_kinematics *sk, int enable);
 
 #endif // itersolve.h
@@ -0,0 +1,215 @@
+// Bed mesh z adjustment applied during step generation
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // struct stepper_kinematics
+#include "trapq.h" // struct move
+
+
+/****************************************************************
+ * Mesh lookup
+ ****************************************************************/
+
+struct bed_mesh {
+    struct stepper_kinematics sk;
+    struct stepper_kinematics *orig_sk;
+    struct move m;
+    // Mesh grid
+    double *z_table;
+    int x_count, y_count;
+    double min_x, min_y, x_dist, y_dist;
+    // Fade settings
+    double fade_start, fade_end, z_shift;
+    // Cached host adjustment at the start and end of the last move
+    struct move *last_move;
+    double last_print_time, last_start_adj, last_end_adj;
+};
+
+#define DUMMY_T 500.0
+
+static inline double
+constrain(double val, double min_val, double max_val)
+{
+    return val < min_val ? min_val : (val > max_val ? max_val : val);
+}
+
+// Find the grid cell containing a coordinate (matches ZMesh.calc_z)
+static inline int
+calc_index(double coord, double mesh_min, double mesh_dist, int count
+           , double *t)
+{
+    double pos = (coord - mesh_min) / mesh_dist;
+    int idx = pos < 0. ? 0 : (int)pos;
+    if (idx > count - 2)
+        idx = count - 2;
+    *t = constrain(pos - idx, 0., 1.);
+    return idx;
+}
+
+// Bilinear interpolation of the mesh at the given xy position
+static double
+mesh_calc_z(struct bed_mesh *bm, double x, double y)
+{
+    double tx, ty;
+    int xidx = calc_index(x, bm->min_x, bm->x_dist, bm->x_count, &tx);
+    int yidx = calc_index(y, bm->min_y, bm->y_dist, bm->y_count, &ty);
+    double *row0 = &bm->z_table[yidx * bm->x_count + xidx];
+    double *row1 = row0 + bm->x_count;
+    double z0 = (1. - tx) * row0[0] + tx * row0[1];
+    double z1 = (1. - tx) * row1[0] + tx * row1[1];
+    return (1. - ty) * z0 + ty * z1;
+}
+
+// Mesh adjustment (including fade) at the given gcode position
+static double
+mesh_calc_adj(struct bed_mesh *bm, double x, double y, double z)
+{
+    if (z >= bm->fade_end)
+        return bm->z_shift;
+    double adj = mesh_calc_z(bm, x, y);
+    if (z >= bm->fade_start)
+        adj *= (bm->fade_end - z) / (bm->fade_end - bm->fade_start);
+    return adj + bm->z_shift;
+}
+
+// Mesh adjustment the host added to a toolhead position.  The gcode z
+// isn't known, so the fade factor is calculated from the toolhead z
+// (matches BedMesh.get_position).
+static double
+mesh_calc_toolhead_adj(struct bed_mesh *bm, struct coord *c)
+{
+    double z = mesh_calc_z(bm, c->x, c->y);
+    double fade_dist = bm->fade_end - bm->fade_start;
+    double factor = 1.;
+    if (fade_dist > 0.)
+        factor = constrain((bm->fade_end + bm->z_shift - c->z)
+                           / (fade_dist - z), 0., 1.);
+    return factor * z + bm->z_shift;
+}
+
+
+/****************************************************************
+ * Kinematic callbacks
+ ****************************************************************/
+
+// The host adds the mesh adjustment at the start and end of each
+// full move, so the toolhead z follows a straight line between them.
+// Remove that line to obtain the gcode z and apply the mesh there.
+// Other moves (such as homing and probing) are not adjusted.
+static double
+bed_mesh_calc_position(struct stepper_kinematics *sk, struct move *m
+                       , double move_time)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->z_table || !m->is_transformed
+        || (!m->axes_r.x && !m->axes_r.y && !m->is_arc))
+        return bm->orig_sk->calc_position_cb(bm->orig_sk, m, move_time);
+    if (m != bm->last_move || m->print_time != bm->last_print_time) {
+        struct coord start_pos = move_get_coord_dist(m, -m->part_dist);
+        struct coord end_pos = move_get_coord_dist(
+            m, m->total_dist - m->part_dist);
+        bm->last_move = m;
+        bm->last_print_time = m->print_time;
+        bm->last_start_adj = mesh_calc_toolhead_adj(bm, &start_pos);
+        bm->last_end_adj = mesh_calc_toolhead_adj(bm, &end_pos);
+    }
+    double move_dist = m->part_dist + move_get_distance(m, move_time);
+    double r = m->total_dist > 0. ? move_dist / m->total_dist : 0.;
+    struct coord c = move_get_coord(m, move_time);
+    double line_adj = (1. - r) * bm->last_start_adj + r * bm->last_end_adj;
+    double gcode_z = c.z - line_adj;
+    bm->m.start_pos = c;
+    bm->m.start_pos.z = gcode_z + mesh_calc_adj(bm, c.x, c.y, gcode_z);
+    return bm->orig_sk->calc_position_cb(bm->orig_sk, &bm->m, DUMMY_T);
+}
+
+
+/****************************************************************
+ * Interface functions
+ ****************************************************************/
+
+int __visible
+bed_mesh_set_sk(struct stepper_kinematics *sk
+                , struct stepper_kinematics *orig_sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (orig_sk->active_flags != AF_Z)
+        return -1;
+    bm->orig_sk = orig_sk;
+    bm->sk.active_flags = orig_sk->active_flags;
+    return 0;
+}
+
+// Load a new mesh (or disable the adjustment if x_count is zero)
+int __visible
+bed_mesh_set_mesh(struct stepper_kinematics *sk, double *z_table
+                  , int x_count, int y_count, double min_x, double min_y
+                  , double max_x, double max_y)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->z_table);
+    bm->z_table = NULL;
+    bm->last_move = NULL;
+    bm->sk.active_flags = bm->orig_sk->active_flags;
+    if (x_count < 2 || y_count < 2)
+        return 0;
+    int size = x_count * y_count * sizeof(bm->z_table[0]);
+    bm->z_table = malloc(size);
+    if (!bm->z_table)
+        return -1;
+    memcpy(bm->z_table, z_table, size);
+    bm->x_count = x_count;
+    bm->y_count = y_count;
+    bm->min_x = min_x;
+    bm->min_y = min_y;
+    bm->x_dist = (max_x - min_x) / (x_count - 1);
+    bm->y_dist = (max_y - min_y) / (y_count - 1);
+    // Moves in the XY plane now also move the stepper
+    bm->sk.active_flags |= AF_X | AF_Y;
+    return 0;
+}
+
+void __visible
+bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+                  , double fade_end, double z_shift)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    bm->fade_start = fade_start;
+    bm->fade_end = fade_end;
+    bm->z_shift = z_shift;
+    bm->last_move = NULL;
+}
+
+double __visible
+bed_mesh_calc_z(struct stepper_kinematics *sk, double x, double y)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->z_table)
+        return 0.;
+    return mesh_calc_z(bm, x, y);
+}
+
+void __visible
+bed_mesh_free(struct stepper_kinematics *sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->z_table);
+    free(bm);
+}
+
+struct stepper_kinematics * __visible
+bed_mesh_alloc(void)
+{
+    struct bed_mesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    bm->m.move_t = 2. * DUMMY_T;
+    bm->fade_start = bm->fade_end = 1e30;
+    bm->sk.calc_position_cb = bed_mesh_calc_position;
+    return &bm->sk;
+}
@@ -27,6 +27,25 @@ delta_stepper_calc_position(struct stepper_kinematics *sk, struct move *m
     return sqrt(ds->arm2 - dx*dx - dy*dy) + c.z;
 }
 
+static void
+delta_stepper_calc_batch(struct stepper_kinematics *sk, struct move *m
+                         , double *move_times, double *positions, int count)
+{
+    struct delta_stepper *ds = container_of(sk, struct delta_stepper, sk);
+    double arm2 = ds->arm2;
+    double sdx = ds->tower_x - m->start_pos.x, rx = m->axes_r.x;
+    double sdy = ds->tower_y - m->start_pos.y, ry = m->axes_r.y;
+    double sz = m->start_pos.z, rz = m->axes_r.z;
+    double dists[ITERSOLVE_BATCH];
+    move_get_distances(m, move_times, dists, count);
+    int i;
+    for (i = 0; i < count; i++) {
+        double move_dist = dists[i];
+        double dx = sdx - rx * move_dist, dy = sdy - ry * move_dist;
+        positions[i] = sqrt(arm2 - dx*dx - dy*dy) + sz + rz * move_dist;
+    }
+}
+
 struct stepper_kinematics * __visible
 delta_stepper_alloc(double arm2, double tower_x, double tower_y)
 {
@@ -36,6 +55,7 @@ delta_stepper_alloc(double arm2, double tower_x, double tower_y)
     ds->tower_x = tower_x;
     ds->tower_y = tower_y;
     ds->sk.calc_position_cb = delta_stepper_calc_position;
+    itersolve_set_batch_callback(&ds->sk, delta_stepper_calc_batch);
     ds->sk.active_flags = AF_X | AF_Y | AF_Z;
     return &ds->sk;
 }
@@ -50,23 +50,76 @@ extruder_integrate_time(double base, double start_v, double half_accel
     return ei - si;
 }
 
-// Calculate the definitive integral of extruder for a given move
-static double
-pa_move_integrate(struct move *m, double base, double start, double end,
-                  double time_offset)
+#define SMOOTH_COEFS 7
+
+// Calculate the definitive integrals of a polynomial motion formula
+// (coefs[i] is the t^i term) and of its time weighted position
+static void
+extruder_integrate_smooth(double *coefs, double start, double end
+                          , double *iext, double *wgt_ext)
+{
+    double si = 0., ei = 0., swi = 0., ewi = 0.;
+    int i;
+    for (i = SMOOTH_COEFS - 1; i >= 0; i--) {
+        si = si * start + coefs[i] / (i + 1);
+        ei = ei * end + coefs[i] / (i + 1);
+        swi = swi * start + coefs[i] / (i + 2);
+        ewi = ewi * end + coefs[i] / (i + 2);
+    }
+    *iext = ei * end - si * start;
+    *wgt_ext = ewi * end * end - swi * start * start;
+}
+
+// Calculate the definitive integrals of extruder for a move with
+// smooth acceleration
+static void
+pa_smooth_move_integrals(struct move *m, double base, double start
+                         , double end, double *iext, double *wgt_ext)
+{
+    // Distance formula coefficients
+    double dist[SMOOTH_COEFS + 1] = {
+        0., m->start_v, m->half_accel, m->accel_coefs[0],
+        m->accel_coefs[1], m->accel_coefs[2], m->accel_coefs[3], 0. };
+    // Add the pressure advance velocity terms
+    double pressure_advance = m->axes_r.y, coefs[SMOOTH_COEFS];
+    int i;
+    for (i = 0; i < SMOOTH_COEFS; i++)
+        coefs[i] = dist[i] + pressure_advance * (i + 1) * dist[i + 1];
+    coefs[0] += base;
+    extruder_integrate_smooth(coefs, start, end, iext, wgt_ext);
+}
+
+// Calculate the definitive integrals (plain and time weighted) of
+// extruder for a given move
+static void
+pa_move_integrals(struct move *m, double base, double start, double end
+                  , double *iext, double *wgt_ext)
 {
     if (start < 0.)
         start = 0.;
     if (end > m->move_t)
         end = m->move_t;
+    if (unlikely(m->accel_order > 2)) {
+        pa_smooth_move_integrals(m, base, start, end, iext, wgt_ext);
+        return;
+    }
     // Calculate base position and velocity with pressure advance
     double pressure_advance = m->axes_r.y;
     base += pressure_advance * m->start_v;
     double start_v = m->start_v + pressure_advance * 2. * m->half_accel;
     // Calculate definitive integral
     double ha = m->half_accel;
-    double iext = extruder_integrate(base, start_v, ha, start, end);
-    double wgt_ext = extruder_integrate_time(base, start_v, ha, start, end);
+    *iext = extruder_integrate(base, start_v, ha, start, end);
+    *wgt_ext = extruder_integrate_time(base, start_v, ha, start, end);
+}
+
+// Calculate the definitive integral of extruder for a given move
+static double
+pa_move_integrate(struct move *m, double base, double start, double end,
+                  double time_offset)
+{
+    double iext, wgt_ext;
+    pa_move_integrals(m, base, start, end, &iext, &wgt_ext);
     return wgt_ext - time_offset * iext;
 }
 
@@ -97,11 +150,112 @@ pa_range_integrate(struct move *m, double move_time, double hst)
     return res;
 }
 
+// The integrals from the start of a "base" move up to the start of
+// each move are cached on the moves.  The integral over a time range
+// is then the difference of the integrals at its end points (which
+// avoids walking and integrating all the moves in the range).  A new
+// base is started every PA_BASE_TIME seconds to limit the size of the
+// sums (and thus the loss of precision when subtracting them).
+#define PA_BASE_TIME 1.0
+
+// Fill the cached integrals of a move (and of any moves before it)
+static void
+pa_fill_prefix(struct trapq *tq, struct move *m)
+{
+    struct move *pm = m;
+    while (!pm->pa_cached && !list_is_first(&pm->node, &tq->moves))
+        pm = list_prev_entry(pm, node);
+    if (!pm->pa_cached) {
+        pm->pa_base_time = pm->print_time;
+        pm->pa_base_pos = pm->start_pos.x;
+        pm->pa_int = pm->pa_wint = 0.;
+        pm->pa_cached = 1;
+    }
+    while (pm != m) {
+        struct move *next = list_next_entry(pm, node);
+        if (next->print_time - pm->pa_base_time >= PA_BASE_TIME) {
+            next->pa_base_time = next->print_time;
+            next->pa_base_pos = next->start_pos.x;
+            next->pa_int = next->pa_wint = 0.;
+        } else {
+            double base = pm->start_pos.x - pm->pa_base_pos;
+            double offset = pm->print_time - pm->pa_base_time;
+            double iext, wgt_ext;
+            pa_move_integrals(pm, base, 0., pm->move_t, &iext, &wgt_ext);
+            next->pa_base_time = pm->pa_base_time;
+            next->pa_base_pos = pm->pa_base_pos;
+            next->pa_int = pm->pa_int + iext;
+            next->pa_wint = pm->pa_wint + wgt_ext + offset * iext;
+        }
+        // The tail sentinel changes as new moves are added
+        next->pa_cached = !list_is_last(&next->node, &tq->moves);
+        pm = next;
+    }
+}
+
+// Calculate the integrals from the start of the base of a move
+static inline void
+pa_prefix_integrals(struct move *m, double move_time
+                    , double *iext, double *wgt_ext)
+{
+    double base = m->start_pos.x - m->pa_base_pos;
+    double offset = m->print_time - m->pa_base_time;
+    double i, w;
+    pa_move_integrals(m, base, 0., move_time, &i, &w);
+    *iext = m->pa_int + i;
+    *wgt_ext = m->pa_wint + w + offset * i;
+}
+
 struct extruder_stepper {
     struct stepper_kinematics sk;
     double half_smooth_time, inv_half_smooth_time2;
+    // Moves at the start and end of the last smoothing range
+    struct move *last_move, *start_move, *end_move;
+    double last_print_time;
 };
 
+// The moves of the last smoothing range may be freed once step
+// generation completes, so only reuse them within a single pass
+static void
+extruder_post_fixup(struct stepper_kinematics *sk)
+{
+    struct extruder_stepper *es = container_of(sk, struct extruder_stepper, sk);
+    es->last_move = NULL;
+}
+
+// Calculate the same integral as pa_range_integrate() using the
+// cached integrals of the moves
+static double
+pa_cached_range_integrate(struct extruder_stepper *es, struct move *m
+                          , double move_time, double hst)
+{
+    if (m != es->last_move || m->print_time != es->last_print_time) {
+        es->last_move = m;
+        es->last_print_time = m->print_time;
+        es->start_move = es->end_move = NULL;
+    }
+    double start = move_time - hst, end = move_time + hst;
+    if (start >= 0. && end <= m->move_t)
+        // The range is within a single move
+        return pa_range_integrate(m, move_time, hst);
+    struct move *sm = move_find(m, &start, &es->start_move);
+    struct move *em = move_find(m, &end, &es->end_move);
+    if (!em->pa_cached)
+        pa_fill_prefix(es->sk.tq, em);
+    if (unlikely(sm->pa_base_time != em->pa_base_time))
+        // The range spans two bases
+        return pa_range_integrate(m, move_time, hst);
+    double si, sw, mi, mw, ei, ew;
+    pa_prefix_integrals(sm, start, &si, &sw);
+    pa_prefix_integrals(m, move_time, &mi, &mw);
+    pa_prefix_integrals(em, end, &ei, &ew);
+    double t = m->print_time + move_time - sm->pa_base_time;
+    double base_offset = sm->pa_base_pos - m->start_pos.x;
+    return ((mw - sw) - (t - hst) * (mi - si)
+            - (ew - mw) + (t + hst) * (ei - mi)
+            + base_offset * hst * hst);
+}
+
 static double
 extruder_calc_position(struct stepper_kinematics *sk, struct move *m
                        , double move_time)
@@ -112,7 +266,7 @@ extruder_calc_position(struct stepper_kinematics *sk, struct move *m
         // Pressure advance not enabled
         return m->start_pos.x + move_get_distance(m, move_time);
     // Apply pressure advance and average over smooth_time
-    double area = pa_range_integrate(m, move_time, hst);
+    double area = pa_cached_range_integrate(es, m, move_time, hst);
     return m->start_pos.x + area * es->inv_half_smooth_time2;
 }
 
@@ -122,6 +276,7 @@ extruder_set_smooth_time(struct stepper_kinematics *sk, double smooth_time)
     struct extruder_stepper *es = container_of(sk, struct extruder_stepper, sk);
     double hst = smooth_time * .5;
     es->half_smooth_time = hst;
+    es->last_move = NULL;
     es->sk.gen_steps_pre_active = es->sk.gen_steps_post_active = hst;
     if (! hst)
         return;
@@ -134,6 +289,7 @@ extruder_stepper_alloc(void)
     struct extruder_stepper *es = malloc(sizeof(*es));
     memset(es, 0, sizeof(*es));
     es->sk.calc_position_cb = extruder_calc_position;
+    es->sk.post_cb = extruder_post_fixup;
     es->sk.active_flags = AF_X;
     return &es->sk;
 }
@@ -13,6 +13,8 @@
 #include "itersolve.h" // struct stepper_kinematics
 #include "trapq.h" // struct move
 
+#define NEVER_TIME 9999999999999999.9
+
 
 /****************************************************************
  * Shaper-specific initialization
@@ -23,6 +25,18 @@ struct shaper_pulses {
     struct {
         double t, a;
     } pulses[5];
+    // Move found by the last lookup of each pulse
+    struct move *pulse_moves[5];
+    // Shaped position (relative to the last move) in a time range
+    struct shaper_segment {
+        double start, end, base_time;
+        // Polynomial coefficients in time relative to base_time (the
+        // t^3 and higher terms are only used if 'smooth' is set).  If
+        // 'arc' is set a pulse is on an arc move and the position is
+        // calculated directly instead.
+        int smooth, arc;
+        double c[7];
+    } seg;
 };
 
 static inline double
@@ -236,27 +250,69 @@ init_shaper(int shaper_type, double shaper_freq, double damping_ratio
  * Generic position calculation via shaper convolution
  ****************************************************************/
 
-static inline double
-get_axis_position(struct move *m, int axis, double move_time)
+// The shaped position is a sum of the pulse positions, each of which
+// is a polynomial in time until one of the pulses crosses into another
+// move.  So, the sum is calculated as a single polynomial that is
+// valid for that time range and reused while the solver stays in it.
+static void
+calc_segment(struct move *m, int axis, double move_time
+             , struct shaper_pulses *sp)
 {
-    double axis_r = m->axes_r.axis[axis - 'x'];
-    double start_pos = m->start_pos.axis[axis - 'x'];
-    double move_dist = move_get_distance(m, move_time);
-    return start_pos + axis_r * move_dist;
+    struct shaper_segment *seg = &sp->seg;
+    double *c = seg->c;
+    memset(c, 0, sizeof(seg->c));
+    seg->smooth = seg->arc = 0;
+    double seg_start = -NEVER_TIME, seg_end = NEVER_TIME;
+    int num_pulses = sp->num_pulses, i, j, k;
+    for (i = 0; i < num_pulses; ++i) {
+        double t = move_time + sp->pulses[i].t, a = sp->pulses[i].a;
+        struct move *pm = move_find(m, &t, &sp->pulse_moves[i]);
+        if (unlikely(pm->is_arc))
+            seg->arc = 1;
+        // Position of the pulse is a polynomial in (t + dt) where dt
+        // is the time since move_time
+        double axis_r = a * pm->axes_r.axis[axis - 'x'];
+        double start_v = axis_r * pm->start_v;
+        double half_accel = axis_r * pm->half_accel;
+        c[0] += (a * pm->start_pos.axis[axis - 'x']
+                 + (start_v + half_accel * t) * t);
+        c[1] += start_v + 2. * half_accel * t;
+        c[2] += half_accel;
+        if (unlikely(pm->accel_order > 2)) {
+            // Shift the smooth acceleration terms by t
+            double e[7] = { 0., 0., 0. };
+            for (k = 0; k < 4; k++)
+                e[k + 3] = axis_r * pm->accel_coefs[k];
+            for (j = 0; j < 6; j++)
+                for (k = 5; k >= j; k--)
+                    e[k] += t * e[k + 1];
+            for (k = 0; k < 7; k++)
+                c[k] += e[k];
+            seg->smooth = 1;
+        }
+        if (-t > seg_start)
+            seg_start = -t;
+        if (pm->move_t - t < seg_end)
+            seg_end = pm->move_t - t;
+    }
+    seg->base_time = move_time;
+    seg->start = move_time + seg_start;
+    seg->end = move_time + seg_end;
 }
 
-static inline double
-get_axis_position_across_moves(struct move *m, int axis, double time)
+// Calculate the shaped position by evaluating each pulse position
+static double
+calc_direct_position(struct move *m, int axis, double move_time
+                     , struct shaper_pulses *sp)
 {
-    while (likely(time < 0.)) {
-        m = list_prev_entry(m, node);
-        time += m->move_t;
-    }
-    while (likely(time > m->move_t)) {
-        time -= m->move_t;
-        m = list_next_entry(m, node);
+    double res = 0.;
+    int num_pulses = sp->num_pulses, i;
+    for (i = 0; i < num_pulses; ++i) {
+        double t = move_time + sp->pulses[i].t;
+        struct move *pm = move_find(m, &t, &sp->pulse_moves[i]);
+        res += sp->pulses[i].a * move_get_coord(pm, t).axis[axis - 'x'];
     }
-    return get_axis_position(m, axis, time);
+    return res;
 }
 
 // Calculate the position from the convolution of the shaper with input signal
@@ -264,13 +320,25 @@ static inline double
 calc_position(struct move *m, int axis, double move_time
               , struct shaper_pulses *sp)
 {
-    double res = 0.;
-    int num_pulses = sp->num_pulses, i;
-    for (i = 0; i < num_pulses; ++i) {
-        double t = sp->pulses[i].t, a = sp->pulses[i].a;
-        res += a * get_axis_position_across_moves(m, axis, move_time + t);
-    }
-    return res;
+    struct shaper_segment *seg = &sp->seg;
+    if (unlikely(move_time < seg->start || move_time > seg->end))
+        calc_segment(m, axis, move_time, sp);
+    if (unlikely(seg->arc))
+        return calc_direct_position(m, axis, move_time, sp);
+    double *c = seg->c, t = move_time - seg->base_time;
+    double pos = c[0] + (c[1] + c[2] * t) * t;
+    if (unlikely(seg->smooth))
+        pos += (((c[6] * t + c[5]) * t + c[4]) * t + c[3]) * t * t * t;
+    return pos;
+}
+
+// Reset the cached pulse lookups
+static inline void
+clear_segment(struct shaper_pulses *sp)
+{
+    memset(sp->pulse_moves, 0, sizeof(sp->pulse_moves));
+    sp->seg.start = NEVER_TIME;
+    sp->seg.end = -NEVER_TIME;
 }
 
 
@@ -285,8 +353,25 @@ struct input_shaper {
     struct stepper_kinematics *orig_sk;
     struct move m;
     struct shaper_pulses sx, sy;
+    // Move of the last position calculation
+    struct move *last_move;
+    double last_print_time;
 };
 
+// The cached pulse lookups are relative to the move being evaluated
+// (and the moves near it remain on the trapq while it is in use), so
+// they are only reused while that move is unchanged.
+static inline void
+shaper_check_move(struct input_shaper *is, struct move *m)
+{
+    if (likely(m == is->last_move && m->print_time == is->last_print_time))
+        return;
+    is->last_move = m;
+    is->last_print_time = m->print_time;
+    clear_segment(&is->sx);
+    clear_segment(&is->sy);
+}
+
 // Optimized calc_position when only x axis is needed
 static double
 shaper_x_calc_position(struct stepper_kinematics *sk, struct move *m
@@ -295,6 +380,7 @@ shaper_x_calc_position(struct stepper_kinematics *sk, struct move *m
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
     if (!is->sx.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
+    shaper_check_move(is, m);
     is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
@@ -307,6 +393,7 @@ shaper_y_calc_position(struct stepper_kinematics *sk, struct move *m
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
     if (!is->sy.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
+    shaper_check_move(is, m);
     is->m.start_pos.y = calc_position(m, 'y', move_time, &is->sy);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
@@ -319,6 +406,7 @@ shaper_xy_calc_position(struct stepper_kinematics *sk, struct move *m
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
     if (!is->sx.num_pulses && !is->sy.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
+    shaper_check_move(is, m);
     is->m.start_pos = move_get_coord(m, move_time);
     if (is->sx.num_pulses)
         is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
@@ -381,6 +469,7 @@ input_shaper_set_shaper_params(struct stepper_kinematics *sk
         init_shaper(shaper_type_y, shaper_freq_y, damping_ratio_y, &is->sy);
     else
         is->sy.num_pulses = 0;
+    is->last_move = NULL;
     shaper_note_generation_time(is);
     return 0;
 }
@@ -28,6 +28,25 @@ winch_stepper_calc_position(struct stepper_kinematics *sk, struct move *m
     return sqrt(dx*dx + dy*dy + dz*dz);
 }
 
+static void
+winch_stepper_calc_batch(struct stepper_kinematics *sk, struct move *m
+                         , double *move_times, double *positions, int count)
+{
+    struct winch_stepper *hs = container_of(sk, struct winch_stepper, sk);
+    double sdx = hs->anchor.x - m->start_pos.x, rx = m->axes_r.x;
+    double sdy = hs->anchor.y - m->start_pos.y, ry = m->axes_r.y;
+    double sdz = hs->anchor.z - m->start_pos.z, rz = m->axes_r.z;
+    double dists[ITERSOLVE_BATCH];
+    move_get_distances(m, move_times, dists, count);
+    int i;
+    for (i = 0; i < count; i++) {
+        double move_dist = dists[i];
+        double dx = sdx - rx * move_dist, dy = sdy - ry * move_dist;
+        double dz = sdz - rz * move_dist;
+        positions[i] = sqrt(dx*dx + dy*dy + dz*dz);
+    }
+}
+
 struct stepper_kinematics * __visible
 winch_stepper_alloc(double anchor_x, double anchor_y, double anchor_z)
 {
@@ -37,6 +56,7 @@ winch_stepper_alloc(double anchor_x, double anchor_y, double anchor_z)
     hs->anchor.y = anchor_y;
     hs->anchor.z = anchor_z;
     hs->sk.calc_position_cb = winch_stepper_calc_position;
+    itersolve_set_batch_callback(&hs->sk, winch_stepper_calc_batch);
     hs->sk.active_flags = AF_X | AF_Y | AF_Z;
     return &hs->sk;
 }
@@ -27,6 +27,12 @@
 #define CHECK_LINES 1
 #define QUEUE_START_SIZE 1024
 
+struct step_move {
+    uint32_t interval;
+    uint16_t count;
+    int16_t add;
+};
+
 struct stepcompress {
     // Buffer management
     uint32_t *queue, *queue_end, *queue_pos, *queue_next;
@@ -42,6 +48,10 @@ struct stepcompress {
     // Step+dir+step filter
     uint64_t next_step_clock;
     int next_step_dir;
+    // Lookahead (the sequence found after the last one sent)
+    struct step_move next_move;
+    uint32_t *next_move_pos;
+    uint64_t next_move_clock;
 };
 
 
@@ -84,12 +94,6 @@ minmax_point(struct stepcompress *sc, uint32_t *pos)
 // using 11 works well in practice.
 #define QUADRATIC_DEV 11
 
-struct step_move {
-    uint32_t interval;
-    uint16_t count;
-    int16_t add;
-};
-
 // Find a 'step_move' that covers a series of step times
 static struct step_move
 compress_bisect_add(struct stepcompress *sc)
@@ -185,6 +189,64 @@ compress_bisect_add(struct stepcompress *sc)
     return (struct step_move){ bestinterval, bestcount, bestadd };
 }
 
+// Return the number of clock ticks covered by a 'step_move'
+static inline uint32_t
+move_ticks(struct step_move move)
+{
+    int32_t addfactor = move.count*(move.count-1)/2;
+    return move.add*addfactor + move.interval*move.count;
+}
+
+// Find the 'step_move' that would follow a given 'step_move'
+static struct step_move
+compress_next(struct stepcompress *sc, struct step_move move)
+{
+    uint32_t *queue_pos = sc->queue_pos;
+    uint64_t last_step_clock = sc->last_step_clock;
+    sc->queue_pos += move.count;
+    sc->last_step_clock += move_ticks(move);
+    struct step_move next = compress_bisect_add(sc);
+    sc->queue_pos = queue_pos;
+    sc->last_step_clock = last_step_clock;
+    return next;
+}
+
+// Find the 'step_move' to send next.  While the step rate changes,
+// ending a sequence one step early sometimes allows the following
+// sequence to cover several more steps, so check the sequence that
+// follows both options.
+static struct step_move
+compress_lookahead(struct stepcompress *sc)
+{
+    struct step_move move;
+    if (sc->next_move_pos == sc->queue_pos
+        && sc->next_move_clock == sc->last_step_clock)
+        move = sc->next_move;
+    else
+        move = compress_bisect_add(sc);
+    sc->next_move_pos = NULL;
+    if (move.count < 2 || !move.add
+        || sc->queue_pos + move.count >= sc->queue_next)
+        return move;
+    struct step_move next = compress_next(sc, move);
+    struct step_move short_move = move;
+    short_move.count--;
+    struct step_move short_next = compress_next(sc, short_move);
+    if (short_move.count + short_next.count > move.count + next.count) {
+        move = short_move;
+        next = short_next;
+    }
+    // Sequences that reach the end of the queue may change as more
+    // steps are added, so only remember those that do not
+    uint32_t *next_pos = sc->queue_pos + move.count;
+    if (next_pos + next.count < sc->queue_next) {
+        sc->next_move = next;
+        sc->next_move_pos = next_pos;
+        sc->next_move_clock = sc->last_step_clock + move_ticks(move);
+    }
+    return move;
+}
+
 
 /****************************************************************
  * Step compress checking
@@ -302,7 +364,7 @@ queue_flush(struct stepcompress *sc, uint64_t move_clock)
     if (sc->queue_pos >= sc->queue_next)
         return 0;
     while (sc->last_step_clock < move_clock) {
-        struct step_move move = compress_bisect_add(sc);
+        struct step_move move = compress_lookahead(sc);
         int ret = check_line(sc, move);
         if (ret)
             return ret;
@@ -312,9 +374,7 @@ queue_flush(struct stepcompress *sc, uint64_t move_clock)
         };
         struct queue_message *qm = message_alloc_and_encode(msg, 5);
         qm->min_clock = qm->req_clock = sc->last_step_clock;
-        int32_t addfactor = move.count*(move.count-1)/2;
-        uint32_t ticks = move.add*addfactor + move.interval*move.count;
-        sc->last_step_clock += ticks;
+        sc->last_step_clock += move_ticks(move);
         list_add_tail(&qm->node, &sc->msg_queue);
 
         if (sc->queue_pos + move.count >= sc->queue_next) {
@@ -411,6 +471,7 @@ queue_append_extend(struct stepcompress *sc)
         }
         sc->queue_pos = sc->queue;
         sc->queue_next = sc->queue + in_use;
+        sc->next_move_pos = NULL;
     }
 
     *sc->queue_next++ = sc->next_step_clock;
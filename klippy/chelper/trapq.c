@@ -4,7 +4,7 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
-#include <math.h> // sqrt
+#include <math.h> // sqrt, cos, sin
 #include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
@@ -20,6 +20,74 @@ move_alloc(void)
     return m;
 }
 
+// Set the acceleration of an accel or decel move.  With smooth
+// acceleration the velocity follows a polynomial "S" curve that
+// covers the same distance in the same time as constant acceleration.
+static void
+move_set_accel(struct move *m, int accel_order, double accel)
+{
+    if (accel_order <= 2) {
+        m->half_accel = .5 * accel;
+        return;
+    }
+    double inv_accel_t = 1. / m->move_t;
+    double accel_div_accel_t = accel * inv_accel_t;
+    double accel_div_accel_t2 = accel_div_accel_t * inv_accel_t;
+    m->accel_order = accel_order;
+    if (accel_order == 4) {
+        m->accel_coefs[0] = accel_div_accel_t;
+        m->accel_coefs[1] = -.5 * accel_div_accel_t2;
+        return;
+    }
+    double accel_div_accel_t3 = accel_div_accel_t2 * inv_accel_t;
+    m->accel_coefs[1] = 2.5 * accel_div_accel_t2;
+    m->accel_coefs[2] = -3. * accel_div_accel_t3;
+    m->accel_coefs[3] = accel_div_accel_t3 * inv_accel_t;
+}
+
+// Add one portion (accel, cruise, or decel) of a move with the
+// geometry of move 'tm' and update 'tm' to start where it ends
+static double
+trapq_append_part(struct trapq *tq, struct move *tm, double print_time
+                  , double move_t, double start_v, double accel)
+{
+    struct move *m = move_alloc();
+    *m = *tm;
+    m->print_time = print_time;
+    m->move_t = move_t;
+    m->start_v = start_v;
+    if (accel)
+        move_set_accel(m, tq->accel_order, accel);
+    trapq_add_move(tq, m);
+
+    double move_dist = move_get_distance(m, move_t);
+    tm->start_pos = move_get_coord(m, move_t);
+    tm->arc_angle += tm->arc_angle_r * move_dist;
+    tm->arc_radius += tm->arc_radius_r * move_dist;
+    tm->part_dist += move_dist;
+    return print_time + move_t;
+}
+
+// Add the accel, cruise, and decel portions of a move
+static void
+trapq_append_parts(struct trapq *tq, struct move *tm, double print_time
+                   , double accel_t, double cruise_t, double decel_t
+                   , double start_v, double cruise_v, double accel)
+{
+    tm->is_transformed = tq->is_transformed;
+    double end_v = cruise_v - accel * decel_t;
+    tm->total_dist = (.5 * (start_v + cruise_v) * accel_t + cruise_v * cruise_t
+                      + .5 * (cruise_v + end_v) * decel_t);
+    if (accel_t)
+        print_time = trapq_append_part(tq, tm, print_time, accel_t
+                                       , start_v, accel);
+    if (cruise_t)
+        print_time = trapq_append_part(tq, tm, print_time, cruise_t
+                                       , cruise_v, 0.);
+    if (decel_t)
+        trapq_append_part(tq, tm, print_time, decel_t, cruise_v, -accel);
+}
+
 // Fill and add a move to the trapezoid velocity queue
 void __visible
 trapq_append(struct trapq *tq, double print_time
@@ -28,64 +96,140 @@ trapq_append(struct trapq *tq, double print_time
              , double axes_r_x, double axes_r_y, double axes_r_z
              , double start_v, double cruise_v, double accel)
 {
-    struct coord start_pos = { .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
-    struct coord axes_r = { .x=axes_r_x, .y=axes_r_y, .z=axes_r_z };
-    if (accel_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = accel_t;
-        m->start_v = start_v;
-        m->half_accel = .5 * accel;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
+    struct move tm;
+    memset(&tm, 0, sizeof(tm));
+    tm.start_pos = (struct coord){
+        .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
+    tm.axes_r = (struct coord){ .x=axes_r_x, .y=axes_r_y, .z=axes_r_z };
+    trapq_append_parts(tq, &tm, print_time, accel_t, cruise_t, decel_t
+                       , start_v, cruise_v, accel);
+}
 
-        print_time += accel_t;
-        start_pos = move_get_coord(m, accel_t);
+// Fill and add an arc move to the trapezoid velocity queue.  The
+// 'angle_r' and 'radius_r' parameters are the change in angle
+// (radians) and radius per millimeter of movement.
+void __visible
+trapq_append_arc(struct trapq *tq, double print_time
+                 , double accel_t, double cruise_t, double decel_t
+                 , double start_pos_x, double start_pos_y, double start_pos_z
+                 , double center_x, double center_y
+                 , double angle_r, double radius_r, double axis_r_z
+                 , double start_v, double cruise_v, double accel)
+{
+    struct move tm;
+    memset(&tm, 0, sizeof(tm));
+    tm.start_pos = (struct coord){
+        .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
+    tm.axes_r.z = axis_r_z;
+    tm.is_arc = 1;
+    tm.arc_center_x = center_x;
+    tm.arc_center_y = center_y;
+    double dx = start_pos_x - center_x, dy = start_pos_y - center_y;
+    tm.arc_angle = atan2(dy, dx);
+    tm.arc_angle_r = angle_r;
+    tm.arc_radius = sqrt(dx*dx + dy*dy);
+    tm.arc_radius_r = radius_r;
+    trapq_append_parts(tq, &tm, print_time, accel_t, cruise_t, decel_t
+                       , start_v, cruise_v, accel);
+}
+
+// Return the distance moved given a time in a move
+inline double
+move_get_distance(struct move *m, double move_time)
+{
+    double dist = (m->start_v + m->half_accel * move_time) * move_time;
+    if (unlikely(m->accel_order > 2)) {
+        double *c = m->accel_coefs, t = move_time, t3 = t * t * t;
+        dist += (((c[3] * t + c[2]) * t + c[1]) * t + c[0]) * t3;
     }
-    if (cruise_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = cruise_t;
-        m->start_v = cruise_v;
-        m->half_accel = 0.;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
-
-        print_time += cruise_t;
-        start_pos = move_get_coord(m, cruise_t);
+    return dist;
+}
+
+// Fill 'dists' with the distance moved at each of the given times
+void
+move_get_distances(struct move *m, double *move_times, double *dists
+                   , int count)
+{
+    double start_v = m->start_v, half_accel = m->half_accel;
+    int i;
+    for (i = 0; i < count; i++) {
+        double t = move_times[i];
+        dists[i] = (start_v + half_accel * t) * t;
     }
-    if (decel_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = decel_t;
-        m->start_v = cruise_v;
-        m->half_accel = -.5 * accel;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
+    if (likely(m->accel_order <= 2))
+        return;
+    double *c = m->accel_coefs;
+    for (i = 0; i < count; i++) {
+        double t = move_times[i], t3 = t * t * t;
+        dists[i] += (((c[3] * t + c[2]) * t + c[1]) * t + c[0]) * t3;
     }
 }
 
-// Return the distance moved given a time in a move
+// Return the time in a move that the given distance is reached
 inline double
-move_get_distance(struct move *m, double move_time)
+move_get_time(struct move *m, double move_dist)
 {
-    return (m->start_v + m->half_accel * move_time) * move_time;
+    // Solve half_accel*t^2 + start_v*t - move_dist = 0 (in a form
+    // that is numerically stable when half_accel is small)
+    double start_v = m->start_v;
+    double disc = start_v * start_v + 4. * m->half_accel * move_dist;
+    double denom = start_v + sqrt(disc > 0. ? disc : 0.);
+    if (denom <= 0.)
+        return 0.;
+    return 2. * move_dist / denom;
 }
 
-// Return the XYZ coordinates given a time in a move
+// Find the move containing 'time' (relative to the start of move
+// 'm').  The search starts at the move found by the previous lookup
+// in 'cursor' (if set) and 'time' is updated to be relative to the
+// start of the returned move.
+inline struct move *
+move_find(struct move *m, double *time, struct move **cursor)
+{
+    double t = *time;
+    struct move *cm = *cursor;
+    if (cm) {
+        t += m->print_time - cm->print_time;
+        m = cm;
+    }
+    while (t < 0.) {
+        m = list_prev_entry(m, node);
+        t += m->move_t;
+    }
+    while (t > m->move_t) {
+        t -= m->move_t;
+        m = list_next_entry(m, node);
+    }
+    *cursor = m;
+    *time = t;
+    return m;
+}
+
+// Return the XYZ coordinates given a distance along a move
 inline struct coord
-move_get_coord(struct move *m, double move_time)
+move_get_coord_dist(struct move *m, double move_dist)
 {
-    double move_dist = move_get_distance(m, move_time);
+    if (unlikely(m->is_arc)) {
+        double angle = m->arc_angle + m->arc_angle_r * move_dist;
+        double radius = m->arc_radius + m->arc_radius_r * move_dist;
+        return (struct coord) {
+            .x = m->arc_center_x + radius * cos(angle),
+            .y = m->arc_center_y + radius * sin(angle),
+            .z = m->start_pos.z + m->axes_r.z * move_dist };
+    }
     return (struct coord) {
         .x = m->start_pos.x + m->axes_r.x * move_dist,
         .y = m->start_pos.y + m->axes_r.y * move_dist,
         .z = m->start_pos.z + m->axes_r.z * move_dist };
 }
 
+// Return the XYZ coordinates given a time in a move
+inline struct coord
+move_get_coord(struct move *m, double move_time)
+{
+    return move_get_coord_dist(m, move_get_distance(m, move_time));
+}
+
 #define NEVER_TIME 9999999999999999.9
 
 // Allocate a new 'trapq' object
@@ -95,6 +239,7 @@ trapq_alloc(void)
     struct trapq *tq = malloc(sizeof(*tq));
     memset(tq, 0, sizeof(*tq));
     list_init(&tq->moves);
+    tq->accel_order = 2;
     struct move *head_sentinel = move_alloc(), *tail_sentinel = move_alloc();
     tail_sentinel->print_time = tail_sentinel->move_t = NEVER_TIME;
     list_add_head(&head_sentinel->node, &tq->moves);
@@ -102,6 +247,23 @@ trapq_alloc(void)
     return tq;
 }
 
+// Select constant (2) or smooth (4 or 6) acceleration for new moves
+int32_t __visible
+trapq_set_accel_order(struct trapq *tq, int accel_order)
+{
+    if (accel_order != 2 && accel_order != 4 && accel_order != 6)
+        return -1;
+    tq->accel_order = accel_order;
+    return 0;
+}
+
+// Note if new moves were adjusted by a host move transform
+void __visible
+trapq_set_transformed(struct trapq *tq, int is_transformed)
+{
+    tq->is_transformed = is_transformed;
+}
+
 // Free memory associated with a 'trapq' object
 void __visible
 trapq_free(struct trapq *tq)
@@ -111,9 +273,40 @@ trapq_free(struct trapq *tq)
         list_del(&m->node);
         free(m);
     }
+    free(tq->index);
     free(tq);
 }
 
+#define INDEX_MIN_SIZE 64
+
+// Return the move at the given position of the move index
+static inline struct move *
+index_get(struct trapq *tq, int pos)
+{
+    return tq->index[(tq->index_start + pos) & (tq->index_size - 1)];
+}
+
+// Add a move to the end of the move index
+static void
+index_push(struct trapq *tq, struct move *m)
+{
+    if (tq->index_count >= tq->index_size) {
+        // Grow the ring buffer (its size is always a power of two)
+        int size = tq->index_size ? tq->index_size * 2 : INDEX_MIN_SIZE;
+        struct move **index = malloc(size * sizeof(*index));
+        int i;
+        for (i = 0; i < tq->index_count; i++)
+            index[i] = index_get(tq, i);
+        free(tq->index);
+        tq->index = index;
+        tq->index_size = size;
+        tq->index_start = 0;
+    }
+    int pos = (tq->index_start + tq->index_count) & (tq->index_size - 1);
+    tq->index[pos] = m;
+    tq->index_count++;
+}
+
 // Update the list sentinels
 void
 trapq_check_sentinels(struct trapq *tq)
@@ -152,8 +345,10 @@ trapq_add_move(struct trapq *tq, struct move *m)
             null_move->print_time = prev->print_time + prev->move_t;
         null_move->move_t = m->print_time - null_move->print_time;
         list_add_before(&null_move->node, &tail_sentinel->node);
+        index_push(tq, null_move);
     }
     list_add_before(&m->node, &tail_sentinel->node);
+    index_push(tq, m);
     tail_sentinel->print_time = 0.;
 }
 
@@ -173,5 +368,28 @@ trapq_free_moves(struct trapq *tq, double print_time)
             return;
         list_del(&m->node);
         free(m);
+        tq->index_start = (tq->index_start + 1) & (tq->index_size - 1);
+        tq->index_count--;
+    }
+}
+
+// Find the first move that ends after 'print_time' (this may be one
+// of the list sentinels)
+struct move *
+trapq_find_move(struct trapq *tq, double print_time)
+{
+    if (print_time < 0.)
+        return list_first_entry(&tq->moves, struct move, node);
+    int low = 0, high = tq->index_count;
+    while (low < high) {
+        int mid = (low + high) / 2;
+        struct move *m = index_get(tq, mid);
+        if (m->print_time + m->move_t > print_time)
+            high = mid;
+        else
+            low = mid + 1;
     }
+    if (low >= tq->index_count)
+        return list_last_entry(&tq->moves, struct move, node);
+    return index_get(tq, low);
 }
@@ -1,6 +1,7 @@
 #ifndef TRAPQ_H
 #define TRAPQ_H
 
+#include <stdint.h> // int32_t
 #include "list.h" // list_node
 
 struct coord {
@@ -15,13 +16,37 @@ struct coord {
 struct move {
     double print_time, move_t;
     double start_v, half_accel;
+    // The t^3 to t^6 terms of the distance formula of moves with
+    // smooth acceleration (only used when accel_order is above 2)
+    int accel_order;
+    double accel_coefs[4];
     struct coord start_pos, axes_r;
+    // Arc moves follow an arc (or spiral) in the XY plane around the
+    // given center - the angle and radius change linearly with the
+    // distance moved (axes_r.z is still used for the Z axis)
+    int is_arc;
+    double arc_center_x, arc_center_y, arc_angle, arc_angle_r;
+    double arc_radius, arc_radius_r;
+    // Distance moved in the full move (as added by trapq_append)
+    // before this part started, and the distance of the full move
+    double part_dist, total_dist;
+    // Set on moves whose end points were adjusted by a host move
+    // transform (see kin_bed_mesh.c)
+    int is_transformed;
+    // Cached extruder position integrals (see kin_extruder.c)
+    int pa_cached;
+    double pa_base_time, pa_base_pos, pa_int, pa_wint;
 
     struct list_node node;
 };
 
 struct trapq {
     struct list_head moves;
+    int accel_order, is_transformed;
+    // Ring buffer of the moves on the list (excluding the sentinels)
+    // in time order - used to find a move by time
+    struct move **index;
+    int index_size, index_start, index_count;
 };
 
 struct move *move_alloc(void);
@@ -30,12 +55,26 @@ void trapq_append(struct trapq *tq, double print_time
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_arc(struct trapq *tq, double print_time
+                      , double accel_t, double cruise_t, double decel_t
+                      , double start_pos_x, double start_pos_y
+                      , double start_pos_z, double center_x, double center_y
+                      , double angle_r, double radius_r, double axis_r_z
+                      , double start_v, double cruise_v, double accel);
 double move_get_distance(struct move *m, double move_time);
+void move_get_distances(struct move *m, double *move_times, double *dists
+                        , int count);
+double move_get_time(struct move *m, double move_dist);
+struct move *move_find(struct move *m, double *time, struct move **cursor);
+struct coord move_get_coord_dist(struct move *m, double move_dist);
 struct coord move_get_coord(struct move *m, double move_time);
 struct trapq *trapq_alloc(void);
+int32_t trapq_set_accel_order(struct trapq *tq, int accel_order);
+void trapq_set_transformed(struct trapq *tq, int is_transformed);
 void trapq_free(struct trapq *tq);
 void trapq_check_sentinels(struct trapq *tq);
 void trapq_add_move(struct trapq *tq, struct move *m);
 void trapq_free_moves(struct trapq *tq, double print_time);
+struct move *trapq_find_move(struct trapq *tq, double print_time);
 
 #endif // trapq.h
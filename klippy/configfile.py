@@ -267,10 +267,13 @@ class PrinterConfig:
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
-    def get_status(self, eventtime):
-        return {'config': self.status_raw_config,
-                'settings': self.status_settings,
-                'save_config_pending': self.save_config_pending}
+    def get_status(self, eventtime, fields=None):
+        status = {'config': self.status_raw_config,
+                  'settings': self.status_settings,
+                  'save_config_pending': self.save_config_pending}
+        if fields is None:
+            return status
+        return {k: v for k, v in status.items() if k in fields}
     # Autosave functions
     def set(self, section, option, value):
         if not self.autosave.fileconfig.has_section(section):
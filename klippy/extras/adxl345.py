@@ -3,7 +3,8 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, sys, array
+import importlib
 from . import bus
 
 # ADXL345 registers
@@ -25,21 +26,33 @@ SCALE = 0.004 * 9.80665 * 1000. # 4mg/LSB * Earth gravity in mm/s**2
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Binary data files start with this line and a line with the stats,
+# followed by little-endian doubles (time, accel_x, accel_y, accel_z)
+BINARY_HEADER = b"#accel_binary\n"
+OUTPUT_FORMATS = {'csv': '.csv', 'binary': '.bin'}
+
 # Sample results
 class ADXL345Results:
     def __init__(self):
         self.raw_samples = None
         self.samples = []
+        try:
+            self.numpy = importlib.import_module('numpy')
+        except ImportError:
+            self.numpy = None
         self.drops = self.overflows = 0
         self.time_per_sample = self.start_range = self.end_range = 0.
+        self.seq_to_time = 0.
+        self.total_count = 0
     def get_stats(self):
         return ("drops=%d,overflows=%d"
                 ",time_per_sample=%.9f,start_range=%.6f,end_range=%.6f"
                 % (self.drops, self.overflows,
                    self.time_per_sample, self.start_range, self.end_range))
-    def setup_data(self, axes_map, raw_samples, end_sequence, overflows,
+    def setup_data(self, axes_map, raw_samples, sample_count, last_count,
+                   end_sequence, overflows,
                    start1_time, start2_time, end1_time, end2_time):
-        if not raw_samples or not end_sequence:
+        if not sample_count or not end_sequence:
             return
         self.axes_map = axes_map
         self.raw_samples = raw_samples
@@ -47,15 +60,38 @@ class ADXL345Results:
         self.start2_time = start2_time
         self.start_range = start2_time - start1_time
         self.end_range = end2_time - end1_time
-        self.total_count = (end_sequence - 1) * 8 + len(raw_samples[-1][1]) // 6
+        self.total_count = (end_sequence - 1) * 8 + last_count
         total_time = end2_time - start2_time
         self.time_per_sample = time_per_sample = total_time / self.total_count
         self.seq_to_time = time_per_sample * 8.
-        actual_count = sum([len(data)//6 for _, data in raw_samples])
-        self.drops = self.total_count - actual_count
+        self.drops = self.total_count - sample_count
+    def _decode_numpy(self):
+        # Decode all samples at once into an array of
+        # (time, accel_x, accel_y, accel_z) rows
+        np = self.numpy
+        seqs = [seq for seq, _ in self.raw_samples]
+        blocks = [data[:len(data) - len(data) % 6]
+                  for _, data in self.raw_samples]
+        counts = np.array([len(data) // 6 for data in blocks], dtype=int)
+        sdata = np.frombuffer(b"".join(blocks), dtype='<i2').reshape(-1, 3)
+        seq_times = self.start2_time + np.array(seqs) * self.seq_to_time
+        starts = np.cumsum(counts) - counts
+        indexes = np.arange(sdata.shape[0]) - np.repeat(starts, counts)
+        samples = np.empty((sdata.shape[0], 4))
+        samples[:,0] = (np.repeat(seq_times, counts)
+                        + indexes * self.time_per_sample)
+        for i, (pos, scale) in enumerate(self.axes_map):
+            samples[:,i+1] = sdata[:,pos] * scale
+        return samples
     def decode_samples(self):
+        # Returns a list of Accel_Measurement tuples (or an equivalent
+        # array if numpy is available)
         if not self.raw_samples:
             return self.samples
+        if self.numpy is not None:
+            self.samples = self._decode_numpy()
+            self.raw_samples = None
+            return self.samples
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         actual_count = 0
         self.samples = samples = [None] * self.total_count
@@ -73,21 +109,40 @@ class ADXL345Results:
                 samples[actual_count] = Accel_Measurement(samp_time, x, y, z)
                 actual_count += 1
         del samples[actual_count:]
+        self.raw_samples = None
         return self.samples
-    def write_to_file(self, filename):
+    def _write_csv(self, f, samples):
+        f.write(("##%s\n#time,accel_x,accel_y,accel_z\n" % (
+            self.get_stats(),)).encode())
+        if self.numpy is not None:
+            self.numpy.savetxt(f, samples, fmt="%.6f", delimiter=",")
+            return
+        for t, accel_x, accel_y, accel_z in samples:
+            f.write(("%.6f,%.6f,%.6f,%.6f\n" % (
+                t, accel_x, accel_y, accel_z)).encode())
+    def _write_binary(self, f, samples):
+        f.write(BINARY_HEADER)
+        f.write(("##%s\n" % (self.get_stats(),)).encode())
+        if self.numpy is not None:
+            f.write(self.numpy.asarray(samples, dtype='<f8').tobytes())
+            return
+        data = array.array('d', [v for sample in samples for v in sample])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        data.tofile(f)
+    def write_to_file(self, filename, output_format='csv'):
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (
-                self.get_stats(),))
-            samples = self.samples or self.decode_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
+            f = open(filename, "wb")
+            samples = self.decode_samples()
+            if output_format == 'binary':
+                self._write_binary(f, samples)
+            else:
+                self._write_csv(f, samples)
             f.close()
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
@@ -111,6 +166,9 @@ class ADXL345:
         # Measurement storage (accessed from background thread)
         self.raw_samples = []
         self.last_sequence = 0
+        self.sample_count = self.last_count = 0
+        self.stream = None
+        self.store_samples = True
         self.samples_start1 = self.samples_start2 = 0.
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
@@ -160,17 +218,26 @@ class ADXL345:
         if sequence < last_sequence:
             sequence += 0x10000
         self.last_sequence = sequence
+        data = params['data']
+        self.sample_count += len(data) // 6
+        self.last_count = len(data) // 6
+        if self.stream is not None:
+            self.stream.add_samples(sequence, data)
         raw_samples = self.raw_samples
-        if len(raw_samples) >= 300000:
+        if not self.store_samples or len(raw_samples) >= 300000:
             # Avoid filling up memory with too many samples
             return
-        raw_samples.append((sequence, params['data']))
+        raw_samples.append((sequence, data))
     def _convert_sequence(self, sequence):
         sequence = (self.last_sequence & ~0xffff) | sequence
         if sequence < self.last_sequence:
             sequence += 0x10000
         return sequence
-    def start_measurements(self, rate=None):
+    def start_measurements(self, rate=None, stream=None, store_samples=True,
+                           print_time=None):
+        # Raw measurements are passed to the optional 'stream' (from the
+        # background thread) as they arrive.  Several chips may be
+        # started at the same 'print_time' to synchronize them.
         rate = rate or self.data_rate
         # Verify chip connectivity
         params = self.spi.spi_transfer([REG_DEVID | REG_MOD_READ, 0x00])
@@ -188,10 +255,17 @@ class ADXL345:
         self.spi.spi_send([REG_BW_RATE, QUERY_RATES[rate]])
         self.spi.spi_send([REG_FIFO_CTL, 0x80])
         # Setup samples
-        print_time = self.printer.lookup_object('toolhead').get_last_move_time()
+        if print_time is None:
+            toolhead = self.printer.lookup_object('toolhead')
+            print_time = toolhead.get_last_move_time()
         self.raw_samples = []
         self.last_sequence = 0
+        self.sample_count = self.last_count = 0
         self.samples_start1 = self.samples_start2 = print_time
+        if stream is not None:
+            stream.start(self.axes_map, rate)
+        self.stream = stream
+        self.store_samples = store_samples
         # Start bulk reading
         reqclock = self.mcu.print_time_to_clock(print_time)
         rest_ticks = self.mcu.seconds_to_clock(4. / rate)
@@ -199,12 +273,14 @@ class ADXL345:
         self.query_rate = rate
         self.query_adxl345_cmd.send([self.oid, reqclock, rest_ticks],
                                     reqclock=reqclock)
-    def finish_measurements(self):
+    def finish_measurements(self, print_time=None):
         query_rate = self.query_rate
         if not query_rate:
             return ADXL345Results()
         # Halt bulk reading
-        print_time = self.printer.lookup_object('toolhead').get_last_move_time()
+        if print_time is None:
+            toolhead = self.printer.lookup_object('toolhead')
+            print_time = toolhead.get_last_move_time()
         clock = self.mcu.print_time_to_clock(print_time)
         params = self.query_adxl345_end_cmd.send([self.oid, 0, 0],
                                                  minclock=clock)
@@ -212,35 +288,41 @@ class ADXL345:
         self.query_rate = 0
         raw_samples = self.raw_samples
         self.raw_samples = []
+        self.stream = None
         # Generate results
         end1_time = self._clock_to_print_time(params['end1_time'])
         end2_time = self._clock_to_print_time(params['end2_time'])
         end_sequence = self._convert_sequence(params['sequence'])
         overflows = params['limit_count']
         res = ADXL345Results()
-        res.setup_data(self.axes_map, raw_samples, end_sequence, overflows,
+        res.setup_data(self.axes_map, raw_samples, self.sample_count,
+                       self.last_count, end_sequence, overflows,
                        self.samples_start1, self.samples_start2,
                        end1_time, end2_time)
         logging.info("ADXL345 finished %d measurements: %s",
                      res.total_count, res.get_stats())
         return res
-    def end_query(self, name):
+    def end_query(self, name, output_format='csv'):
         if not self.query_rate:
             return
         res = self.finish_measurements()
         # Write data to file
+        ext = OUTPUT_FORMATS[output_format]
         if self.name == "default":
-            filename = "/tmp/adxl345-%s.csv" % (name,)
+            filename = "/tmp/adxl345-%s%s" % (name, ext)
         else:
-            filename = "/tmp/adxl345-%s-%s.csv" % (self.name, name,)
-        res.write_to_file(filename)
+            filename = "/tmp/adxl345-%s-%s%s" % (self.name, name, ext)
+        res.write_to_file(filename, output_format)
     cmd_ACCELEROMETER_MEASURE_help = "Start/stop accelerometer"
     def cmd_ACCELEROMETER_MEASURE(self, gcmd):
         if self.query_rate:
             name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
             if not name.replace('-', '').replace('_', '').isalnum():
                 raise gcmd.error("Invalid adxl345 NAME parameter")
-            self.end_query(name)
+            output_format = gcmd.get("FORMAT", "csv").lower()
+            if output_format not in OUTPUT_FORMATS:
+                raise gcmd.error("Invalid adxl345 FORMAT parameter")
+            self.end_query(name, output_format)
             gcmd.respond_info("adxl345 measurements stopped")
         else:
             rate = gcmd.get_int("RATE", self.data_rate)
@@ -4,7 +4,9 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, importlib, bisect
+import os, struct
+import chelper, mathutil
 from . import probe
 
 PROFILE_VERSION = 1
@@ -17,6 +19,84 @@ PROFILE_OPTIONS = {
 class BedMeshError(Exception):
     pass
 
+# Find the xy extents of an arc (including the axis crossings)
+def get_arc_extents(start, end, center, clockwise):
+    cx, cy = center
+    radius = math.sqrt((start[0] - cx)**2 + (start[1] - cy)**2)
+    start_angle = math.atan2(start[1] - cy, start[0] - cx)
+    end_angle = math.atan2(end[1] - cy, end[0] - cx)
+    if clockwise:
+        start_angle, end_angle = end_angle, start_angle
+    # Counter-clockwise sweep from start_angle (full circle if equal)
+    sweep = (end_angle - start_angle) % (2. * math.pi)
+    if sweep < 1e-9:
+        sweep = 2. * math.pi
+    xs = [start[0], end[0]]
+    ys = [start[1], end[1]]
+    for quadrant in range(4):
+        angle = quadrant * .5 * math.pi
+        if (angle - start_angle) % (2. * math.pi) <= sweep:
+            xs.append(cx + radius * math.cos(angle))
+            ys.append(cy + radius * math.sin(angle))
+    return (min(xs), min(ys)), (max(xs), max(ys))
+
+# Find the xy extents of the extruding moves in a gcode file
+def get_print_area(filename):
+    min_x = min_y = 99999999.
+    max_x = max_y = -99999999.
+    pos = {'X': 0., 'Y': 0., 'E': 0.}
+    absolute_coord = absolute_extrude = True
+    f = open(filename, 'rb')
+    for line in f:
+        words = line.split(';', 1)[0].upper().split()
+        if not words:
+            continue
+        cmd = words[0]
+        if cmd in ('G0', 'G1', 'G2', 'G3', 'G92'):
+            params = {}
+            for word in words[1:]:
+                if word[:1] in 'XYEIJ':
+                    try:
+                        params[word[0]] = float(word[1:])
+                    except ValueError:
+                        pass
+            offset_i = params.pop('I', 0.)
+            offset_j = params.pop('J', 0.)
+            if cmd == 'G92':
+                pos.update(params or {'X': 0., 'Y': 0., 'E': 0.})
+                continue
+            last_x, last_y, last_e = pos['X'], pos['Y'], pos['E']
+            for axis, value in params.items():
+                is_absolute = absolute_coord
+                if axis == 'E':
+                    is_absolute = absolute_coord and absolute_extrude
+                pos[axis] = value if is_absolute else pos[axis] + value
+            if pos['E'] <= last_e:
+                continue
+            if cmd in ('G2', 'G3'):
+                (amin_x, amin_y), (amax_x, amax_y) = get_arc_extents(
+                    (last_x, last_y), (pos['X'], pos['Y']),
+                    (last_x + offset_i, last_y + offset_j), cmd == 'G2')
+            else:
+                amin_x, amax_x = sorted([last_x, pos['X']])
+                amin_y, amax_y = sorted([last_y, pos['Y']])
+            min_x = min(min_x, amin_x)
+            max_x = max(max_x, amax_x)
+            min_y = min(min_y, amin_y)
+            max_y = max(max_y, amax_y)
+        elif cmd == 'G90':
+            absolute_coord = True
+        elif cmd == 'G91':
+            absolute_coord = False
+        elif cmd == 'M82':
+            absolute_extrude = True
+        elif cmd == 'M83':
+            absolute_extrude = False
+    f.close()
+    if min_x > max_x:
+        return None
+    return (min_x, min_y), (max_x, max_y)
+
 # PEP 485 isclose()
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
@@ -57,6 +137,8 @@ class BedMesh:
     FADE_DISABLE = 0x7FFFFFFF
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.printer.register_event_handler("klippy:connect",
+                                            self.handle_connect)
         self.printer.register_event_handler("klippy:ready",
                                             self.handle_ready)
         self.last_position = [0., 0., 0., 0.]
@@ -74,6 +156,11 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        # Optionally apply the mesh during step generation
+        self.kinematic_transform = config.getboolean(
+            'kinematic_transform', False)
+        self.stepper_kinematics = []
+        self.orig_stepper_kinematics = []
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -90,10 +177,47 @@ class BedMesh:
         # Register transform
         gcode_move = self.printer.load_object(config, 'gcode_move')
         gcode_move.set_move_transform(self)
+    def handle_connect(self):
+        if not self.kinematic_transform:
+            return
+        # Wrap the stepper kinematics of all z steppers
+        toolhead = self.printer.lookup_object('toolhead')
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for s in toolhead.get_kinematics().get_steppers():
+            if not s.is_active_axis('z'):
+                continue
+            sk = ffi_main.gc(ffi_lib.bed_mesh_alloc(), ffi_lib.bed_mesh_free)
+            orig_sk = s.set_stepper_kinematics(sk)
+            res = ffi_lib.bed_mesh_set_sk(sk, orig_sk)
+            if res < 0:
+                s.set_stepper_kinematics(orig_sk)
+                raise self.printer.config_error(
+                    "bed_mesh: kinematic_transform is not supported on"
+                    " stepper '%s'" % (s.get_name(),))
+            self.stepper_kinematics.append(sk)
+            self.orig_stepper_kinematics.append(orig_sk)
     def handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
+    def _update_stepper_kinematics(self):
+        if not self.stepper_kinematics:
+            return
+        self.toolhead.flush_step_generation()
+        ffi_main, ffi_lib = chelper.get_ffi()
+        mesh = self.z_mesh
+        for sk in self.stepper_kinematics:
+            if mesh is None or mesh.mesh_matrix is None:
+                ffi_lib.bed_mesh_set_mesh(sk, ffi_main.NULL, 0, 0,
+                                          0., 0., 0., 0.)
+                continue
+            z_table = [z for line in mesh.mesh_matrix for z in line]
+            ffi_lib.bed_mesh_set_mesh(
+                sk, z_table, mesh.mesh_x_count, mesh.mesh_y_count,
+                mesh.mesh_x_min, mesh.mesh_y_min,
+                mesh.mesh_x_max, mesh.mesh_y_max)
+            ffi_lib.bed_mesh_set_fade(sk, self.fade_start, self.fade_end,
+                                      self.fade_target)
     def set_mesh(self, mesh):
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
@@ -108,16 +232,17 @@ class BedMesh:
                     err_target = self.fade_target
                     self.z_mesh = None
                     self.fade_target = 0.
+                    self._update_stepper_kinematics()
                     raise self.gcode.error(
                         "bed_mesh: ERROR, fade_target lies outside of mesh z "
                         "range\nmin: %.4f, max: %.4f, fade_target: %.4f"
                         % (min_z, max_z, err_target))
-            if self.fade_target:
-                mesh.offset_mesh(self.fade_target)
+            mesh.offset_mesh(self.fade_target)
             min_z, max_z = mesh.get_z_range()
             if self.fade_dist <= max(abs(min_z), abs(max_z)):
                 self.z_mesh = None
                 self.fade_target = 0.
+                self._update_stepper_kinematics()
                 raise self.gcode.error(
                     "bed_mesh:  Mesh extends outside of the fade range, "
                     "please see the fade_start and fade_end options in"
@@ -127,6 +252,7 @@ class BedMesh:
             self.fade_target = 0.
         self.z_mesh = mesh
         self.splitter.initialize(mesh)
+        self._update_stepper_kinematics()
         # cache the current position before a transform takes place
         gcode_move = self.printer.lookup_object('gcode_move')
         gcode_move.reset_last_position()
@@ -162,7 +288,11 @@ class BedMesh:
             final_z_adj = factor * z_adj + self.fade_target
             self.last_position[:] = [x, y, z - final_z_adj, e]
         return list(self.last_position)
-    def move(self, newpos, speed):
+    def can_move_arc(self):
+        # Arcs only need their end points adjusted when the mesh is
+        # applied during step generation
+        return bool(self.stepper_kinematics)
+    def move(self, newpos, speed, arc=None):
         factor = self.get_z_factor(newpos[2])
         if self.z_mesh is None or not factor:
             # No mesh calibrated, or mesh leveling phased out.
@@ -172,7 +302,14 @@ class BedMesh:
                 logging.info(
                     "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
                     % (z, self.fade_target))
-            self.toolhead.move([x, y, z + self.fade_target, e], speed)
+            self.toolhead.move([x, y, z + self.fade_target, e], speed, arc)
+        elif self.stepper_kinematics:
+            # Only adjust the end position - the z steppers follow the
+            # mesh between the end points during step generation
+            x, y, z, e = newpos
+            z_adj = factor * self.z_mesh.calc_z(x, y) + self.z_mesh.mesh_offset
+            self.toolhead.move([x, y, z + z_adj, e], speed, arc,
+                               is_transformed=True)
         else:
             self.splitter.build_move(self.last_position, newpos, factor)
             while not self.splitter.traverse_complete:
@@ -183,7 +320,7 @@ class BedMesh:
                     raise self.gcode.error(
                         "Mesh Leveling: Error splitting move ")
         self.last_position[:] = newpos
-    def get_status(self, eventtime=None):
+    def get_status(self, eventtime=None, fields=None):
         status = {
             "profile_name": "",
             "mesh_min": (0., 0.),
@@ -191,17 +328,21 @@ class BedMesh:
             "probed_matrix": [[]],
             "mesh_matrix": [[]]
         }
+        if fields is not None:
+            status = {k: v for k, v in status.items() if k in fields}
         if self.z_mesh is not None:
+            # Only build the (potentially large) matrices when requested
             params = self.z_mesh.get_mesh_params()
-            mesh_min = (params['min_x'], params['min_y'])
-            mesh_max = (params['max_x'], params['max_y'])
-            probed_matrix = self.z_mesh.get_probed_matrix()
-            mesh_matrix = self.z_mesh.get_mesh_matrix()
-            status['profile_name'] = self.pmgr.get_current_profile()
-            status['mesh_min'] = mesh_min
-            status['mesh_max'] = mesh_max
-            status['probed_matrix'] = probed_matrix
-            status['mesh_matrix'] = mesh_matrix
+            if 'profile_name' in status:
+                status['profile_name'] = self.pmgr.get_current_profile()
+            if 'mesh_min' in status:
+                status['mesh_min'] = (params['min_x'], params['min_y'])
+            if 'mesh_max' in status:
+                status['mesh_max'] = (params['max_x'], params['max_y'])
+            if 'probed_matrix' in status:
+                status['probed_matrix'] = self.z_mesh.get_probed_matrix()
+            if 'mesh_matrix' in status:
+                status['mesh_matrix'] = self.z_mesh.get_mesh_matrix()
         return status
     def get_mesh(self):
         return self.z_mesh
@@ -244,12 +385,27 @@ class BedMeshCalibrate:
         self.bedmesh = bedmesh
         self.mesh_config = collections.OrderedDict()
         self._init_mesh_config(config)
+        self.adaptive_threshold = config.getfloat(
+            'adaptive_threshold', None, above=0.)
+        if self.adaptive_threshold is not None and self.radius is not None:
+            raise config.error(
+                "bed_mesh: adaptive_threshold is not supported on round beds")
+        self.orig_config['adaptive_threshold'] = self.adaptive_threshold
+        self.adaptive_max_points = config.getint(
+            'adaptive_max_points', None, minval=4)
         self._generate_points(config.error)
         self.orig_points = self.points
+        self.orig_point_indices = self.point_indices
         self.probe_helper = probe.ProbePointsHelper(
             config, self.probe_finalize, self.points)
         self.probe_helper.minimum_points(3)
         self.probe_helper.use_xy_offsets(True)
+        self.probe_helper.use_result_callback(self.probe_result)
+        # Probing state
+        self.probed_grid = [[]]
+        self.probe_indices = []
+        self.results_processed = 0
+        self.refined_cells = set()
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command(
             'BED_MESH_CALIBRATE', self.cmd_BED_MESH_CALIBRATE,
@@ -278,25 +434,32 @@ class BedMeshCalibrate:
             max_x = min_x + x_dist * (x_cnt - 1)
         pos_y = min_y
         points = []
+        indices = []
         for i in range(y_cnt):
             for j in range(x_cnt):
                 if not i % 2:
                     # move in positive directon
                     pos_x = min_x + j * x_dist
+                    x_idx = j
                 else:
                     # move in negative direction
                     pos_x = max_x - j * x_dist
+                    x_idx = x_cnt - 1 - j
                 if self.radius is None:
                     # rectangular bed, append
                     points.append((pos_x, pos_y))
+                    indices.append((x_idx, i))
                 else:
                     # round bed, check distance from origin
                     dist_from_origin = math.sqrt(pos_x*pos_x + pos_y*pos_y)
                     if dist_from_origin <= self.radius:
                         points.append(
                             (self.origin[0] + pos_x, self.origin[1] + pos_y))
+                        indices.append((x_idx, i))
             pos_y += y_dist
         self.points = points
+        # The (x, y) mesh index of each point
+        self.point_indices = indices
     def print_generated_points(self, print_func):
         x_offset = y_offset = 0.
         probe = self.printer.lookup_object('probe', None)
@@ -394,6 +557,7 @@ class BedMeshCalibrate:
         self.radius = self.orig_config['radius']
         self.origin = self.orig_config['origin']
         self.relative_reference_index = self.orig_config['rri']
+        self.adaptive_threshold = self.orig_config['adaptive_threshold']
         self.mesh_min = self.orig_config['mesh_min']
         self.mesh_max = self.orig_config['mesh_max']
         for key in list(self.mesh_config.keys()):
@@ -401,6 +565,7 @@ class BedMeshCalibrate:
 
         params = gcmd.get_command_parameters()
         need_cfg_update = False
+        ref_pos = None
         if 'RELATIVE_REFERENCE_INDEX' in params:
             self.relative_reference_index = gcmd.get_int(
                 'RELATIVE_REFERENCE_INDEX')
@@ -433,6 +598,20 @@ class BedMeshCalibrate:
                 self.mesh_config['x_count'] = x_cnt
                 self.mesh_config['y_count'] = y_cnt
                 need_cfg_update = True
+            if "ADAPTIVE_THRESHOLD" in params:
+                threshold = gcmd.get_float('ADAPTIVE_THRESHOLD', minval=0.)
+                self.adaptive_threshold = threshold or None
+            area = None
+            if "AREA_MIN" in params or "AREA_MAX" in params:
+                area = (
+                    parse_pair(gcmd, ('AREA_MIN', "%f,%f" % self.mesh_min)),
+                    parse_pair(gcmd, ('AREA_MAX', "%f,%f" % self.mesh_max)))
+            elif gcmd.get_int('PRINT_AREA', 0, minval=0, maxval=1):
+                area = self._get_print_area(gcmd)
+            if area is not None:
+                ref_pos = self._get_reference_pos(gcmd)
+                self._set_mesh_area(area, gcmd)
+                need_cfg_update = True
 
         if "ALGORITHM" in params:
             self.mesh_config['algo'] = gcmd.get('ALGORITHM').strip().lower()
@@ -441,6 +620,13 @@ class BedMeshCalibrate:
         if need_cfg_update:
             self._verify_algorithm(gcmd.error)
             self._generate_points(gcmd.error)
+            if ref_pos is not None:
+                self._set_reference_pos(ref_pos, gcmd)
+            rri = self.relative_reference_index
+            if rri is not None and not 0 <= rri < len(self.points):
+                raise gcmd.error(
+                    "bed_mesh: relative_reference_index %d is out of range"
+                    % (rri,))
             gcmd.respond_info("Generating new points...")
             self.print_generated_points(gcmd.respond_info)
             self.probe_helper.update_probe_points(self.points, 3)
@@ -451,13 +637,218 @@ class BedMeshCalibrate:
             logging.info("Updated Mesh Configuration:\n" + msg)
         else:
             self.points = self.orig_points
+            self.point_indices = self.orig_point_indices
             self.probe_helper.update_probe_points(self.points, 3)
 
+    def _get_print_area(self, gcmd):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        filename = None
+        if sdcard is not None:
+            filename = sdcard.get_file_path()
+        if filename is None:
+            raise gcmd.error("bed_mesh: PRINT_AREA requires a loaded"
+                             " virtual_sdcard file")
+        area = mathutil.background_process_exec(
+            self.printer, get_print_area, (filename,))
+        if area is None:
+            raise gcmd.error("bed_mesh: unable to find the print area of %s"
+                             % (filename,))
+        return area
+    def _get_reference_pos(self, gcmd):
+        # Find the location of the relative_reference_index point in
+        # the full (not area limited) mesh
+        rri = self.relative_reference_index
+        if rri is None:
+            return None
+        self._generate_points(gcmd.error)
+        if not 0 <= rri < len(self.points):
+            raise gcmd.error(
+                "bed_mesh: relative_reference_index %d is out of range"
+                % (rri,))
+        return self.points[rri]
+    def _set_reference_pos(self, ref_pos, gcmd):
+        # Use the nearest point of the area limited mesh as reference
+        ref_x, ref_y = ref_pos
+        rri = min(range(len(self.points)),
+                  key=lambda i: ((self.points[i][0] - ref_x)**2
+                                 + (self.points[i][1] - ref_y)**2))
+        x, y = self.points[rri]
+        if abs(x - ref_x) > .01 or abs(y - ref_y) > .01:
+            gcmd.respond_info(
+                "bed_mesh: reference point (%.2f, %.2f) is outside the"
+                " probing area, using the nearest point (%.2f, %.2f)"
+                % (ref_x, ref_y, x, y))
+        self.relative_reference_index = rri
+    def _set_mesh_area(self, area, gcmd):
+        # Only probe the given area, at the configured probe density
+        area_min, area_max = area
+        mesh_min = []
+        mesh_max = []
+        counts = []
+        for axis, cnt_key in enumerate(['x_count', 'y_count']):
+            if area_max[axis] < area_min[axis]:
+                raise gcmd.error("bed_mesh: invalid area min/max points")
+            min_pos = self.mesh_min[axis]
+            max_pos = self.mesh_max[axis]
+            count = self.mesh_config[cnt_key]
+            dist = (max_pos - min_pos) / (count - 1)
+            amin = constrain(area_min[axis], min_pos, max_pos)
+            amax = constrain(area_max[axis], min_pos, max_pos)
+            count = constrain(int(math.ceil((amax - amin) / dist - .001)) + 1,
+                              3, count)
+            span = dist * (count - 1)
+            start = constrain(.5 * (amin + amax - span),
+                              min_pos, max_pos - span)
+            mesh_min.append(start)
+            mesh_max.append(start + span)
+            counts.append(count)
+        self.mesh_min = tuple(mesh_min)
+        self.mesh_max = tuple(mesh_max)
+        self.mesh_config['x_count'], self.mesh_config['y_count'] = counts
+        gcmd.respond_info("bed_mesh: probing area (%.1f, %.1f) - (%.1f, %.1f)"
+                          % (mesh_min[0], mesh_min[1],
+                             mesh_max[0], mesh_max[1]))
+    def _get_coarse_indices(self, count):
+        # Every other mesh index (always including the last one)
+        indices = list(range(0, count, 2))
+        if indices[-1] != count - 1:
+            indices.append(count - 1)
+        return indices
+    def _start_probing(self):
+        x_cnt = self.mesh_config['x_count']
+        y_cnt = self.mesh_config['y_count']
+        self.probed_grid = [[None] * x_cnt for i in range(y_cnt)]
+        self.probe_indices = list(self.point_indices)
+        self.results_processed = 0
+        self.refined_cells = set()
+        if self.adaptive_threshold is None:
+            return
+        # Probe a coarse grid first, the remaining points are only
+        # probed in areas where the coarse grid is not sufficient
+        self.point_map = dict(zip(self.point_indices, self.points))
+        x_coarse = self._get_coarse_indices(x_cnt)
+        y_coarse = self._get_coarse_indices(y_cnt)
+        indices = []
+        for i, y_idx in enumerate(y_coarse):
+            row = x_coarse if not i % 2 else reversed(x_coarse)
+            indices.extend([(x_idx, y_idx) for x_idx in row])
+        rri = self.relative_reference_index
+        if rri is not None and self.point_indices[rri] not in indices:
+            indices.append(self.point_indices[rri])
+        self.probe_indices = indices
+        self.probe_helper.update_probe_points(
+            [self.point_map[idx] for idx in indices], 3)
+    def _calc_coarse_z(self, x_coarse, y_coarse, cx, cy, x_idx, y_idx):
+        # Bilinear estimate of a point from the corners of a coarse cell
+        grid = self.probed_grid
+        x0, x1 = x_coarse[cx], x_coarse[cx + 1]
+        y0, y1 = y_coarse[cy], y_coarse[cy + 1]
+        tx = float(x_idx - x0) / (x1 - x0)
+        ty = float(y_idx - y0) / (y1 - y0)
+        return lerp(ty, lerp(tx, grid[y0][x0], grid[y0][x1]),
+                    lerp(tx, grid[y1][x0], grid[y1][x1]))
+    def _calc_cell_score(self, x_coarse, y_coarse, cx, cy):
+        # Estimate the error of interpolating within a coarse cell
+        grid = self.probed_grid
+        score = 0.
+        # Curvature of the coarse grid at the cell corners
+        for i, j in [(cx, cy), (cx + 1, cy), (cx, cy + 1), (cx + 1, cy + 1)]:
+            y_idx = y_coarse[j]
+            x_idx = x_coarse[i]
+            z = grid[y_idx][x_idx]
+            if 0 < i < len(x_coarse) - 1:
+                x0, x1 = x_coarse[i - 1], x_coarse[i + 1]
+                t = float(x_idx - x0) / (x1 - x0)
+                line_z = lerp(t, grid[y_idx][x0], grid[y_idx][x1])
+                score = max(score, abs(z - line_z) * .25)
+            if 0 < j < len(y_coarse) - 1:
+                y0, y1 = y_coarse[j - 1], y_coarse[j + 1]
+                t = float(y_idx - y0) / (y1 - y0)
+                line_z = lerp(t, grid[y0][x_idx], grid[y1][x_idx])
+                score = max(score, abs(z - line_z) * .25)
+        # Residual of any points already probed within the cell
+        for y_idx in range(y_coarse[cy], y_coarse[cy + 1] + 1):
+            for x_idx in range(x_coarse[cx], x_coarse[cx + 1] + 1):
+                z = grid[y_idx][x_idx]
+                if z is not None:
+                    est_z = self._calc_coarse_z(
+                        x_coarse, y_coarse, cx, cy, x_idx, y_idx)
+                    score = max(score, abs(z - est_z))
+        return score
+    def _get_refine_points(self):
+        x_cnt = self.mesh_config['x_count']
+        y_cnt = self.mesh_config['y_count']
+        max_points = self.adaptive_max_points or x_cnt * y_cnt
+        budget = max_points - len(self.probe_indices)
+        if budget <= 0:
+            return []
+        grid = self.probed_grid
+        x_coarse = self._get_coarse_indices(x_cnt)
+        y_coarse = self._get_coarse_indices(y_cnt)
+        cells = []
+        for cy in range(len(y_coarse) - 1):
+            for cx in range(len(x_coarse) - 1):
+                if (cx, cy) in self.refined_cells:
+                    continue
+                score = self._calc_cell_score(x_coarse, y_coarse, cx, cy)
+                if score > self.adaptive_threshold:
+                    cells.append((score, cx, cy))
+        # Refine the cells with the largest expected error first
+        cells.sort(reverse=True)
+        indices = []
+        for score, cx, cy in cells:
+            cell_indices = [
+                (x_idx, y_idx)
+                for y_idx in range(y_coarse[cy], y_coarse[cy + 1] + 1)
+                for x_idx in range(x_coarse[cx], x_coarse[cx + 1] + 1)
+                if grid[y_idx][x_idx] is None
+                and (x_idx, y_idx) not in indices]
+            if len(indices) + len(cell_indices) > budget:
+                continue
+            self.refined_cells.add((cx, cy))
+            indices.extend(cell_indices)
+        # Visit the new points in nearest neighbor order
+        point_map = self.point_map
+        last_x, last_y = point_map[self.probe_indices[-1]]
+        ordered = []
+        while indices:
+            idx = min(indices, key=lambda i: (point_map[i][0] - last_x)**2
+                      + (point_map[i][1] - last_y)**2)
+            indices.remove(idx)
+            ordered.append(idx)
+            last_x, last_y = point_map[idx]
+        self.probe_indices.extend(ordered)
+        return [point_map[idx] for idx in ordered]
+    def _fill_unprobed_points(self):
+        grid = self.probed_grid
+        x_coarse = self._get_coarse_indices(len(grid[0]))
+        y_coarse = self._get_coarse_indices(len(grid))
+        for y_idx, row in enumerate(grid):
+            cy = min(bisect.bisect_right(y_coarse, y_idx) - 1,
+                     len(y_coarse) - 2)
+            for x_idx, z in enumerate(row):
+                if z is not None:
+                    continue
+                cx = min(bisect.bisect_right(x_coarse, x_idx) - 1,
+                         len(x_coarse) - 2)
+                row[x_idx] = self._calc_coarse_z(
+                    x_coarse, y_coarse, cx, cy, x_idx, y_idx)
     cmd_BED_MESH_CALIBRATE_help = "Perform Mesh Bed Leveling"
     def cmd_BED_MESH_CALIBRATE(self, gcmd):
         self.bedmesh.set_mesh(None)
         self.update_config(gcmd)
+        self._start_probing()
         self.probe_helper.start_probe(gcmd)
+    def probe_result(self, offsets, results):
+        # Store each result in the mesh as it arrives
+        for pos in results[self.results_processed:]:
+            x_idx, y_idx = self.probe_indices[self.results_processed]
+            self.probed_grid[y_idx][x_idx] = pos[2]
+            self.results_processed += 1
+        if (self.adaptive_threshold is None
+                or self.results_processed < len(self.probe_indices)):
+            return None
+        return self._get_refine_points()
     def probe_finalize(self, offsets, positions):
         x_offset, y_offset, z_offset = offsets
         positions = [(round(p[0], 2), round(p[1], 2), p[2])
@@ -473,32 +864,17 @@ class BedMeshCalibrate:
         if self.relative_reference_index is not None:
             # zero out probe z offset and
             # set offset relative to reference index
-            z_offset = positions[self.relative_reference_index][2]
+            x_idx, y_idx = self.point_indices[self.relative_reference_index]
+            z_offset = self.probed_grid[y_idx][x_idx]
 
-        probed_matrix = []
-        row = []
-        prev_pos = positions[0]
-        for pos in positions:
-            if not isclose(pos[1], prev_pos[1], abs_tol=.1):
-                # y has changed, append row and start new
-                probed_matrix.append(row)
-                row = []
-            if pos[0] > prev_pos[0]:
-                # probed in the positive direction
-                row.append(pos[2] - z_offset)
-            else:
-                # probed in the negative direction
-                row.insert(0, pos[2] - z_offset)
-            prev_pos = pos
-        # append last row
-        probed_matrix.append(row)
+        if self.adaptive_threshold is not None:
+            self.gcode.respond_info(
+                "bed_mesh: adaptive probing sampled %d of %d points"
+                % (len(positions), x_cnt * y_cnt))
+            self._fill_unprobed_points()
 
-        # make sure the y-axis is the correct length
-        if len(probed_matrix) != y_cnt:
-            raise self.gcode.error(
-                ("bed_mesh: Invalid y-axis table length\n"
-                 "Probed table length: %d Probed Table:\n%s") %
-                (len(probed_matrix), str(probed_matrix)))
+        probed_matrix = [[z - z_offset for z in row if z is not None]
+                         for row in self.probed_grid]
 
         if self.radius is not None:
             # round bed, extrapolate probed values to create a square mesh
@@ -549,57 +925,124 @@ class MoveSplitter:
     def build_move(self, prev_pos, next_pos, factor):
         self.prev_pos = tuple(prev_pos)
         self.next_pos = tuple(next_pos)
-        self.current_pos = list(prev_pos)
         self.z_factor = factor
-        self.z_offset = self._calc_z_offset(prev_pos)
-        self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        if self.axis_move[0] or self.axis_move[1]:
+            self.splits = self._find_splits()
+        else:
+            self.splits = [(1., self._calc_z_offset(self.next_pos))]
+        self.split_index = 0
+        self.traverse_complete = False
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         return self.z_factor * z + self.z_mesh.mesh_offset
-    def _set_next_move(self, distance_from_prev):
-        t = distance_from_prev / self.total_move_length
-        if t > 1. or t < 0.:
-            raise self.gcode.error(
-                "bed_mesh: Slice distance is negative "
-                "or greater than entire move length")
-        for i in range(4):
-            if self.axis_move[i]:
-                self.current_pos[i] = lerp(
-                    t, self.prev_pos[i], self.next_pos[i])
+    def _get_move_pos(self, t):
+        return [lerp(t, self.prev_pos[i], self.next_pos[i])
+                if self.axis_move[i] else self.prev_pos[i] for i in range(4)]
+    def _find_grid_crossings(self):
+        # Return the locations (as a fraction of the move) where the
+        # xy line crosses a mesh grid line.  The mesh is bilinear
+        # within each grid cell, so these are the points where the
+        # slope of the mesh along the move may change.
+        mesh = self.z_mesh
+        crossings = []
+        for axis, mesh_min, mesh_dist, mesh_cnt in [
+                (0, mesh.mesh_x_min, mesh.mesh_x_dist, mesh.mesh_x_count),
+                (1, mesh.mesh_y_min, mesh.mesh_y_dist, mesh.mesh_y_count)]:
+            if not self.axis_move[axis]:
+                continue
+            start = self.prev_pos[axis]
+            delta = self.next_pos[axis] - start
+            pos1 = (start - mesh_min) / mesh_dist
+            pos2 = (self.next_pos[axis] - mesh_min) / mesh_dist
+            first_idx = max(int(math.floor(min(pos1, pos2))) + 1, 0)
+            last_idx = min(int(math.ceil(max(pos1, pos2))) - 1, mesh_cnt - 1)
+            for idx in range(first_idx, last_idx + 1):
+                crossings.append((mesh_min + idx * mesh_dist - start) / delta)
+        crossings.sort()
+        return crossings
+    def _find_splits(self):
+        # Evaluate the z adjustment at each grid crossing (and at the
+        # middle of each cell traversed) and pick the fewest split
+        # points such that the straight line between two splits stays
+        # within split_delta_z of the mesh.
+        samples = [(0., self._calc_z_offset(self.prev_pos), True)]
+        last_t = 0.
+        min_t = self.move_check_distance / self.total_move_length
+        last_split_t = 0.
+        crossings = [t for t in self._find_grid_crossings()
+                     if t < 1. - 1e-9]
+        for t in crossings + [1.]:
+            if t - last_t < 1e-9:
+                continue
+            mid_t = .5 * (last_t + t)
+            samples.append((mid_t, self._calc_z_offset(
+                self._get_move_pos(mid_t)), False))
+            if t >= 1.:
+                z = self._calc_z_offset(self.next_pos)
+            else:
+                z = self._calc_z_offset(self._get_move_pos(t))
+            # Sub-moves shorter than move_check_distance are not created
+            is_candidate = t >= 1. or t - last_split_t >= min_t
+            if is_candidate:
+                last_split_t = t
+            samples.append((t, z, is_candidate))
+            last_t = t
+        splits = []
+        split_delta_z = self.split_delta_z
+        start_idx = 0
+        last_ok = None
+        idx = 1
+        while idx < len(samples):
+            end_t, end_z, is_candidate = samples[idx]
+            if not is_candidate:
+                idx += 1
+                continue
+            start_t, start_z, _ = samples[start_idx]
+            scale = 1. / (end_t - start_t)
+            for t, z, _ in samples[start_idx+1:idx]:
+                line_z = lerp((t - start_t) * scale, start_z, end_z)
+                if abs(z - line_z) > split_delta_z:
+                    break
+            else:
+                last_ok = idx
+                idx += 1
+                continue
+            if last_ok is None:
+                # Deviation is within a single grid cell
+                last_ok = idx
+                idx += 1
+                if idx >= len(samples):
+                    break
+            splits.append(samples[last_ok][:2])
+            start_idx = last_ok
+            last_ok = None
+        splits.append(samples[-1][:2])
+        return splits
     def split(self):
-        if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
-            # end of move reached
-            self.current_pos[:] = self.next_pos
-            self.z_offset = self._calc_z_offset(self.current_pos)
-            # Its okay to add Z-Offset to the final move, since it will not be
-            # used again.
-            self.current_pos[2] += self.z_offset
+        if self.traverse_complete:
+            return None
+        t, z_offset = self.splits[self.split_index]
+        self.split_index += 1
+        if self.split_index >= len(self.splits):
             self.traverse_complete = True
-            return self.current_pos
+            pos = list(self.next_pos)
         else:
-            # Traverse complete
-            return None
-
+            pos = self._get_move_pos(t)
+        pos[2] += z_offset
+        return pos
 
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_coeffs = None
+        try:
+            self.numpy = importlib.import_module('numpy')
+        except ImportError:
+            # Fall back to the (slower) pure python interpolation
+            self.numpy = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
@@ -680,6 +1123,7 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        self._build_coeffs()
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
@@ -688,26 +1132,30 @@ class ZMesh:
         self.avg_z = round(self.avg_z, 2)
         self.print_mesh(logging.debug)
     def offset_mesh(self, offset):
-        if self.mesh_matrix:
+        if self.mesh_matrix and offset != self.mesh_offset:
+            delta = offset - self.mesh_offset
             self.mesh_offset = offset
             for y_line in self.mesh_matrix:
                 for idx, z in enumerate(y_line):
-                    y_line[idx] = z - self.mesh_offset
+                    y_line[idx] = z - delta
+            self._build_coeffs()
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x, 0)
-            ty, yidx = self._get_linear_index(y, 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        if self.mesh_coeffs is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        xpos = (x - self.mesh_x_min) / self.mesh_x_dist
+        xidx = constrain(int(math.floor(xpos)), 0, self.mesh_x_count - 2)
+        tx = constrain(xpos - xidx, 0., 1.)
+        ypos = (y - self.mesh_y_min) / self.mesh_y_dist
+        yidx = constrain(int(math.floor(ypos)), 0, self.mesh_y_count - 2)
+        ty = constrain(ypos - yidx, 0., 1.)
+        z0, zx, zy, zxy = self.mesh_coeffs[
+            yidx * (self.mesh_x_count - 1) + xidx]
+        return z0 + tx * (zx + ty * zxy) + ty * zy
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -715,177 +1163,189 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
+    def _build_coeffs(self):
+        # Store the bilinear coefficients of each mesh cell so that
+        # calc_z() only needs a single table lookup
+        self.mesh_coeffs = coeffs = []
+        tbl = self.mesh_matrix
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx + 1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00 = row0[xidx]
+                z10 = row0[xidx + 1]
+                z01 = row1[xidx]
+                z11 = row1[xidx + 1]
+                coeffs.append((z00, z10 - z00, z01 - z00,
+                               z11 - z10 - z01 + z00))
+    def _interpolate(self, z_matrix, x_weights, y_weights):
+        # Interpolation is separable - each probed row is interpolated
+        # along X and the resulting columns are then interpolated
+        # along Y.  Weights are lists of (probe_index, weight) pairs.
+        np = self.numpy
+        if np is not None:
+            xw = np.zeros((len(x_weights), len(z_matrix[0])))
+            for i, weights in enumerate(x_weights):
+                for pidx, w in weights:
+                    xw[i, pidx] = w
+            yw = np.zeros((len(y_weights), len(z_matrix)))
+            for i, weights in enumerate(y_weights):
+                for pidx, w in weights:
+                    yw[i, pidx] = w
+            return np.dot(np.dot(yw, np.array(z_matrix)), xw.T).tolist()
+        rows = [[sum([line[pidx] * w for pidx, w in weights])
+                 for weights in x_weights]
+                for line in z_matrix]
+        x_range = range(len(x_weights))
+        matrix = []
+        for weights in y_weights:
+            if len(weights) == 1:
+                matrix.append(list(rows[weights[0][0]]))
+                continue
+            pts = [(rows[pidx], w) for pidx, w in weights]
+            matrix.append([sum([r[x] * w for r, w in pts]) for x in x_range])
+        return matrix
     def _sample_direct(self, z_matrix):
-        self.mesh_matrix = z_matrix
+        self.mesh_matrix = [list(line) for line in z_matrix]
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
+        x_weights = self._get_lagrange_weights(
+            self.mesh_params['x_count'], self.x_mult, self.get_x_coordinate)
+        y_weights = self._get_lagrange_weights(
+            self.mesh_params['y_count'], self.y_mult, self.get_y_coordinate)
+        self.mesh_matrix = self._interpolate(z_matrix, x_weights, y_weights)
+    def _get_lagrange_weights(self, pt_cnt, mult, cfunc):
+        lpts = [cfunc(i * mult) for i in range(pt_cnt)]
+        all_weights = []
+        for idx in range((pt_cnt - 1) * mult + 1):
+            if idx % mult == 0:
+                all_weights.append([(idx // mult, 1.)])
                 continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
-    def _get_lagrange_coords(self):
-        xpts = []
-        ypts = []
-        for i in range(self.mesh_params['x_count']):
-            xpts.append(self.get_x_coordinate(i * self.x_mult))
-        for j in range(self.mesh_params['y_count']):
-            ypts.append(self.get_y_coordinate(j * self.y_mult))
-        return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
-        pt_cnt = len(lpts)
-        total = 0.
-        for i in range(pt_cnt):
-            n = 1.
-            d = 1.
-            for j in range(pt_cnt):
-                if j == i:
-                    continue
-                n *= (c - lpts[j])
-                d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+            c = cfunc(idx)
+            weights = []
+            for i in range(pt_cnt):
+                n = 1.
+                d = 1.
+                for j in range(pt_cnt):
+                    if j == i:
+                        continue
+                    n *= (c - lpts[j])
+                    d *= (lpts[i] - lpts[j])
+                weights.append((i, n / d))
+            all_weights.append(weights)
+        return all_weights
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
+        tension = self.mesh_params['tension']
+        x_weights = self._get_bicubic_weights(
+            self.mesh_params['x_count'], self.x_mult, tension)
+        y_weights = self._get_bicubic_weights(
+            self.mesh_params['y_count'], self.y_mult, tension)
+        self.mesh_matrix = self._interpolate(z_matrix, x_weights, y_weights)
+    def _get_bicubic_weights(self, pt_cnt, mult, tension):
+        # Cardinal spline between control points p1 and p2:
+        #   p1*h00 + p2*h01 + tension*((p2-p0)*h10 + (p3-p1)*h11)
+        # The end points are repeated at the edges of the mesh.
+        last_pt = pt_cnt - 1
+        all_weights = []
+        for idx in range(last_pt * mult + 1):
+            seg, rem = divmod(idx, mult)
+            if not rem:
+                all_weights.append([(seg, 1.)])
                 continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
-        t2 = t*t
-        t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
+            t = rem / float(mult)
+            t2 = t*t
+            t3 = t2*t
+            h00 = 2*t3 - 3*t2 + 1
+            h01 = -2*t3 + 3*t2
+            h10 = tension * (t3 - 2*t2 + t)
+            h11 = tension * (t3 - t2)
+            pts = [max(seg - 1, 0), seg, seg + 1, min(seg + 2, last_pt)]
+            factors = [-h10, h00 - h11, h01 + h10, h11]
+            weights = collections.OrderedDict()
+            for pidx, w in zip(pts, factors):
+                weights[pidx] = weights.get(pidx, 0.) + w
+            all_weights.append(list(weights.items()))
+        return all_weights
 
+class ProfileStore:
+    # Binary profile storage.  The file starts with a header and an
+    # index of (name, offset, length) entries, followed by one record
+    # per profile containing the mesh parameters (as json) and the
+    # probed points (as doubles).
+    MAGIC = b"KBMP"
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = collections.OrderedDict()
+    def load_index(self):
+        self.index.clear()
+        if not os.path.exists(self.filename):
+            return []
+        f = open(self.filename, 'rb')
+        try:
+            magic, version, count = struct.unpack('<4sII', f.read(12))
+            if magic != self.MAGIC:
+                raise BedMeshError("bed_mesh: invalid profile store %s"
+                                   % (self.filename,))
+            if version != PROFILE_VERSION:
+                logging.info("bed_mesh: Profile store %s not compatible with"
+                             " this version of bed_mesh", self.filename)
+                return []
+            for i in range(count):
+                name_len, = struct.unpack('<H', f.read(2))
+                name = f.read(name_len).decode()
+                self.index[name] = struct.unpack('<II', f.read(8))
+        except struct.error:
+            raise BedMeshError("bed_mesh: corrupt profile store %s"
+                               % (self.filename,))
+        finally:
+            f.close()
+        return list(self.index.keys())
+    def read_record(self, name):
+        offset, length = self.index[name]
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(offset)
+            return f.read(length)
+        finally:
+            f.close()
+    def encode_record(self, points, mesh_params):
+        params = json.dumps(mesh_params).encode()
+        y_cnt = len(points)
+        x_cnt = len(points[0]) if y_cnt else 0
+        values = [z for line in points for z in line]
+        return (struct.pack('<HHI', x_cnt, y_cnt, len(params)) + params
+                + struct.pack('<%dd' % (len(values),), *values))
+    def decode_record(self, data):
+        x_cnt, y_cnt, params_len = struct.unpack_from('<HHI', data)
+        pos = struct.calcsize('<HHI')
+        mesh_params = json.loads(data[pos:pos+params_len].decode(),
+                                 object_pairs_hook=collections.OrderedDict)
+        for key, t in PROFILE_OPTIONS.items():
+            mesh_params[key] = t(mesh_params[key])
+        values = struct.unpack_from('<%dd' % (x_cnt * y_cnt,),
+                                    data, pos + params_len)
+        points = [list(values[i:i+x_cnt])
+                  for i in range(0, x_cnt * y_cnt, x_cnt)]
+        return points, mesh_params
+    def write(self, records):
+        # records is a list of (name, record_data) pairs
+        names = [name.encode() for name, data in records]
+        offset = 12 + sum([2 + len(name) + 8 for name in names])
+        header = [struct.pack('<4sII', self.MAGIC, PROFILE_VERSION,
+                              len(records))]
+        index = collections.OrderedDict()
+        for name, (prof_name, data) in zip(names, records):
+            header.append(struct.pack('<H', len(name)) + name
+                          + struct.pack('<II', offset, len(data)))
+            index[prof_name] = (offset, len(data))
+            offset += len(data)
+        # Write to a temporary file and atomically replace the store
+        temp_name = self.filename + ".tmp"
+        f = open(temp_name, 'wb')
+        f.write(b"".join(header + [data for name, data in records]))
+        f.close()
+        os.rename(temp_name, self.filename)
+        self.index = index
 
 class ProfileManager:
     def __init__(self, config, bedmesh):
@@ -896,6 +1356,9 @@ class ProfileManager:
         self.profiles = {}
         self.current_profile = ""
         self.incompatible_profiles = []
+        # Built meshes of recently loaded profiles
+        self.mesh_cache = collections.OrderedDict()
+        self.cache_size = config.getint('profile_cache_size', 4, minval=0)
         # Fetch stored profiles from Config
         stored_profs = config.get_prefix_sections(self.name)
         stored_profs = [s for s in stored_profs
@@ -910,11 +1373,9 @@ class ProfileManager:
                     % (name, version, PROFILE_VERSION))
                 self.incompatible_profiles.append(name)
                 continue
-            self.profiles[name] = {}
-            z_values = profile.get('points').split('\n')
-            self.profiles[name]['points'] = \
-                [[float(pt.strip()) for pt in line.split(',')]
-                    for line in z_values if line.strip()]
+            # The points are only parsed when the profile is loaded
+            self.profiles[name] = {'points_text': profile.get('points'),
+                                   'from_config': True}
             self.profiles[name]['mesh_params'] = params = \
                 collections.OrderedDict()
             for key, t in PROFILE_OPTIONS.items():
@@ -924,6 +1385,18 @@ class ProfileManager:
                     params[key] = profile.getfloat(key)
                 elif t is str:
                     params[key] = profile.get(key)
+        # Optional binary profile store (records are read on demand)
+        self.store = None
+        store_path = config.get('profile_path', None)
+        if store_path is not None:
+            self.store = ProfileStore(
+                os.path.normpath(os.path.expanduser(store_path)))
+            try:
+                names = self.store.load_index()
+            except (IOError, OSError, BedMeshError) as e:
+                raise config.error(str(e))
+            for name in names:
+                self.profiles[name] = {'in_store': True}
         # Register GCode
         self.gcode.register_command(
             'BED_MESH_PROFILE', self.cmd_BED_MESH_PROFILE,
@@ -945,6 +1418,36 @@ class ProfileManager:
                 "The SAVE_CONFIG command will update the printer config\n"
                 "file and restart the printer" %
                 (('\n').join(self.incompatible_profiles)))
+    def _get_profile_data(self, prof_name):
+        profile = self.profiles[prof_name]
+        if 'points' not in profile:
+            if profile.get('in_store'):
+                data = self.store.read_record(prof_name)
+                profile['points'], profile['mesh_params'] = \
+                    self.store.decode_record(data)
+            else:
+                z_values = profile.pop('points_text').split('\n')
+                profile['points'] = \
+                    [[float(pt.strip()) for pt in line.split(',')]
+                        for line in z_values if line.strip()]
+        return profile['points'], profile['mesh_params']
+    def _write_store(self):
+        records = []
+        for name in sorted(self.profiles.keys()):
+            profile = self.profiles[name]
+            if profile.get('from_config'):
+                continue
+            if 'points' in profile:
+                data = self.store.encode_record(
+                    profile['points'], profile['mesh_params'])
+            else:
+                data = self.store.read_record(name)
+            records.append((name, data))
+        try:
+            self.store.write(records)
+        except (IOError, OSError) as e:
+            raise self.gcode.error(
+                "bed_mesh: Unable to write profile store: %s" % (str(e),))
     def save_profile(self, prof_name):
         z_mesh = self.bedmesh.get_mesh()
         if z_mesh is None:
@@ -956,6 +1459,21 @@ class ProfileManager:
         mesh_params = z_mesh.get_mesh_params()
         configfile = self.printer.lookup_object('configfile')
         cfg_name = self.name + " " + prof_name
+        old_profile = self.profiles.get(prof_name, {})
+        # save copy in local storage
+        self.profiles[prof_name] = profile = {}
+        profile['points'] = probed_matrix
+        profile['mesh_params'] = collections.OrderedDict(mesh_params)
+        self.mesh_cache.pop(prof_name, None)
+        self.current_profile = prof_name
+        if self.store is not None:
+            if old_profile.get('from_config'):
+                configfile.remove_section(cfg_name)
+            profile['in_store'] = True
+            self._write_store()
+            self.gcode.respond_info(
+                "Bed Mesh state has been saved to profile [%s]" % (prof_name))
+            return
         # set params
         z_values = ""
         for line in probed_matrix:
@@ -967,35 +1485,42 @@ class ProfileManager:
         configfile.set(cfg_name, 'points', z_values)
         for key, value in mesh_params.items():
             configfile.set(cfg_name, key, value)
-        # save copy in local storage
-        self.profiles[prof_name] = profile = {}
-        profile['points'] = probed_matrix
-        profile['mesh_params'] = collections.OrderedDict(mesh_params)
-        self.current_profile = prof_name
+        profile['from_config'] = True
         self.gcode.respond_info(
             "Bed Mesh state has been saved to profile [%s]\n"
             "for the current session.  The SAVE_CONFIG command will\n"
             "update the printer config file and restart the printer."
             % (prof_name))
     def load_profile(self, prof_name):
-        profile = self.profiles.get(prof_name, None)
-        if profile is None:
+        if prof_name not in self.profiles:
             raise self.gcode.error(
                 "bed_mesh: Unknown profile [%s]" % prof_name)
-        probed_matrix = profile['points']
-        mesh_params = profile['mesh_params']
-        z_mesh = ZMesh(mesh_params)
-        try:
-            z_mesh.build_mesh(probed_matrix)
-        except BedMeshError as e:
-            raise self.gcode.error(str(e))
+        z_mesh = self.mesh_cache.pop(prof_name, None)
+        if z_mesh is None:
+            try:
+                probed_matrix, mesh_params = self._get_profile_data(prof_name)
+                z_mesh = ZMesh(mesh_params)
+                z_mesh.build_mesh(probed_matrix)
+            except (BedMeshError, IOError, OSError,
+                    ValueError, struct.error) as e:
+                raise self.gcode.error(str(e))
+        if self.cache_size:
+            self.mesh_cache[prof_name] = z_mesh
+            while len(self.mesh_cache) > self.cache_size:
+                self.mesh_cache.popitem(last=False)
         self.current_profile = prof_name
         self.bedmesh.set_mesh(z_mesh)
     def remove_profile(self, prof_name):
         if prof_name in self.profiles:
+            profile = self.profiles.pop(prof_name)
+            self.mesh_cache.pop(prof_name, None)
+            if not profile.get('from_config'):
+                self._write_store()
+                self.gcode.respond_info(
+                    "Profile [%s] removed from storage" % (prof_name))
+                return
             configfile = self.printer.lookup_object('configfile')
             configfile.remove_section('bed_mesh ' + prof_name)
-            del self.profiles[prof_name]
             self.gcode.respond_info(
                 "Profile [%s] removed from storage for this session.\n"
                 "The SAVE_CONFIG command will update the printer\n"
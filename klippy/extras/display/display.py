@@ -71,16 +71,43 @@ class DisplayGroup:
             if c.get('text'):
                 template = gcode_macro.load_template(c, 'text')
                 self.data_items.append((row, col, template))
-    def show(self, display, templates, eventtime):
+        self.gcode_macro = gcode_macro
+        self.status_refs = None
+    def _get_status_refs(self, templates):
+        # Printer objects that may be referenced during a screen update
+        if self.status_refs is None:
+            refs = [t.get_status_refs() for r, c, t in self.data_items]
+            refs.extend([dt.template.get_status_refs()
+                         for dt in templates.values()])
+            self.status_refs = self.gcode_macro.merge_status_refs(refs)
+        return self.status_refs
+    def render(self, output, display, templates, eventtime):
+        # Evaluate the templates and append (row, col, text, progress_bars)
+        # for each item to 'output' - unchanged items are normally
+        # returned from the template result cache
         context = self.data_items[0][2].create_template_context(eventtime)
-        context['draw_progress_bar'] = display.draw_progress_bar
+        context['printer'].prefetch(self._get_status_refs(templates))
+        progress_bars = []
+        def draw_progress_bar(row, col, width, value):
+            progress_bars.append((row, col, width, value))
+            return ""
+        context['draw_progress_bar'] = draw_progress_bar
         def render(name, **kwargs):
             return templates[name].render(context, **kwargs)
         context['render'] = render
-        for row, col, template in self.data_items:
-            text = template.render(context)
-            display.draw_text(row, col, text.replace('\n', ''), eventtime)
-        context.clear() # Remove circular references for better gc
+        try:
+            for row, col, template in self.data_items:
+                text = template.render(context)
+                output.append((row, col, text.replace('\n', ''),
+                               tuple(progress_bars)))
+                del progress_bars[:]
+        finally:
+            context.clear() # Remove circular references for better gc
+    def draw(self, display, output, eventtime):
+        for row, col, text, progress_bars in output:
+            for bar in progress_bars:
+                display.draw_progress_bar(*bar)
+            display.draw_text(row, col, text, eventtime)
 
 class PrinterLCD:
     def __init__(self, config):
@@ -112,6 +139,12 @@ class PrinterLCD:
             self.screen_update_event)
         self.redraw_request_pending = False
         self.redraw_time = 0.
+        self.shown_output = None
+        # Screen update statistics
+        self.stats_name = name.replace(" ", "_")
+        self.update_count = self.skip_count = 0
+        self.render_time = self.render_max = 0.
+        self.flush_time = self.flush_max = 0.
         # Register g-code commands
         gcode = self.printer.lookup_object("gcode")
         gcode.register_mux_command('SET_DISPLAY_GROUP', 'DISPLAY', name,
@@ -198,20 +231,54 @@ class PrinterLCD:
         if self.redraw_request_pending:
             self.redraw_request_pending = False
             self.redraw_time = eventtime + REDRAW_MIN_TIME
-        self.lcd_chip.clear()
+        render_start = self.reactor.monotonic()
         # update menu component
-        if self.menu is not None:
-            ret = self.menu.screen_update_event(eventtime)
-            if ret:
-                self.lcd_chip.flush()
+        if self.menu is not None and self.menu.is_running():
+            self.lcd_chip.clear()
+            self.menu.screen_update_event(eventtime)
+            self.shown_output = None
+        else:
+            # Update normal display
+            output = []
+            try:
+                self.show_data_group.render(output, self,
+                                            self.display_templates, eventtime)
+            except:
+                logging.exception("Error during display screen update")
+            if output == self.shown_output:
+                # Screen contents unchanged - no need to redraw
+                self.note_update_time(render_start, None)
                 return eventtime + REDRAW_TIME
-        # Update normal display
-        try:
-            self.show_data_group.show(self, self.display_templates, eventtime)
-        except:
-            logging.exception("Error during display screen update")
+            self.lcd_chip.clear()
+            self.show_data_group.draw(self, output, eventtime)
+            self.shown_output = output
+        flush_start = self.reactor.monotonic()
         self.lcd_chip.flush()
+        self.note_update_time(render_start, flush_start)
         return eventtime + REDRAW_TIME
+    def note_update_time(self, render_start, flush_start):
+        curtime = self.reactor.monotonic()
+        self.update_count += 1
+        if flush_start is None:
+            self.skip_count += 1
+            flush_start = curtime
+        render_time = flush_start - render_start
+        flush_time = curtime - flush_start
+        self.render_time += render_time
+        self.render_max = max(self.render_max, render_time)
+        self.flush_time += flush_time
+        self.flush_max = max(self.flush_max, flush_time)
+    def stats(self, eventtime):
+        count = max(1, self.update_count)
+        res = ("%s: updates=%d skipped=%d render=%.3fms render_max=%.3fms"
+               " flush=%.3fms flush_max=%.3fms" % (
+                   self.stats_name, self.update_count, self.skip_count,
+                   1000. * self.render_time / count, 1000. * self.render_max,
+                   1000. * self.flush_time / count, 1000. * self.flush_max))
+        self.update_count = self.skip_count = 0
+        self.render_time = self.render_max = 0.
+        self.flush_time = self.flush_max = 0.
+        return False, res
     def request_redraw(self):
         if self.redraw_request_pending:
             return
@@ -0,0 +1,25 @@
+# Helper code for transmitting lcd framebuffer updates
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import chelper
+
+# Locate the bytes in a framebuffer that need to be sent to the display
+class FramebufferDiff:
+    def __init__(self, max_gap, max_merge=16):
+        self.max_gap = max_gap
+        self.max_merge = max_merge
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.regions = self.ffi_main.new('int[]', 0)
+    def find_changes(self, new_data, old_data):
+        # Return a list of (position, count) regions that need updating
+        ffi_main = self.ffi_main
+        data_len = len(new_data)
+        if len(self.regions) < 2 * data_len:
+            self.regions = ffi_main.new('int[]', 2 * data_len)
+        count = self.ffi_lib.framebuffer_find_changes(
+            ffi_main.from_buffer(new_data), ffi_main.from_buffer(old_data),
+            data_len, self.max_gap, self.max_merge, self.regions)
+        regions = ffi_main.unpack(self.regions, 2 * count)
+        return zip(regions[::2], regions[1::2])
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
+from . import framebuffer
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 LINE_LENGTH_DEFAULT="20"
@@ -48,6 +49,7 @@ class HD44780:
               0xc0),
             # Glyph framebuffer
             (self.glyph_framebuffer, bytearray('~'*64), 0x40) ]
+        self.fb_diff = framebuffer.FramebufferDiff(4)
     def build_config(self):
         self.mcu.add_config_cmd(
             "config_hd44780 oid=%d rs_pin=%s e_pin=%s"
@@ -71,16 +73,8 @@ class HD44780:
         for new_data, old_data, fb_id in self.all_framebuffers:
             if new_data == old_data:
                 continue
-            # Find the position of all changed bytes in this framebuffer
-            diffs = [[i, 1] for i, (n, o) in enumerate(zip(new_data, old_data))
-                     if n != o]
-            # Batch together changes that are close to each other
-            for i in range(len(diffs)-2, -1, -1):
-                pos, count = diffs[i]
-                nextpos, nextcount = diffs[i+1]
-                if pos + 4 >= nextpos and nextcount < 16:
-                    diffs[i][1] = nextcount + (nextpos - pos)
-                    del diffs[i+1]
+            # Find the changed regions (nearby changes are batched together)
+            diffs = self.fb_diff.find_changes(new_data, old_data)
             # Transmit changes
             for pos, count in diffs:
                 chip_pos = pos
@@ -5,7 +5,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 from .. import bus
-from . import font8x14
+from . import font8x14, framebuffer
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 
@@ -30,6 +30,7 @@ class DisplayBase:
             # Graphics framebuffers
             ] + [(self.graphics_framebuffers[i], bytearray('~'*32), i)
                  for i in range(32)]
+        self.fb_diff = framebuffer.FramebufferDiff(5)
         self.cached_glyphs = {}
         self.icons = {}
     def flush(self):
@@ -37,16 +38,8 @@ class DisplayBase:
         for new_data, old_data, fb_id in self.all_framebuffers:
             if new_data == old_data:
                 continue
-            # Find the position of all changed bytes in this framebuffer
-            diffs = [[i, 1] for i, (n, o) in enumerate(zip(new_data, old_data))
-                     if n != o]
-            # Batch together changes that are close to each other
-            for i in range(len(diffs)-2, -1, -1):
-                pos, count = diffs[i]
-                nextpos, nextcount = diffs[i+1]
-                if pos + 5 >= nextpos and nextcount < 16:
-                    diffs[i][1] = nextcount + (nextpos - pos)
-                    del diffs[i+1]
+            # Find the changed regions (nearby changes are batched together)
+            diffs = self.fb_diff.find_changes(new_data, old_data)
             # Transmit changes
             for pos, count in diffs:
                 count += pos & 0x01
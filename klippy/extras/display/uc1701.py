@@ -6,7 +6,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 from .. import bus
-from . import font8x14
+from . import font8x14, framebuffer
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 
@@ -21,6 +21,7 @@ class DisplayBase:
         self.vram = [bytearray(self.columns) for i in range(8)]
         self.all_framebuffers = [(self.vram[i], bytearray('~'*self.columns), i)
                                  for i in range(8)]
+        self.fb_diff = framebuffer.FramebufferDiff(5)
         # Cache fonts and icons in display byte order
         self.font = [self._swizzle_bits(bytearray(c))
                      for c in font8x14.VGA_FONT]
@@ -30,16 +31,8 @@ class DisplayBase:
         for new_data, old_data, page in self.all_framebuffers:
             if new_data == old_data:
                 continue
-            # Find the position of all changed bytes in this framebuffer
-            diffs = [[i, 1] for i, (n, o) in enumerate(zip(new_data, old_data))
-                     if n != o]
-            # Batch together changes that are close to each other
-            for i in range(len(diffs)-2, -1, -1):
-                pos, count = diffs[i]
-                nextpos, nextcount = diffs[i+1]
-                if pos + 5 >= nextpos and nextcount < 16:
-                    diffs[i][1] = nextcount + (nextpos - pos)
-                    del diffs[i+1]
+            # Find the changed regions (nearby changes are batched together)
+            diffs = self.fb_diff.find_changes(new_data, old_data)
             # Transmit changes
             for col_pos, count in diffs:
                 # Set Position registers
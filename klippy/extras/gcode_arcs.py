@@ -8,14 +8,22 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
 
-# Coordinates created by this are converted into G1 commands.
+# Arcs are sent to the toolhead as native arc moves (of at most half a
+# turn each).  If a g-code move transform that doesn't support arc
+# moves is in use (eg, bed_tilt) the arc is instead converted into
+# linear segments.
 #
 # note: only IJ version available
 
+ARC_RADIUS_TOLERANCE = .050
+ARC_CORRECTION = 25
+
 class ArcSupport:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1., above=0.0)
+        self.chord_tolerance = config.getfloat('chord_tolerance', None,
+                                               above=0.)
 
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
         self.gcode = self.printer.lookup_object('gcode')
@@ -39,36 +47,34 @@ class ArcSupport:
         if not asI and not asJ:
             raise gcmd.error("G2/G3 neither I nor J given")
         asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
+        asF = gcmd.get_float("F", None, above=0.)
         clockwise = (gcmd.get_command() == 'G2')
 
-        # Build list of linear coordinates to move to
-        coords = self.planArc(currentPos, [asX, asY, asZ], [asI, asJ],
-                              clockwise)
-        e_per_move = e_base = 0.
+        # Build list of coordinates to move to (along with the angle
+        # turned if the move is an arc move)
+        if self.gcode_move.can_move_arc():
+            coords = self.planArcMoves(currentPos, [asX, asY, asZ],
+                                       [asI, asJ], clockwise)
+        else:
+            coords = [(c, None) for c in self.planArc(
+                currentPos, [asX, asY, asZ], [asI, asJ], clockwise)]
+        center = (currentPos[0] + asI, currentPos[1] + asJ)
+        e_dist = 0.
         if asE is not None:
+            e_dist = asE
             if gcodestatus['absolute_extrude']:
-                e_base = currentPos[3]
-            e_per_move = (asE - e_base) / len(coords)
-
-        # Convert coords into G1 commands
-        for coord in coords:
-            g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
-            if e_per_move:
-                g1_params['E'] = e_base + e_per_move
-                if gcodestatus['absolute_extrude']:
-                    e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+                e_dist -= currentPos[3]
+
+        # Send the coordinates directly to gcode_move
+        self.gcode_move.move_arc_path(coords, center, e_dist, asF)
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
     #
     # The arc is approximated by generating many small linear segments.
     # The length of each segment is configured in MM_PER_ARC_SEGMENT
-    # Arcs smaller then this value, will be a Line only
+    # (or is longer if the segments stay within CHORD_TOLERANCE of the
+    # arc).  Arcs smaller then this value, will be a Line only
     def planArc(self, currentPos, targetPos, offset, clockwise):
         # todo: sometimes produces full circles
         X_AXIS = 0
@@ -78,25 +84,10 @@ class ArcSupport:
         # Radius vector from center to current location
         r_P = -offset[0]
         r_Q = -offset[1]
-
-        # Determine angular travel
         center_P = currentPos[X_AXIS] - r_P
         center_Q = currentPos[Y_AXIS] - r_Q
-        rt_X = targetPos[X_AXIS] - center_P
-        rt_Y = targetPos[Y_AXIS] - center_Q
-        angular_travel = math.atan2(r_P * rt_Y - r_Q * rt_X,
-                                    r_P * rt_X + r_Q * rt_Y)
-        if angular_travel < 0.:
-            angular_travel += 2. * math.pi
-        if clockwise:
-            angular_travel -= 2. * math.pi
-
-        if (angular_travel == 0.
-            and currentPos[X_AXIS] == targetPos[X_AXIS]
-            and currentPos[Y_AXIS] == targetPos[Y_AXIS]):
-            # Make a circle if the angular rotation is 0 and the
-            # target is current position
-            angular_travel = 2. * math.pi
+        angular_travel = self.calcAngularTravel(currentPos, targetPos,
+                                                offset, clockwise)
 
         # Determine number of segments
         linear_travel = targetPos[Z_AXIS] - currentPos[Z_AXIS]
@@ -106,24 +97,92 @@ class ArcSupport:
             mm_of_travel = math.hypot(flat_mm, linear_travel)
         else:
             mm_of_travel = math.fabs(flat_mm)
-        segments = max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
-
-        # Generate coordinates
+        mm_per_segment = self.mm_per_arc_segment
+        tolerance = self.chord_tolerance
+        if tolerance is not None and tolerance < radius:
+            # Length of a chord that is tolerance away from the arc
+            chord_mm = 2. * math.sqrt((2. * radius - tolerance) * tolerance)
+            mm_per_segment = max(mm_per_segment, chord_mm)
+        segments = max(1., math.floor(mm_of_travel / mm_per_segment))
+
+        # Generate coordinates - the radius vector is rotated by a
+        # fixed rotation matrix for each segment and is recalculated
+        # with cos/sin every ARC_CORRECTION segments to limit the
+        # accumulated error
         theta_per_segment = angular_travel / segments
         linear_per_segment = linear_travel / segments
+        cos_T = math.cos(theta_per_segment)
+        sin_T = math.sin(theta_per_segment)
         coords = []
         for i in range(1, int(segments)):
-            dist_Z = i * linear_per_segment
-            cos_Ti = math.cos(i * theta_per_segment)
-            sin_Ti = math.sin(i * theta_per_segment)
-            r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
-            r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
-
-            c = [center_P + r_P, center_Q + r_Q, currentPos[Z_AXIS] + dist_Z]
-            coords.append(c)
+            if i % ARC_CORRECTION:
+                r_P, r_Q = r_P * cos_T - r_Q * sin_T, r_P * sin_T + r_Q * cos_T
+            else:
+                cos_Ti = math.cos(i * theta_per_segment)
+                sin_Ti = math.sin(i * theta_per_segment)
+                r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
+                r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
+            coords.append([center_P + r_P, center_Q + r_Q,
+                           currentPos[Z_AXIS] + i * linear_per_segment])
 
         coords.append(targetPos)
         return coords
 
+    def calcAngularTravel(self, currentPos, targetPos, offset, clockwise):
+        # Radius vectors from center to current and target location
+        r_P = -offset[0]
+        r_Q = -offset[1]
+        rt_X = targetPos[0] - currentPos[0] - offset[0]
+        rt_Y = targetPos[1] - currentPos[1] - offset[1]
+        angular_travel = math.atan2(r_P * rt_Y - r_Q * rt_X,
+                                    r_P * rt_X + r_Q * rt_Y)
+        if angular_travel < 0.:
+            angular_travel += 2. * math.pi
+        if clockwise:
+            angular_travel -= 2. * math.pi
+
+        if (angular_travel == 0.
+            and currentPos[0] == targetPos[0]
+            and currentPos[1] == targetPos[1]):
+            # Make a circle if the angular rotation is 0 and the
+            # target is current position
+            angular_travel = 2. * math.pi
+        return angular_travel
+
+    # Split an arc into arc moves of at most half a turn each and
+    # return their end coordinates and angles.  If the target is not
+    # the same distance from the center (within ARC_RADIUS_TOLERANCE)
+    # the arc ends at the target angle and a line to the target is
+    # added (as done by planArc), otherwise the radius changes
+    # linearly along the arc to meet the target.
+    def planArcMoves(self, currentPos, targetPos, offset, clockwise):
+        angular_travel = self.calcAngularTravel(currentPos, targetPos,
+                                                offset, clockwise)
+        center_P = currentPos[0] + offset[0]
+        center_Q = currentPos[1] + offset[1]
+        start_angle = math.atan2(-offset[1], -offset[0])
+        start_radius = math.hypot(offset[0], offset[1])
+        end_radius = math.hypot(targetPos[0] - center_P,
+                                targetPos[1] - center_Q)
+        is_spiral = abs(end_radius - start_radius) <= ARC_RADIUS_TOLERANCE
+        if not is_spiral:
+            end_radius = start_radius
+        count = max(1, int(math.ceil(abs(angular_travel) / math.pi)))
+        coords = []
+        for i in range(1, count + 1):
+            r = float(i) / count
+            angle = start_angle + angular_travel * r
+            radius = start_radius + (end_radius - start_radius) * r
+            coords.append(([center_P + radius * math.cos(angle),
+                            center_Q + radius * math.sin(angle),
+                            currentPos[2]
+                            + (targetPos[2] - currentPos[2]) * r],
+                           angular_travel / count))
+        if is_spiral:
+            coords[-1] = (targetPos, coords[-1][1])
+        else:
+            coords.append((targetPos, None))
+        return coords
+
 def load_config(config):
     return ArcSupport(config)
@@ -5,39 +5,339 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import traceback, logging, ast, copy
 import jinja2
+import webhooks
 
 
 ######################################################################
 # Template handling
 ######################################################################
 
+class _NotCacheable(Exception):
+    pass
+
+_ATOMIC_TYPES = (type(None), bool, int, long, float, str, unicode)
+
+# Create an independent copy of a template parameter for later comparison
+def _snapshot_value(value):
+    if isinstance(value, _ATOMIC_TYPES):
+        return value
+    if type(value) is dict:
+        return {k: _snapshot_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_snapshot_value(v) for v in value]
+    raise _NotCacheable()
+
+# Markers used in dependency paths for the list of keys in a dictionary
+# and for the full contents of a dictionary
+_KEYS = ('keys',)
+_ALL = ('all',)
+
+# Read-only view of a get_status() dictionary.  Values are copied only
+# when accessed and every access is reported to the GetStatusWrapper
+# so that template results can be reused while the values are unchanged.
+class StatusView(dict):
+    def __init__(self, wrapper, obj_name, path, status, is_partial=False):
+        dict.__init__(self, status)
+        self._sv_wrapper = wrapper
+        self._sv_name = obj_name
+        self._sv_path = path
+        self._sv_cache = {}
+        self._sv_partial = is_partial
+    def _sv_note(self, path, value):
+        self._sv_wrapper.note_access(self._sv_name, self._sv_path + path,
+                                     value)
+    def _sv_complete(self):
+        # Fill in fields that were not included in a prefetched status
+        if not self._sv_partial:
+            return
+        self._sv_partial = False
+        status = self._sv_wrapper.get_raw_status(self._sv_name)
+        for key, val in status.items():
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, val)
+    def _sv_fetch(self, key):
+        status = self._sv_wrapper.get_raw_status(
+            self._sv_name, frozenset([key]))
+        if key in status:
+            dict.__setitem__(self, key, status[key])
+        else:
+            self._sv_complete()
+    def __getitem__(self, key):
+        if key in self._sv_cache:
+            res = self._sv_cache[key]
+        else:
+            if self._sv_partial and not dict.__contains__(self, key):
+                self._sv_fetch(key)
+            val = dict.__getitem__(self, key)
+            if type(val) is dict:
+                res = StatusView(self._sv_wrapper, self._sv_name,
+                                 self._sv_path + (key,), val)
+            elif isinstance(val, _ATOMIC_TYPES):
+                res = val
+            else:
+                res = copy.deepcopy(val)
+            self._sv_cache[key] = res
+        if isinstance(res, StatusView):
+            res._sv_note((_KEYS,), frozenset(dict.keys(res)))
+        else:
+            self._sv_note((key,), res)
+        return res
+    def get(self, key, default=None):
+        if self._sv_partial and not dict.__contains__(self, key):
+            self._sv_fetch(key)
+        if dict.__contains__(self, key):
+            return self[key]
+        self._sv_note((_KEYS,), frozenset(dict.keys(self)))
+        return default
+    def __contains__(self, key):
+        self._sv_complete()
+        self._sv_note((_KEYS,), frozenset(dict.keys(self)))
+        return dict.__contains__(self, key)
+    has_key = __contains__
+    def keys(self):
+        self._sv_complete()
+        self._sv_note((_KEYS,), frozenset(dict.keys(self)))
+        return dict.keys(self)
+    def __iter__(self):
+        return iter(self.keys())
+    iterkeys = __iter__
+    def __len__(self):
+        return len(self.keys())
+    def values(self):
+        return [self[k] for k in self.keys()]
+    def itervalues(self):
+        return iter(self.values())
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+    def iteritems(self):
+        return iter(self.items())
+    def copy(self):
+        return dict(self.items())
+    def __eq__(self, other):
+        return dict(self.items()) == other
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    __hash__ = None
+    def __repr__(self):
+        # The text of a dictionary includes all of its nested values
+        self._sv_complete()
+        status = copy.deepcopy(dict(dict.items(self)))
+        self._sv_note((_ALL,), status)
+        return repr(status)
+    __str__ = __repr__
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
     def __init__(self, printer, eventtime=None):
         self.printer = printer
         self.eventtime = eventtime
         self.cache = {}
+        self.raw_cache = {}
+        self.prefetched = {}
+        self.trackers = []
+    def _has_status(self, sval):
+        po = self.printer.lookup_object(sval, None)
+        return po is not None and hasattr(po, 'get_status')
+    def get_raw_status(self, sval, fields=None):
+        # Returns the get_status() dictionary of the given printer
+        # object (or None).  If 'fields' is specified, the object may
+        # return only the requested fields.
+        res = self.raw_cache.get(sval)
+        if res is not None:
+            status, have_fields = res
+            if have_fields is None:
+                return status
+            if fields is not None:
+                if fields <= have_fields:
+                    return status
+                fields = fields | have_fields
+        po = self.printer.lookup_object(sval, None)
+        if po is None or not hasattr(po, 'get_status'):
+            self.raw_cache[sval] = (None, None)
+            return None
+        if self.eventtime is None:
+            self.eventtime = self.printer.get_reactor().monotonic()
+        if fields is not None and webhooks.supports_status_fields(po):
+            status = po.get_status(self.eventtime, fields=fields)
+        else:
+            status = po.get_status(self.eventtime)
+            fields = None
+        self.raw_cache[sval] = (status, fields)
+        return status
+    def prefetch(self, status_refs):
+        # Obtain the status of all the printer objects (and fields)
+        # that will be referenced by a set of templates
+        if id(status_refs) in self.prefetched:
+            return
+        self.prefetched[id(status_refs)] = status_refs
+        for sval, fields in status_refs.items():
+            if fields is None or fields:
+                self.get_raw_status(sval, fields)
     def __getitem__(self, val):
         sval = str(val).strip()
         if sval in self.cache:
             return self.cache[sval]
-        po = self.printer.lookup_object(sval, None)
-        if po is None or not hasattr(po, 'get_status'):
+        res = self.raw_cache.get(sval)
+        if res is None:
+            self.get_raw_status(sval)
+            res = self.raw_cache[sval]
+        status, have_fields = res
+        if status is None:
             raise KeyError(val)
-        if self.eventtime is None:
-            self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
-        return res
+        self.cache[sval] = view = StatusView(self, sval, (), status,
+                                             have_fields is not None)
+        return view
     def __contains__(self, val):
-        try:
-            self.__getitem__(val)
-        except KeyError as e:
-            return False
-        return True
+        sval = str(val).strip()
+        res = self._has_status(sval)
+        self.note_access(sval, (), res)
+        return res
     def __iter__(self):
+        self.mark_uncacheable()
         for name, obj in self.printer.lookup_objects():
             if self.__contains__(name):
                 yield name
+    # Dependency tracking for template result caching
+    def push_tracker(self):
+        self.trackers.append({})
+    def pop_tracker(self):
+        deps = self.trackers.pop()
+        if self.trackers:
+            self.note_deps(deps)
+        return deps
+    def mark_uncacheable(self):
+        if self.trackers:
+            self.trackers[-1] = None
+    def note_access(self, obj_name, path, value):
+        if self.trackers and self.trackers[-1] is not None:
+            self.trackers[-1][(obj_name, path)] = value
+    def note_deps(self, deps):
+        if not self.trackers or self.trackers[-1] is None:
+            return
+        if deps is None:
+            self.trackers[-1] = None
+            return
+        self.trackers[-1].update(deps)
+    def _lookup_path(self, obj_name, path):
+        if not path:
+            return self._has_status(obj_name)
+        res = self.raw_cache.get(obj_name)
+        if res is not None and (res[1] is None or path[0] in res[1]):
+            status = res[0]
+        elif path[0] is _KEYS or path[0] is _ALL:
+            status = self.get_raw_status(obj_name)
+        else:
+            status = self.get_raw_status(obj_name, frozenset(path[:1]))
+        for p in path:
+            if p is _KEYS:
+                status = frozenset(status.keys())
+            elif p is _ALL:
+                break
+            else:
+                status = status[p]
+        return status
+    def check_deps(self, deps):
+        # Returns None if all dependencies are unchanged, otherwise
+        # returns the key of the first changed dependency
+        for key, value in deps:
+            try:
+                if self._lookup_path(*key) != value:
+                    return key
+            except (KeyError, IndexError, TypeError, AttributeError):
+                return key
+        return None
+
+# Functions and methods that may be called from a template without
+# preventing the caching of the template's output
+PURE_FUNCTIONS = ['range', 'dict', 'render']
+PURE_METHODS = [
+    'format', 'strip', 'lstrip', 'rstrip', 'upper', 'lower', 'split',
+    'join', 'replace', 'startswith', 'endswith', 'get', 'keys', 'values',
+    'items', 'count', 'index', 'find']
+IMPURE_FILTERS = ['random', 'tojson']
+
+# Determine if a template's output depends only on its inputs
+def _is_cacheable(tree):
+    for call in tree.find_all(jinja2.nodes.Call):
+        node = call.node
+        if isinstance(node, jinja2.nodes.Name):
+            if node.name not in PURE_FUNCTIONS:
+                return False
+            if node.name == 'dict' and (call.args or call.dyn_args):
+                # Copying a status dictionary does not note its fields
+                return False
+        elif isinstance(node, jinja2.nodes.Getattr):
+            if node.attr not in PURE_METHODS:
+                return False
+        else:
+            return False
+    for flt in tree.find_all(jinja2.nodes.Filter):
+        if flt.name in IMPURE_FILTERS:
+            return False
+    return True
+
+# Find the printer objects (and their fields) used by a template.
+# Returns a dictionary mapping object name to a set of field names (or
+# None if the template may use any field of the object).  References
+# that can not be determined from the template source (such as
+# "printer[name]" with a variable name) are not included.
+def _find_status_refs(tree):
+    parents = {}
+    for node in tree.find_all(jinja2.nodes.Node):
+        for child in node.iter_child_nodes():
+            parents[id(child)] = node
+    def get_const_name(node, parent):
+        if getattr(parent, 'node', None) is not node:
+            return None
+        if isinstance(parent, jinja2.nodes.Getattr):
+            return str(parent.attr)
+        if (isinstance(parent, jinja2.nodes.Getitem)
+            and isinstance(parent.arg, jinja2.nodes.Const)
+            and isinstance(parent.arg.value, basestring)):
+            return str(parent.arg.value).strip()
+        return None
+    refs = {}
+    for node in tree.find_all(jinja2.nodes.Name):
+        if node.name != 'printer' or node.ctx != 'load':
+            continue
+        parent = parents.get(id(node))
+        obj_name = get_const_name(node, parent)
+        if obj_name is None:
+            # Check for a "name in printer" test
+            if (isinstance(parent, jinja2.nodes.Operand)
+                and parent.op in ('in', 'notin')):
+                cmp_node = parents.get(id(parent))
+                if (isinstance(cmp_node, jinja2.nodes.Compare)
+                    and isinstance(cmp_node.expr, jinja2.nodes.Const)
+                    and isinstance(cmp_node.expr.value, basestring)):
+                    refs.setdefault(str(cmp_node.expr.value).strip(), set())
+            continue
+        field = get_const_name(parent, parents.get(id(parent)))
+        fields = refs.setdefault(obj_name, set())
+        if field is None:
+            refs[obj_name] = None
+        elif fields is not None:
+            fields.add(field)
+    return {n: (f if f is None else frozenset(f)) for n, f in refs.items()}
+
+# Combine the printer object references of several templates
+def merge_status_refs(refs_list):
+    res = {}
+    for refs in refs_list:
+        for obj_name, fields in refs.items():
+            if obj_name not in res:
+                res[obj_name] = fields
+            elif fields is None or res[obj_name] is None:
+                res[obj_name] = None
+            else:
+                res[obj_name] = res[obj_name] | fields
+    return res
+
+# Maximum number of cached results stored for each template
+TEMPLATE_CACHE_SIZE = 4
+# Maximum number of renders to skip cache checks on a frequently
+# changing template
+TEMPLATE_MAX_SKIP = 16
 
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
@@ -49,14 +349,20 @@ class TemplateWrapper:
         self.create_template_context = gcode_macro.create_template_context
         try:
             self.template = env.from_string(script)
+            tree = env.parse(script)
+            self.is_cacheable = _is_cacheable(tree)
+            self.status_refs = _find_status_refs(tree)
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
-    def render(self, context=None):
-        if context is None:
-            context = self.create_template_context()
+        self.result_cache = []
+        self.volatile_deps = {}
+        self.miss_count = self.skip_count = 0
+    def get_status_refs(self):
+        return self.status_refs
+    def _render(self, context):
         try:
             return str(self.template.render(context))
         except Exception as e:
@@ -64,6 +370,59 @@ class TemplateWrapper:
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+    def _get_params(self, context):
+        try:
+            return {k: _snapshot_value(v) for k, v in context.items()
+                    if k != 'printer' and not callable(v)}
+        except _NotCacheable:
+            return None
+    def render(self, context=None):
+        if context is None:
+            context = self.create_template_context()
+        status = context.get('printer')
+        if not isinstance(status, GetStatusWrapper):
+            return self._render(context)
+        status.prefetch(self.status_refs)
+        if not self.is_cacheable or self.skip_count:
+            if self.skip_count:
+                self.skip_count -= 1
+            status.mark_uncacheable()
+            return self._render(context)
+        # Check for a previous result with the same inputs
+        params = self._get_params(context)
+        if params is None:
+            status.mark_uncacheable()
+            return self._render(context)
+        for i, (cparams, cdeps, cresult) in enumerate(self.result_cache):
+            if cparams != params:
+                continue
+            changed = status.check_deps(cdeps)
+            if changed is not None:
+                self.volatile_deps[changed] = True
+                continue
+            status.note_deps(dict(cdeps))
+            self.miss_count = 0
+            if i:
+                del self.result_cache[i]
+                self.result_cache.insert(0, (cparams, cdeps, cresult))
+            return cresult
+        # Avoid checking the cache on templates that rarely match it
+        self.miss_count += 1
+        if self.miss_count > TEMPLATE_CACHE_SIZE:
+            self.skip_count = min(self.miss_count, TEMPLATE_MAX_SKIP)
+        # Render and note the status fields used
+        status.push_tracker()
+        try:
+            result = self._render(context)
+        finally:
+            deps = status.pop_tracker()
+        if deps is not None:
+            # Check frequently changing fields first on later lookups
+            volatile = self.volatile_deps
+            deps = sorted(deps.items(), key=lambda d: d[0] not in volatile)
+            self.result_cache.insert(0, (params, deps, result))
+            del self.result_cache[TEMPLATE_CACHE_SIZE:]
+        return result
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
@@ -79,6 +438,8 @@ class PrinterGCodeMacro:
         else:
             script = config.get(option, default)
         return TemplateWrapper(self.printer, self.env, name, script)
+    def merge_status_refs(self, refs_list):
+        return merge_status_refs(refs_list)
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("Shutdown due to %s" % (msg,))
         return ""
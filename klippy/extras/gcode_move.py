@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, math
 
 class GCodeMove:
     def __init__(self, config):
@@ -107,6 +107,14 @@ class GCodeMove:
     def reset_last_position(self):
         if self.is_printer_ready:
             self.last_position = self.position_with_transform()
+    def has_move_transform(self):
+        return self.move_transform is not None
+    def can_move_arc(self):
+        # A move transform may accept arc moves by providing a
+        # can_move_arc() method (and an 'arc' parameter to its move())
+        transform = self.move_transform
+        return transform is None or (hasattr(transform, 'can_move_arc')
+                                     and transform.can_move_arc())
     # G-Code movement commands
     def cmd_G1(self, gcmd):
         # Move
@@ -139,6 +147,49 @@ class GCodeMove:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
         self.move_with_transform(self.last_position, self.speed)
+    def move_arc_path(self, coords, center, e_dist, gcode_speed=None):
+        # Move through a list of (position, arc_angle) pairs generated
+        # by G2/G3 (in absolute g-code coordinates).  Positions with an
+        # arc_angle of None are reached with a linear move - the others
+        # with an arc around the given center (only used when
+        # can_move_arc() is true).
+        if gcode_speed is not None:
+            self.speed = gcode_speed * self.speed_factor
+        base_position = self.base_position
+        last_position = self.last_position
+        center_x = center[0] + base_position[0]
+        center_y = center[1] + base_position[1]
+        # Split the extrusion by the length of each move (arc lengths
+        # are calculated as in toolhead.Move)
+        lengths = []
+        last_coord = [last_position[i] - base_position[i] for i in (0, 1, 2)]
+        for coord, arc_angle in coords:
+            axes_d = [coord[i] - last_coord[i] for i in (0, 1, 2)]
+            if arc_angle is None:
+                lengths.append(math.sqrt(sum([d*d for d in axes_d])))
+            else:
+                start_radius = math.hypot(last_coord[0] - center[0],
+                                          last_coord[1] - center[1])
+                end_radius = math.hypot(coord[0] - center[0],
+                                        coord[1] - center[1])
+                arc_d = .5 * (start_radius + end_radius) * abs(arc_angle)
+                lengths.append(math.hypot(arc_d, axes_d[2]))
+            last_coord = coord
+        total_length = sum(lengths)
+        if not total_length:
+            lengths = [1.] * len(coords)
+            total_length = float(len(coords))
+        e_per_mm = e_dist * self.extrude_factor / total_length
+        for (coord, arc_angle), length in zip(coords, lengths):
+            last_position[0] = coord[0] + base_position[0]
+            last_position[1] = coord[1] + base_position[1]
+            last_position[2] = coord[2] + base_position[2]
+            last_position[3] += e_per_mm * length
+            if arc_angle is None:
+                self.move_with_transform(last_position, self.speed)
+            else:
+                self.move_with_transform(last_position, self.speed,
+                                         (center_x, center_y, arc_angle))
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
         # Set units to inches
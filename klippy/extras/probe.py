@@ -339,6 +339,7 @@ class ProbePointsHelper:
         self.horizontal_move_z = config.getfloat('horizontal_move_z', 5.)
         self.speed = config.getfloat('speed', 50., above=0.)
         self.use_offsets = False
+        self.result_callback = None
         # Internal probing state
         self.lift_speed = self.speed
         self.probe_offsets = (0., 0., 0.)
@@ -352,10 +353,19 @@ class ProbePointsHelper:
         self.minimum_points(min_points)
     def use_xy_offsets(self, use_offsets):
         self.use_offsets = use_offsets
+    def use_result_callback(self, result_callback):
+        # The callback is invoked as each probe result arrives and may
+        # return a list of additional points to probe
+        self.result_callback = result_callback
     def get_lift_speed(self):
         return self.lift_speed
     def _move_next(self):
         toolhead = self.printer.lookup_object('toolhead')
+        if self.results and self.result_callback is not None:
+            new_points = self.result_callback(self.probe_offsets,
+                                              self.results)
+            if new_points:
+                self.probe_points = self.probe_points + list(new_points)
         # Lift toolhead
         speed = self.lift_speed
         if not self.results:
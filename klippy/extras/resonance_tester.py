@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
-from . import shaper_calibrate
+from . import adxl345, shaper_calibrate
 
 def _parse_probe_points(config):
     points = config.get('probe_points').split('\n')
@@ -46,9 +46,13 @@ class VibrationPulseTest:
             {"ACCEL": max_accel, "ACCEL_TO_DECEL": max_accel}))
     def run_test(self, toolhead, axis, gcmd):
         X, Y, Z, E = toolhead.get_position()
-        if axis not in self.get_supported_axes():
-            raise gcmd.error("Test axis '%s' is not supported", axis)
-        vib_dir = (1, 0) if axis == 'x' else (0., 1.)
+        # The 'xy' axis vibrates along the diagonal to test both axes
+        # in a single sweep
+        vib_dirs = {'x': (1., 0.), 'y': (0., 1.),
+                    'xy': (math.sqrt(.5), math.sqrt(.5))}
+        if axis not in vib_dirs:
+            raise gcmd.error("Test axis '%s' is not supported" % (axis,))
+        vib_dir = vib_dirs[axis]
         sign = 1.
         freq = self.freq_start
         gcmd.respond_info("Testing frequency %.0f Hz" % (freq,))
@@ -84,6 +88,11 @@ class ResonanceTester:
             if self.accel_chip_names[0][1] == self.accel_chip_names[1][1]:
                 self.accel_chip_names = [('xy', self.accel_chip_names[0][1])]
         self.max_smoothing = config.getfloat('max_smoothing', None, minval=0.05)
+        # A diagonal move drives a single motor on corexy and corexz
+        # printers, so the axes can't be tested with one diagonal sweep
+        kinematics = config.getsection('printer').get('kinematics',
+                                                      note_valid=False)
+        self.supports_combined = kinematics not in ('corexy', 'corexz')
 
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("MEASURE_AXES_NOISE",
@@ -123,6 +132,10 @@ class ResonanceTester:
             raise gcmd.error("Invalid NAME parameter")
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = gcmd.get("FORMAT", "csv").lower()
+        if raw_format not in adxl345.OUTPUT_FORMATS:
+            raise gcmd.error("Unsupported raw data FORMAT '%s'" % (
+                raw_format,))
 
         # Setup calculation of resonances
         if csv_output:
@@ -150,35 +163,27 @@ class ResonanceTester:
             toolhead.dwell(0.500)
             gcmd.respond_info("Testing axis %s" % axis.upper())
 
-            for chip_axis, chip in self.accel_chips:
-                if axis in chip_axis or chip_axis in axis:
-                    chip.start_measurements()
-            # Generate moves
-            self.test.run_test(toolhead, axis, gcmd)
-            raw_values = []
-            for chip_axis, chip in self.accel_chips:
-                if axis in chip_axis or chip_axis in axis:
-                    results = chip.finish_measurements()
-                    if raw_output:
-                        raw_name = self.get_filename(
-                                'raw_data', name_suffix, axis,
-                                point if len(calibration_points) > 1 else None)
-                        results.write_to_file(raw_name)
-                        gcmd.respond_info(
-                                "Writing raw accelerometer data to %s file" % (
-                                    raw_name,))
-                    raw_values.append((chip_axis, results))
-            if not csv_output:
-                continue
-            for chip_axis, chip_values in raw_values:
-                gcmd.respond_info("%s-axis accelerometer stats: %s" % (
-                    chip_axis, chip_values.get_stats(),))
-                if not chip_values:
-                    raise gcmd.error(
-                            "%s-axis accelerometer measured no data" % (
-                                chip_axis,))
-                new_data = helper.process_accelerometer_data(chip_values)
-                data = data.join(new_data) if data else new_data
+            chips = [(chip_axis, chip) for chip_axis, chip in self.accel_chips
+                     if axis in chip_axis or chip_axis in axis]
+            measurements = self._run_chips_test(
+                    gcmd, toolhead, axis, chips,
+                    helper if csv_output else None, raw_output)
+            for chip_axis, results, new_data in measurements:
+                if raw_output:
+                    raw_name = self.get_filename(
+                            'raw_data', name_suffix, axis,
+                            point if len(calibration_points) > 1 else None,
+                            adxl345.OUTPUT_FORMATS[raw_format])
+                    results.write_to_file(raw_name, raw_format)
+                    gcmd.respond_info(
+                            "Writing raw accelerometer data to %s file" % (
+                                raw_name,))
+                if new_data is None:
+                    continue
+                if data is None:
+                    data = new_data
+                else:
+                    data.join(new_data)
         if csv_output:
             csv_name = self.save_calibration_data('resonances', name_suffix,
                                                   helper, axis, data)
@@ -203,6 +208,11 @@ class ResonanceTester:
 
         max_smoothing = gcmd.get_float(
                 "MAX_SMOOTHING", self.max_smoothing, minval=0.05)
+        combined = len(calibrate_axes) > 1 and gcmd.get_int(
+                "COMBINED", 0, minval=0, maxval=1)
+        if combined and not self.supports_combined:
+            raise gcmd.error("COMBINED=1 is not supported on corexy and"
+                             " corexz printers")
 
         name_suffix = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not self.is_valid_name_suffix(name_suffix):
@@ -227,51 +237,56 @@ class ResonanceTester:
             if len(calibration_points) > 1:
                 gcmd.respond_info(
                         "Probing point (%.3f, %.3f, %.3f)" % tuple(point))
-            for axis in calibrate_axes:
+            if combined:
+                # Test all axes at once with all the chips
+                test_axes = [''.join(calibrate_axes)]
+            else:
+                test_axes = calibrate_axes
+            for test_axis in test_axes:
                 toolhead.wait_moves()
                 toolhead.dwell(0.500)
-                gcmd.respond_info("Testing axis %s" % axis.upper())
+                gcmd.respond_info("Testing axis %s" % test_axis.upper())
 
-                for chip_axis, chip in self.accel_chips:
-                    if axis in chip_axis or chip_axis in axis:
-                        chip.start_measurements()
-                # Generate moves
-                self.test.run_test(toolhead, axis, gcmd)
-                raw_values = [(chip_axis, chip.finish_measurements())
-                              for chip_axis, chip in self.accel_chips
-                              if axis in chip_axis or chip_axis in axis]
-                for chip_axis, chip_values in raw_values:
-                    gcmd.respond_info("%s-axis accelerometer stats: %s" % (
-                        chip_axis, chip_values.get_stats(),))
-                    if not chip_values:
-                        raise gcmd.error(
-                                "%s-axis accelerometer measured no data" % (
-                                    chip_axis,))
-                    new_data = helper.process_accelerometer_data(chip_values)
-                    if calibration_data[axis] is None:
-                        calibration_data[axis] = new_data
-                    else:
-                        calibration_data[axis].join(new_data)
+                chips = [(chip_axis, chip)
+                         for chip_axis, chip in self.accel_chips
+                         if test_axis in chip_axis or chip_axis in test_axis]
+                measurements = self._run_chips_test(
+                        gcmd, toolhead, test_axis, chips, helper, False)
+                for axis in calibrate_axes:
+                    for chip_axis, _, new_data in measurements:
+                        if axis not in chip_axis or axis not in test_axis:
+                            continue
+                        if combined:
+                            new_data = new_data.get_axis_data(axis)
+                        if calibration_data[axis] is None:
+                            calibration_data[axis] = new_data
+                        else:
+                            calibration_data[axis].join(new_data)
 
         configfile = self.printer.lookup_object('configfile')
 
-        for axis in calibrate_axes:
-            gcmd.respond_info(
-                    "Calculating the best input shaper parameters for %s axis"
-                    % (axis,))
-            calibration_data[axis].normalize_to_frequencies()
-            best_shaper, all_shapers = helper.find_best_shaper(
-                    calibration_data[axis], max_smoothing, gcmd.respond_info)
-            gcmd.respond_info(
-                    "Recommended shaper_type_%s = %s, shaper_freq_%s = %.1f Hz"
-                    % (axis, best_shaper.name, axis, best_shaper.freq))
-            helper.save_params(configfile, axis,
-                               best_shaper.name, best_shaper.freq)
-            csv_name = self.save_calibration_data(
-                    'calibration_data', name_suffix, helper, axis,
-                    calibration_data[axis], all_shapers)
-            gcmd.respond_info(
-                    "Shaper calibration data written to %s file" % (csv_name,))
+        try:
+            for axis in calibrate_axes:
+                gcmd.respond_info("Calculating the best input shaper"
+                                  " parameters for %s axis" % (axis,))
+                calibration_data[axis].normalize_to_frequencies()
+                best_shaper, all_shapers = helper.find_best_shaper(
+                        calibration_data[axis], max_smoothing,
+                        gcmd.respond_info)
+                gcmd.respond_info(
+                        "Recommended shaper_type_%s = %s,"
+                        " shaper_freq_%s = %.1f Hz" % (
+                            axis, best_shaper.name, axis, best_shaper.freq))
+                helper.save_params(configfile, axis,
+                                   best_shaper.name, best_shaper.freq)
+                csv_name = self.save_calibration_data(
+                        'calibration_data', name_suffix, helper, axis,
+                        calibration_data[axis], all_shapers)
+                gcmd.respond_info("Shaper calibration data written to"
+                                  " %s file" % (csv_name,))
+        finally:
+            # Release the worker processes used for shaper fitting
+            helper.close()
 
         gcmd.respond_info(
             "The SAVE_CONFIG command will update the printer config file\n"
@@ -280,6 +295,39 @@ class ResonanceTester:
             input_shaper.enable_shaping()
             gcmd.respond_info("Re-enabled [input_shaper] after calibration")
 
+    def _run_chips_test(self, gcmd, toolhead, axis, chips, helper,
+                        store_samples):
+        # Run the test on the given axis while measuring with all the
+        # chips, started and stopped at the same print_time so that
+        # their measurements are aligned.  Returns a list of
+        # (chip_axis, results, calibration_data) tuples.
+        streams = [helper.create_psd_stream() if helper is not None else None
+                   for _ in chips]
+        try:
+            print_time = toolhead.get_last_move_time()
+            for (chip_axis, chip), stream in zip(chips, streams):
+                chip.start_measurements(stream=stream,
+                                        store_samples=store_samples,
+                                        print_time=print_time)
+            # Generate moves
+            self.test.run_test(toolhead, axis, gcmd)
+            print_time = toolhead.get_last_move_time()
+            raw_values = [(chip_axis, chip.finish_measurements(print_time))
+                          for chip_axis, chip in chips]
+            measurements = []
+            for (chip_axis, results), stream in zip(raw_values, streams):
+                data = None
+                if stream is not None:
+                    gcmd.respond_info("%s-axis accelerometer stats: %s" % (
+                        chip_axis, results.get_stats(),))
+                    data = stream.finish(results)
+                measurements.append((chip_axis, results, data))
+            return measurements
+        finally:
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
+
     def cmd_MEASURE_AXES_NOISE(self, gcmd):
         meas_time = gcmd.get_float("MEAS_TIME", 2.)
         for _, chip in self.accel_chips:
@@ -300,14 +348,15 @@ class ResonanceTester:
     def is_valid_name_suffix(self, name_suffix):
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
-    def get_filename(self, base, name_suffix, axis=None, point=None):
+    def get_filename(self, base, name_suffix, axis=None, point=None,
+                     ext=".csv"):
         name = base
         if axis:
             name += '_' + axis
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data, all_shapers=None):
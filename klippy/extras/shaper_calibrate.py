@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing
+import collections, importlib, logging, math, multiprocessing, traceback
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
@@ -12,6 +12,8 @@ MAX_SHAPER_FREQ = 150.
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 SHAPER_DAMPING_RATIO = 0.1
+FIT_BLOCK_SIZE = 32
+WELCH_BLOCK_SIZE = 64
 
 ######################################################################
 # Input shapers
@@ -154,6 +156,14 @@ class CalibrationData:
         self.data_sets = joined_data_sets
     def set_numpy(self, numpy):
         self.numpy = numpy
+    def get_axis_data(self, axis):
+        # Return the frequency response along a single axis (for tests
+        # that excite several axes at once)
+        psd = {'x': self.psd_x, 'y': self.psd_y, 'z': self.psd_z}[axis]
+        data = CalibrationData(self.freq_bins, psd.copy(), self.psd_x.copy(),
+                               self.psd_y.copy(), self.psd_z.copy())
+        data.set_numpy(self.numpy)
+        return data
     def normalize_to_frequencies(self):
         for psd in self._psd_list:
             # Avoid division by zero errors
@@ -166,93 +176,275 @@ CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score'))
 
-class ShaperCalibrate:
-    def __init__(self, printer):
-        self.printer = printer
-        self.error = printer.command_error if printer else Exception
-        try:
-            self.numpy = importlib.import_module('numpy')
-        except ImportError:
-            raise self.error(
-                    "Failed to import `numpy` module, make sure it was "
-                    "installed via `~/klippy-env/bin/pip install` (refer to "
-                    "docs/Measuring_Resonances.md for more details).")
-
-    def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
+def estimate_shaper(np, A, T, test_damping_ratios, test_freqs):
+    # Calculate the remaining vibrations of a set of shapers (one per
+    # row of A and T) for each damping ratio and test frequency.  The
+    # result is indexed by [damping_ratio, shaper, test_freq].
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    T = np.atleast_2d(np.asarray(T, dtype=float))
+    inv_D = 1. / A.sum(axis=-1)
+    damping_ratios = np.asarray(test_damping_ratios, dtype=float)
+    omega = 2. * math.pi * np.asarray(test_freqs, dtype=float)
+    # Arrays are broadcast as [damping_ratio, shaper, test_freq, pulse]
+    damping = (damping_ratios[:, None] * omega)[:, None, :, None]
+    omega_d = (np.sqrt(1. - damping_ratios**2)[:, None]
+               * omega)[:, None, :, None]
+    W = A[None, :, None, :] * np.exp(
+            -damping * (T[:, -1:] - T)[None, :, None, :])
+    phase = omega_d * T[None, :, None, :]
+    S = (W * np.sin(phase)).sum(axis=-1)
+    C = (W * np.cos(phase)).sum(axis=-1)
+    return np.sqrt(S**2 + C**2) * inv_D[None, :, None]
+
+def fit_shaper(np, shaper_cfg, freq_bins, psd_sum, max_smoothing):
+    test_freqs = np.arange(shaper_cfg.min_freq, MAX_SHAPER_FREQ, .2)[::-1]
+
+    psd = psd_sum[freq_bins <= MAX_FREQ]
+    freq_bins = freq_bins[freq_bins <= MAX_FREQ]
+
+    shapers = [shaper_cfg.init_func(test_freq, SHAPER_DAMPING_RATIO)
+               for test_freq in test_freqs]
+    smoothing = [get_shaper_smoothing(shaper) for shaper in shapers]
+    # The search stops at the first frequency with too much smoothing
+    num_freqs = len(test_freqs)
+    if max_smoothing:
+        for i in range(1, num_freqs):
+            if smoothing[i] > max_smoothing:
+                num_freqs = i
+                break
+    # Exact damping ratio of the printer is unknown, pessimizing
+    # remaining vibrations over possible damping values.  Shapers are
+    # evaluated in blocks to limit the size of the intermediate arrays.
+    blocks = []
+    for i in range(0, num_freqs, FIT_BLOCK_SIZE):
+        block = shapers[i:min(i + FIT_BLOCK_SIZE, num_freqs)]
+        blocks.append(estimate_shaper(np, [shaper[0] for shaper in block],
+                                      [shaper[1] for shaper in block],
+                                      TEST_DAMPING_RATIOS, freq_bins))
+    vals = np.concatenate(blocks, axis=1)
+    all_vibrations = (vals * psd).sum(axis=-1) / psd.sum()
+    shaper_vals = vals.max(axis=0)
+    shaper_vibrations = all_vibrations.max(axis=0)
+    # The score trying to minimize vibrations, but also accounting
+    # the growth of smoothing. The formula itself does not have any
+    # special meaning, it simply shows good results on real user data
+    shaper_scores = shaper_vibrations**1.5 * smoothing[:num_freqs]
+
+    best_res = None
+    results = []
+    for i in range(num_freqs):
+        results.append(
+                CalibrationResult(
+                    name=shaper_cfg.name, freq=test_freqs[i],
+                    vals=shaper_vals[i], vibrs=shaper_vibrations[i],
+                    smoothing=smoothing[i], score=shaper_scores[i]))
+        if best_res is None or best_res.vibrs > results[-1].vibrs:
+            # The current frequency is better for the shaper.
+            best_res = results[-1]
+    if num_freqs < len(test_freqs):
+        return best_res
+    # Try to find an 'optimal' shapper configuration: the one that is not
+    # much worse than the 'best' one, but gives much less smoothing
+    selected = best_res
+    for res in results[::-1]:
+        if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
+            selected = res
+    return selected
+
+def fit_shaper_task(args):
+    # Entry point for fitting a shaper in a worker process
+    return fit_shaper(importlib.import_module('numpy'), *args)
+
+def get_window_size(sampling_freq):
+    # Round up to the nearest power of 2 for faster FFT
+    return 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+
+class WelchPSD:
+    # Calculate power spectral density (PSD) using Welch's algorithm,
+    # accumulating the response of each window as the samples are added
+    def __init__(self, np, nfft):
+        self.numpy = np
+        self.nfft = nfft
+        self.window = np.kaiser(nfft, 6.)
+        # Compensation for windowing loss
+        self.scale = 1.0 / (self.window**2).sum()
+        # Split into overlapping windows of size nfft
+        self.overlap = nfft // 2
+        self.step = nfft - self.overlap
+        self.pending = []
+        self.pending_count = 0
+        self.psd = np.zeros((3, nfft // 2 + 1))
+        self.window_count = 0
+    def _split_into_windows(self, x, n_windows):
+        # Memory-efficient algorithm to split an input 'x' into a series
+        # of overlapping windows
+        shape = (self.nfft, n_windows)
+        strides = (x.strides[-1], self.step * x.strides[-1])
+        return self.numpy.lib.stride_tricks.as_strided(
+                x, shape=shape, strides=strides, writeable=False)
+    def _calc_windows(self, x):
+        np = self.numpy
+        # First detrend, then apply windowing function
+        x = self.window[:, None] * (x - np.mean(x, axis=0))
+        # Calculate frequency response for each window using FFT
+        result = np.fft.rfft(x, n=self.nfft, axis=0)
+        result = (np.conjugate(result) * result).real
+        # For one-sided FFT output the response must be doubled, except
+        # the last point for unpaired Nyquist frequency (assuming even nfft)
+        # and the 'DC' term (0 Hz)
+        result[1:-1,:] *= 2.
+        return result.sum(axis=-1) * self.scale
+    def add_samples(self, data):
+        # Add a (N, 3) array of x, y, and z accelerations
+        np = self.numpy
+        self.pending.append(data)
+        self.pending_count += data.shape[0]
+        if self.pending_count < self.nfft:
+            return
+        data = np.concatenate(self.pending)
+        n_windows = (data.shape[0] - self.overlap) // self.step
+        for i in range(0, n_windows, WELCH_BLOCK_SIZE):
+            count = min(WELCH_BLOCK_SIZE, n_windows - i)
+            start = i * self.step
+            end = start + (count - 1) * self.step + self.nfft
+            for axis in range(3):
+                x = np.ascontiguousarray(data[start:end, axis])
+                self.psd[axis] += self._calc_windows(
+                        self._split_into_windows(x, count))
+        self.window_count += n_windows
+        # Keep the samples of the next (incomplete) window
+        rest = data[n_windows * self.step:].copy()
+        self.pending = [rest]
+        self.pending_count = rest.shape[0]
+    def get_calibration_data(self, sampling_freq):
+        np = self.numpy
+        if not self.window_count:
+            return None
+        # Welch's algorithm: average response over windows
+        px, py, pz = self.psd * (1. / (self.window_count * sampling_freq))
+        # Calculate the frequency bins
+        freqs = np.fft.rfftfreq(self.nfft, 1. / sampling_freq)
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
+class PSDStream:
+    # Calculate the frequency response of accelerometer measurements in
+    # a background process while the measurements are being taken
+    def __init__(self, shaper_calibrate):
+        self.shaper_calibrate = shaper_calibrate
+        self.printer = shaper_calibrate.printer
+        self.queue = self.calc_proc = self.result_conn = None
+    def start(self, axes_map, rate):
+        # Start the calculation for a chip with the given axes mapping
+        # (list of (sample index, scale) per axis) and query rate
         import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
+        self.queue = multiprocessing.Queue()
+        self.result_conn, child_conn = multiprocessing.Pipe(False)
         def wrapper():
             queuelogger.clear_bg_logging()
             try:
-                res = method(*args)
+                res = self._calc_psd(axes_map, get_window_size(rate))
             except:
                 child_conn.send((True, traceback.format_exc()))
                 child_conn.close()
                 return
             child_conn.send((False, res))
             child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
+        self.calc_proc = multiprocessing.Process(target=wrapper)
+        self.calc_proc.daemon = True
+        self.calc_proc.start()
+    def add_samples(self, sequence, data):
+        # Called from the serial background thread with raw chip data
+        self.queue.put((sequence, data))
+    def finish(self, results):
+        # Wait for the frequency response of the completed measurements
+        self.queue.put((None, (results.seq_to_time, results.time_per_sample)))
         reactor = self.printer.get_reactor()
         gcode = self.printer.lookup_object("gcode")
         eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
+        while not self.result_conn.poll():
+            if not self.calc_proc.is_alive():
+                self.close()
+                raise self.printer.command_error(
+                    "Error in remote calculation: process exited")
             if eventtime > last_report_time + 5.:
                 last_report_time = eventtime
                 gcode.respond_info("Wait for calculations..", log=False)
             eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
+        is_err, res = self.result_conn.recv()
+        self.close()
         if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
+            raise self.printer.command_error(
+                "Error in remote calculation: %s" % (res,))
+        if res is None:
+            raise self.printer.command_error(
+                "Not enough accelerometer data to calculate resonances")
+        res.set_numpy(self.shaper_calibrate.numpy)
         return res
+    def close(self):
+        if self.calc_proc is None:
+            return
+        if self.calc_proc.is_alive():
+            self.calc_proc.terminate()
+        self.calc_proc.join()
+        self.result_conn.close()
+        self.queue.close()
+        self.queue = self.calc_proc = self.result_conn = None
+    def _calc_psd(self, axes_map, nfft):
+        # Decode the raw measurements and accumulate the PSD
+        np = importlib.import_module('numpy')
+        welch = WelchPSD(np, nfft)
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = axes_map
+        sample_pos = [x_pos, y_pos, z_pos]
+        sample_scale = np.array([x_scale, y_scale, z_scale])
+        first = last = timing = None
+        sample_count = 0
+        while timing is None:
+            # Process all the queued raw measurements at once
+            msgs = [self.queue.get()]
+            while msgs[-1][0] is not None and not self.queue.empty():
+                msgs.append(self.queue.get())
+            if msgs[-1][0] is None:
+                timing = msgs.pop()[1]
+            blocks = [(seq, data[:len(data) - len(data) % 6])
+                      for seq, data in msgs]
+            blocks = [(seq, data) for seq, data in blocks if data]
+            if not blocks:
+                continue
+            if first is None:
+                first = blocks[0][0]
+            last = (blocks[-1][0], len(blocks[-1][1]) // 6)
+            raw = np.frombuffer(b"".join([data for _, data in blocks]),
+                                dtype='<i2').reshape(-1, 3)
+            sample_count += raw.shape[0]
+            welch.add_samples(raw[:, sample_pos] * sample_scale)
+        if first is None:
+            return None
+        seq_to_time, time_per_sample = timing
+        total_time = ((last[0] - first) * seq_to_time
+                      + (last[1] - 1) * time_per_sample)
+        if total_time <= 0.:
+            return None
+        return welch.get_calibration_data(sample_count / total_time)
 
-    def _split_into_windows(self, x, window_size, overlap):
-        # Memory-efficient algorithm to split an input 'x' into a series
-        # of overlapping windows
-        step_between_windows = window_size - overlap
-        n_windows = (x.shape[-1] - overlap) // step_between_windows
-        shape = (window_size, n_windows)
-        strides = (x.strides[-1], step_between_windows * x.strides[-1])
-        return self.numpy.lib.stride_tricks.as_strided(
-                x, shape=shape, strides=strides, writeable=False)
-
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
-        np = self.numpy
-        window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
-        scale = 1.0 / (window**2).sum()
-
-        # Split into overlapping windows of size nfft
-        overlap = nfft // 2
-        x = self._split_into_windows(x, nfft, overlap)
-
-        # First detrend, then apply windowing function
-        x = window[:, None] * (x - np.mean(x, axis=0))
-
-        # Calculate frequency response for each window using FFT
-        result = np.fft.rfft(x, n=nfft, axis=0)
-        result = np.conjugate(result) * result
-        result *= scale / fs
-        # For one-sided FFT output the response must be doubled, except
-        # the last point for unpaired Nyquist frequency (assuming even nfft)
-        # and the 'DC' term (0 Hz)
-        result[1:-1,:] *= 2.
-
-        # Welch's algorithm: average response over windows
-        psd = result.real.mean(axis=-1)
+class ShaperCalibrate:
+    def __init__(self, printer):
+        self.printer = printer
+        self.error = printer.command_error if printer else Exception
+        self.pool = None
+        try:
+            self.numpy = importlib.import_module('numpy')
+        except ImportError:
+            raise self.error(
+                    "Failed to import `numpy` module, make sure it was "
+                    "installed via `~/klippy-env/bin/pip install` (refer to "
+                    "docs/Measuring_Resonances.md for more details).")
 
-        # Calculate the frequency bins
-        freqs = np.fft.rfftfreq(nfft, 1. / fs)
-        return freqs, psd
+    def background_process_exec(self, method, args):
+        if self.printer is None:
+            return method(*args)
+        import mathutil
+        return mathutil.background_process_exec(
+            self.printer, method, args, "Wait for calculations..")
 
     def calc_freq_response(self, raw_values):
         np = self.numpy
@@ -266,17 +458,18 @@ class ShaperCalibrate:
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
         SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        M = get_window_size(SAMPLING_FREQ)
         if N <= M:
             return None
 
         # Calculate PSD (power spectral density) of vibrations per
         # frequency bins (the same bins for X, Y, and Z)
-        fx, px = self._psd(data[:,1], SAMPLING_FREQ, M)
-        fy, py = self._psd(data[:,2], SAMPLING_FREQ, M)
-        fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
-        return CalibrationData(fx, px+py+pz, px, py, pz)
+        welch = WelchPSD(np, M)
+        welch.add_samples(data[:,1:])
+        return welch.get_calibration_data(SAMPLING_FREQ)
+
+    def create_psd_stream(self):
+        return PSDStream(self)
 
     def process_accelerometer_data(self, data):
         calibration_data = self.background_process_exec(
@@ -287,78 +480,50 @@ class ShaperCalibrate:
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
-        np = self.numpy
-
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
-
-        omega = 2. * math.pi * test_freqs
-        damping = test_damping_ratio * omega
-        omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
-
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
-                                       freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
-        remaining_vibrations = (vals * psd).sum() / psd.sum()
-        return (remaining_vibrations, vals)
-
     def fit_shaper(self, shaper_cfg, calibration_data, max_smoothing):
-        np = self.numpy
-
-        test_freqs = np.arange(shaper_cfg.min_freq, MAX_SHAPER_FREQ, .2)
-
-        freq_bins = calibration_data.freq_bins
-        psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
-        freq_bins = freq_bins[freq_bins <= MAX_FREQ]
-
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, SHAPER_DAMPING_RATIO)
-            shaper_smoothing = get_shaper_smoothing(shaper)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_vibrations**1.5 * shaper_smoothing
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
-                # The current frequency is better for the shaper.
-                best_res = results[-1]
-        # Try to find an 'optimal' shapper configuration: the one that is not
-        # much worse than the 'best' one, but gives much less smoothing
-        selected = best_res
-        for res in results[::-1]:
-            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
-                selected = res
-        return selected
+        return fit_shaper(self.numpy, shaper_cfg, calibration_data.freq_bins,
+                          calibration_data.psd_sum, max_smoothing)
+
+    def _get_pool(self):
+        if self.pool is None:
+            initializer = None
+            if self.printer is not None:
+                import queuelogger
+                initializer = queuelogger.clear_bg_logging
+            self.pool = multiprocessing.Pool(initializer=initializer)
+        return self.pool
+
+    def close(self):
+        # Stop the worker processes used for shaper fitting
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _fit_shapers(self, calibration_data, max_smoothing):
+        # Fit all shapers in parallel in the worker processes
+        args = [(shaper_cfg, calibration_data.freq_bins,
+                 calibration_data.psd_sum, max_smoothing)
+                for shaper_cfg in INPUT_SHAPERS]
+        async_res = self._get_pool().map_async(fit_shaper_task, args)
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+            while not async_res.ready():
+                if eventtime > last_report_time + 5.:
+                    last_report_time = eventtime
+                    gcode.respond_info("Wait for calculations..", log=False)
+                eventtime = reactor.pause(eventtime + .1)
+        try:
+            return async_res.get()
+        except Exception as e:
+            raise self.error("Error in remote calculation: %s" % (str(e),))
 
     def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
         best_shaper = None
         all_shapers = []
-        for shaper_cfg in INPUT_SHAPERS:
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
+        for shaper in self._fit_shapers(calibration_data, max_smoothing):
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
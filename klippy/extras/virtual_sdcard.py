@@ -84,6 +84,10 @@ class VirtualSD:
         is_active = self.is_active()
         return {'progress': progress, 'is_active': is_active,
                 'file_position': self.file_position}
+    def get_file_path(self):
+        if self.current_file is None:
+            return None
+        return self.current_file.name
     def is_active(self):
         return self.work_timer is not None
     def do_pause(self):
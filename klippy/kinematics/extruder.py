@@ -48,6 +48,8 @@ class PrinterExtruder:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        # Extruder moves use the same velocity curve as toolhead moves
+        ffi_lib.trapq_set_accel_order(self.trapq, toolhead.get_accel_order())
         self.trapq_append = ffi_lib.trapq_append
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.sk_extruder = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
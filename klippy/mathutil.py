@@ -47,14 +47,14 @@ def coordinate_descent(adj_params, params, error_func):
                  best_err, rounds)
     return params
 
-# Helper to run the coordinate descent function in a background
-# process so that it does not block the main thread.
-def background_coordinate_descent(printer, adj_params, params, error_func):
+# Helper to run a function in a background process so that it does
+# not block the main thread.
+def background_process_exec(printer, method, args, report_msg=None):
     parent_conn, child_conn = multiprocessing.Pipe()
     def wrapper():
         queuelogger.clear_bg_logging()
         try:
-            res = coordinate_descent(adj_params, params, error_func)
+            res = method(*args)
         except:
             child_conn.send((True, traceback.format_exc()))
             child_conn.close()
@@ -70,18 +70,26 @@ def background_coordinate_descent(printer, adj_params, params, error_func):
     gcode = printer.lookup_object("gcode")
     eventtime = last_report_time = reactor.monotonic()
     while calc_proc.is_alive():
-        if eventtime > last_report_time + 5.:
+        if report_msg is not None and eventtime > last_report_time + 5.:
             last_report_time = eventtime
-            gcode.respond_info("Working on calibration...", log=False)
+            gcode.respond_info(report_msg, log=False)
         eventtime = reactor.pause(eventtime + .1)
     # Return results
     is_err, res = parent_conn.recv()
     if is_err:
-        raise Exception("Error in coordinate descent: %s" % (res,))
+        raise printer.command_error(
+            "Error in remote calculation: %s" % (res,))
     calc_proc.join()
     parent_conn.close()
     return res
 
+# Helper to run the coordinate descent function in a background
+# process so that it does not block the main thread.
+def background_coordinate_descent(printer, adj_params, params, error_func):
+    return background_process_exec(
+        printer, coordinate_descent, (adj_params, params, error_func),
+        "Working on calibration...")
+
 
 ######################################################################
 # Trilateration
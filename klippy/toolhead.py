@@ -10,18 +10,37 @@ import mcu, chelper, kinematics.extruder
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
+# Class to track each move request.  If 'arc' is set to (center_x,
+# center_y, angle) the move follows an arc of at most half a turn in
+# the XY plane (counter-clockwise for a positive angle) - its radius
+# changes linearly from the start to the end of the move.  The
+# 'is_transformed' flag marks moves whose end points were adjusted by
+# a move transform that also adjusts the steps between them.
 class Move:
-    def __init__(self, toolhead, start_pos, end_pos, speed):
+    def __init__(self, toolhead, start_pos, end_pos, speed, arc=None,
+                 is_transformed=False):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.timing_callbacks = []
+        self.is_transformed = is_transformed
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
         self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.arc = arc
+        if arc is not None:
+            center_x, center_y, angle = arc
+            self.start_radius = math.hypot(start_pos[0] - center_x,
+                                           start_pos[1] - center_y)
+            self.end_radius = math.hypot(end_pos[0] - center_x,
+                                         end_pos[1] - center_y)
+            arc_d = .5 * (self.start_radius + self.end_radius) * abs(angle)
+            self.move_d = move_d = math.hypot(arc_d, axes_d[2])
+            if move_d < .000000001:
+                self.arc = None
+        if self.arc is None:
+            self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
@@ -37,6 +56,13 @@ class Move:
         else:
             inv_move_d = 1. / move_d
         self.axes_r = [d * inv_move_d for d in axes_d]
+        # Direction at the start and end of the move
+        self.start_axes_r = self.end_axes_r = self.axes_r
+        if self.arc is not None:
+            self._calc_arc_directions(inv_move_d)
+            # Limit the centripetal acceleration to the move acceleration
+            radius = min(self.start_radius, self.end_radius)
+            velocity = min(velocity, math.sqrt(radius * self.accel))
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -46,6 +72,44 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+    def _calc_arc_directions(self, inv_move_d):
+        center_x, center_y, angle = self.arc
+        start_angle = math.atan2(self.start_pos[1] - center_y,
+                                 self.start_pos[0] - center_x)
+        self.angle_r = angle * inv_move_d
+        self.radius_r = (self.end_radius - self.start_radius) * inv_move_d
+        def calc_dir(a, radius):
+            sin_a, cos_a = math.sin(a), math.cos(a)
+            return [self.radius_r * cos_a - radius * self.angle_r * sin_a,
+                    self.radius_r * sin_a + radius * self.angle_r * cos_a,
+                    self.axes_r[2], self.axes_r[3]]
+        self.start_axes_r = calc_dir(start_angle, self.start_radius)
+        self.end_axes_r = calc_dir(start_angle + angle, self.end_radius)
+    def get_arc_extremes(self):
+        # Return the positions on an arc move where it reaches its
+        # furthest extent along the X and Y axes or from the origin
+        center_x, center_y, angle = self.arc
+        start_angle = math.atan2(self.start_pos[1] - center_y,
+                                 self.start_pos[0] - center_x)
+        angles = [i * .5 * math.pi for i in range(4)]
+        origin_angle = math.atan2(center_y, center_x)
+        angles += [origin_angle, origin_angle + math.pi]
+        out = []
+        for a in angles:
+            # Angle traveled from the start of the arc to this angle
+            a_d = (a - start_angle) % (2. * math.pi)
+            if angle < 0.:
+                a_d -= 2. * math.pi
+            if abs(a_d) >= abs(angle):
+                continue
+            r = a_d / angle
+            radius = self.start_radius + (
+                self.end_radius - self.start_radius) * r
+            out.append((center_x + radius * math.cos(a),
+                        center_y + radius * math.sin(a),
+                        self.start_pos[2] + self.axes_d[2] * r,
+                        self.start_pos[3] + self.axes_d[3] * r))
+        return out
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -64,8 +128,8 @@ class Move:
         # Allow extruder to calculate its maximum junction
         extruder_v2 = self.toolhead.extruder.calc_junction(prev_move, self)
         # Find max velocity using "approximated centripetal velocity"
-        axes_r = self.axes_r
-        prev_axes_r = prev_move.axes_r
+        axes_r = self.start_axes_r
+        prev_axes_r = prev_move.end_axes_r
         junction_cos_theta = -(axes_r[0] * prev_axes_r[0]
                                + axes_r[1] * prev_axes_r[1]
                                + axes_r[2] * prev_axes_r[2])
@@ -217,6 +281,8 @@ class ToolHead:
         self.max_accel_to_decel = self.requested_accel_to_decel
         self.square_corner_velocity = config.getfloat(
             'square_corner_velocity', 5., minval=0.)
+        self.accel_order = config.getchoice(
+            'accel_order', {'2': 2, '4': 4, '6': 6}, '2')
         self.config_max_velocity = self.max_velocity
         self.config_max_accel = self.max_accel
         self.config_square_corner_velocity = self.square_corner_velocity
@@ -246,7 +312,11 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        ffi_lib.trapq_set_accel_order(self.trapq, self.accel_order)
+        self.trapq_set_transformed = ffi_lib.trapq_set_transformed
+        self.trapq_transformed = False
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_arc = ffi_lib.trapq_append_arc
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.step_generators = []
         # Create kinematics class
@@ -317,7 +387,17 @@ class ToolHead:
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
         for move in moves:
-            if move.is_kinematic_move:
+            if move.is_transformed != self.trapq_transformed:
+                self.trapq_transformed = move.is_transformed
+                self.trapq_set_transformed(self.trapq, move.is_transformed)
+            if move.arc is not None:
+                self.trapq_append_arc(
+                    self.trapq, next_move_time,
+                    move.accel_t, move.cruise_t, move.decel_t,
+                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
+                    move.arc[0], move.arc[1], move.angle_r, move.radius_r,
+                    move.axes_r[2], move.start_v, move.cruise_v, move.accel)
+            elif move.is_kinematic_move:
                 self.trapq_append(
                     self.trapq, next_move_time,
                     move.accel_t, move.cruise_t, move.decel_t,
@@ -408,12 +488,21 @@ class ToolHead:
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
         self.printer.send_event("toolhead:set_position")
-    def move(self, newpos, speed):
-        move = Move(self, self.commanded_pos, newpos, speed)
+    def move(self, newpos, speed, arc=None, is_transformed=False):
+        move = Move(self, self.commanded_pos, newpos, speed, arc,
+                    is_transformed)
         if not move.move_d:
             return
         if move.is_kinematic_move:
             self.kin.check_move(move)
+        if move.arc is not None:
+            # Check the parts of the arc that may be outside the
+            # range of the start and end positions
+            for pos in move.get_arc_extremes():
+                check_move = Move(self, move.start_pos, pos, speed)
+                self.kin.check_move(check_move)
+                move.limit_speed(math.sqrt(check_move.max_cruise_v2),
+                                 check_move.accel)
         if move.axes_d[3]:
             self.extruder.check_move(move)
         self.commanded_pos[:] = move.end_pos
@@ -537,6 +626,8 @@ class ToolHead:
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
     def get_max_velocity(self):
         return self.max_velocity, self.max_accel
+    def get_accel_order(self):
+        return self.accel_order
     def get_max_axis_halt(self):
         # Determine the maximum velocity a cartesian axis could halt
         # at due to the junction_deviation setting.  The 8.0 was
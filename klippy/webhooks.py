@@ -3,7 +3,7 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json
+import logging, socket, os, sys, errno, json, collections
 import gcode
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
@@ -97,6 +97,12 @@ class WebRequest:
             self.response = {}
         return {"id": self.id, rtype: self.response}
 
+# Number of pending connections the server socket will queue
+SERVER_BACKLOG = 16
+# Maximum number of decoded requests a client may have queued before
+# the server stops reading from its socket
+CLIENT_MAX_PENDING = 32
+
 class ServerSocket:
     def __init__(self, webhooks, printer):
         self.printer = printer
@@ -104,6 +110,9 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        # Round-robin request scheduling
+        self.ready_clients = collections.deque()
+        self.dispatch_timer = None
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -114,20 +123,45 @@ class ServerSocket:
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.setblocking(0)
         self.sock.bind(server_address)
-        self.sock.listen(1)
+        self.sock.listen(SERVER_BACKLOG)
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self._handle_accept)
+        self.dispatch_timer = self.reactor.register_timer(
+            self._dispatch_requests)
         printer.register_event_handler(
             'klippy:disconnect', self._handle_disconnect)
 
     def _handle_accept(self, eventtime):
-        try:
-            sock, addr = self.sock.accept()
-        except socket.error:
-            return
-        sock.setblocking(0)
-        client = ClientConnection(self, sock)
-        self.clients[client.uid] = client
+        # Accept all queued connections
+        while 1:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                return
+            sock.setblocking(0)
+            client = ClientConnection(self, sock)
+            self.clients[client.uid] = client
+
+    def schedule_client(self, client):
+        if client not in self.ready_clients:
+            self.ready_clients.append(client)
+            self.reactor.update_timer(self.dispatch_timer, self.reactor.NOW)
+
+    def _dispatch_requests(self, eventtime):
+        # Start at most one request from each client per pass so that
+        # a single busy client can not starve the others (or the rest
+        # of the reactor) of processing time.
+        ready_clients = self.ready_clients
+        for i in range(len(ready_clients)):
+            client = ready_clients.popleft()
+            if client.start_next_request(eventtime):
+                ready_clients.append(client)
+        if ready_clients:
+            return self.reactor.NOW
+        return self.reactor.NEVER
+
+    def get_stats(self, eventtime):
+        return [c.get_stats(eventtime) for c in self.clients.values()]
 
     def _handle_disconnect(self):
         for client in list(self.clients.values()):
@@ -150,7 +184,9 @@ class ServerSocket:
                 raise
 
     def pop_client(self, client_id):
-        self.clients.pop(client_id, None)
+        client = self.clients.pop(client_id, None)
+        if client in self.ready_clients:
+            self.ready_clients.remove(client)
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -164,6 +200,11 @@ class ClientConnection:
             self.sock.fileno(), self.process_received)
         self.partial_data = self.send_buffer = ""
         self.is_sending_data = False
+        self.pending_requests = collections.deque()
+        self.is_receive_paused = False
+        # Request latency tracking
+        self.request_count = 0
+        self.total_latency = self.max_latency = 0.
         self.set_client_info("?", "New connection")
 
     def set_client_info(self, client_info, state_msg=None):
@@ -181,8 +222,10 @@ class ClientConnection:
         if self.fd_handle is None:
             return
         self.set_client_info(None, "Disconnected")
-        self.reactor.unregister_fd(self.fd_handle)
+        if not self.is_receive_paused:
+            self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        self.pending_requests.clear()
         try:
             self.sock.close()
         except socket.error:
@@ -216,10 +259,42 @@ class ClientConnection:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
                 continue
-            self.reactor.register_callback(
-                lambda e, s=self, wr=web_request: s._process_request(wr))
-
-    def _process_request(self, web_request):
+            self.pending_requests.append((eventtime, web_request))
+        if not self.pending_requests:
+            return
+        if len(self.pending_requests) >= CLIENT_MAX_PENDING:
+            # Stop reading from the socket until the backlog is handled
+            self.reactor.unregister_fd(self.fd_handle)
+            self.is_receive_paused = True
+        self.server.schedule_client(self)
+
+    def start_next_request(self, eventtime):
+        # Invoked by the server to start processing the next request.
+        # Returns True if more requests are pending.
+        if self.is_closed() or not self.pending_requests:
+            return False
+        recv_time, web_request = self.pending_requests.popleft()
+        self.reactor.register_callback(
+            lambda e, s=self, wr=web_request, rt=recv_time:
+            s._process_request(wr, rt))
+        if self.is_receive_paused and not self.pending_requests:
+            self.fd_handle = self.reactor.register_fd(
+                self.sock.fileno(), self.process_received)
+            self.is_receive_paused = False
+        return len(self.pending_requests) > 0
+
+    def get_stats(self, eventtime):
+        avg_latency = 0.
+        if self.request_count:
+            avg_latency = self.total_latency / self.request_count
+        msg = "client_%s: requests=%d pending=%d latency=%.6f max=%.6f" % (
+            self.uid, self.request_count, len(self.pending_requests),
+            avg_latency, self.max_latency)
+        self.request_count = 0
+        self.total_latency = self.max_latency = 0.
+        return msg
+
+    def _process_request(self, web_request, recv_time=None):
         try:
             func = self.webhooks.get_callback(web_request.get_method())
             func(web_request)
@@ -231,6 +306,11 @@ class ClientConnection:
             logging.exception(msg)
             web_request.set_error(WebRequestError(str(e)))
             self.printer.invoke_shutdown(msg)
+        if recv_time is not None:
+            latency = self.reactor.monotonic() - recv_time
+            self.request_count += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
         result = web_request.finish()
         if result is None:
             return
@@ -326,6 +406,13 @@ class WebHooks:
         state_message, state = self.printer.get_state_message()
         return {'state': state, 'state_message': state_message}
 
+    def stats(self, eventtime):
+        client_stats = self.sconn.get_stats(eventtime)
+        if not client_stats:
+            return False, ""
+        return False, "webhooks: clients=%d %s" % (
+            len(client_stats), " ".join(client_stats))
+
     def call_remote_method(self, method, **kwargs):
         if method not in self._remote_methods:
             raise self.printer.command_error(
@@ -386,6 +473,15 @@ class GCodeHelper:
 
 SUBSCRIPTION_REFRESH_TIME = .25
 
+# Printer objects may optionally implement get_status(eventtime, fields)
+# in order to skip building status fields that no client requested.
+def supports_status_fields(obj):
+    func = getattr(obj.get_status, '__func__', obj.get_status)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return False
+    return 'fields' in code.co_varnames[:code.co_argcount]
+
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -402,28 +498,46 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _get_requested_fields(self, msglist):
+        # Build the union of requested fields for each printer object
+        # (a value of None indicates that all fields are needed)
+        req_fields = {}
+        for cconn, subscription, send_func, template in msglist:
+            for obj_name, req_items in subscription.items():
+                if req_items is None:
+                    req_fields[obj_name] = None
+                    continue
+                fields = req_fields.setdefault(obj_name, set())
+                if fields is not None:
+                    fields.update(req_items)
+        return req_fields
+    def _query_object(self, obj_name, fields, eventtime):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        if fields is not None and supports_status_fields(po):
+            return po.get_status(eventtime, fields=fields)
+        return po.get_status(eventtime)
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
+        msglist.extend([c for c in self.clients.values()
+                        if not c[0].is_closed()])
+        for cconn in [c for c in self.clients if c.is_closed()]:
+            del self.clients[cconn]
+        req_fields = self._get_requested_fields(msglist)
         # Generate get_status() info for each client
         for cconn, subscription, send_func, template in msglist:
             is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
-                continue
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res = query[obj_name] = self._query_object(
+                        obj_name, req_fields.get(obj_name), eventtime)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
@@ -0,0 +1,160 @@
+#!/usr/bin/env python2
+# Benchmark G2/G3 arc processing (native arcs and arc segmentation)
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, shutil, math
+
+CONFIG = """
+[stepper_x]
+step_pin: ar54
+dir_pin: ar55
+enable_pin: !ar38
+step_distance: .0125
+endstop_pin: ^ar3
+position_endstop: 0
+position_max: 200
+homing_speed: 50
+
+[stepper_y]
+step_pin: ar60
+dir_pin: !ar61
+enable_pin: !ar56
+step_distance: .0125
+endstop_pin: ^ar14
+position_endstop: 0
+position_max: 200
+homing_speed: 50
+
+[stepper_z]
+step_pin: ar46
+dir_pin: ar48
+enable_pin: !ar62
+step_distance: .0025
+endstop_pin: ^ar18
+position_endstop: 0.5
+position_max: 200
+
+[extruder]
+step_pin: ar26
+dir_pin: ar28
+enable_pin: !ar24
+step_distance: .002
+nozzle_diameter: 0.400
+filament_diameter: 1.750
+heater_pin: ar10
+sensor_type: EPCOS 100K B57560G104F
+sensor_pin: analog13
+control: pid
+pid_Kp: 22.2
+pid_Ki: 1.08
+pid_Kd: 114
+min_temp: 0
+max_temp: 250
+min_extrude_temp: 0
+
+[gcode_arcs]
+resolution: %(resolution).3f
+%(extra)s
+
+[mcu]
+serial: /dev/ttyACM0
+pin_map: arduino
+
+[printer]
+kinematics: cartesian
+max_velocity: 300
+max_accel: 3000
+max_z_velocity: 5
+max_z_accel: 100
+"""
+
+# A bed_tilt with no adjustment forces arcs to be split into segments
+TESTS = [
+    ("native", ""),
+    ("segmented", "[bed_tilt]"),
+    ("tolerance", "chord_tolerance: %(tolerance).3f\n\n[bed_tilt]"),
+]
+
+
+######################################################################
+# Test file generation
+######################################################################
+
+def write_gcode(fname, count):
+    # Concentric circles and half circles of varying radius
+    f = open(fname, 'wb')
+    f.write("G28\nG1 Z5 F600\nM83\nG1 X100 Y100 F6000\n")
+    for i in range(count):
+        radius = 5. + 75. * (i % 16) / 15.
+        f.write("G1 X%.3f Y100 F6000\n" % (100. - radius,))
+        if i & 1:
+            f.write("G2 X%.3f Y100 I%.3f J0 E%.5f\n" % (
+                100. + radius, radius, math.pi * radius * .03))
+        else:
+            f.write("G3 X%.3f Y100 I%.3f J0 E%.5f\n" % (
+                100. - radius, radius, 2. * math.pi * radius * .03))
+    f.close()
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def run_klippy(tempdir, name, extra, options, gcode_fname, dict_fname):
+    klippy_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              '..', 'klippy')
+    cfg_fname = os.path.join(tempdir, name + ".cfg")
+    f = open(cfg_fname, 'wb')
+    params = {'resolution': options.resolution, 'tolerance': options.tolerance}
+    f.write(CONFIG % dict(params, extra=extra % params))
+    f.close()
+    output_fname = os.path.join(tempdir, name + ".serial")
+    log_fname = os.path.join(tempdir, name + ".log")
+    args = [sys.executable, os.path.join(klippy_dir, 'klippy.py'), cfg_fname,
+            '-i', gcode_fname, '-o', output_fname, '-d', dict_fname,
+            '-l', log_fname]
+    start = os.times()
+    res = subprocess.call(args)
+    end = os.times()
+    if res:
+        sys.stderr.write("klippy failed - see %s\n" % (log_fname,))
+        sys.exit(-1)
+    cpu_time = (end[2] - start[2]) + (end[3] - start[3])
+    return cpu_time, os.path.getsize(output_fname)
+
+def main():
+    usage = "%prog [options] <data dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--arcs", type="int", dest="arcs", default=500,
+                    help="number of arcs in the test print (default 500)")
+    opts.add_option("-r", "--resolution", type="float", dest="resolution",
+                    default=1., help="arc resolution in mm (default 1.0)")
+    opts.add_option("-t", "--tolerance", type="float", dest="tolerance",
+                    default=.01, help="arc chord tolerance in mm"
+                    " (default 0.01)")
+    opts.add_option("-k", "--keep", action="store_true", dest="keep",
+                    help="keep the generated files")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    dict_fname = os.path.abspath(args[0])
+    tempdir = tempfile.mkdtemp(prefix="bench_arcs_")
+    try:
+        gcode_fname = os.path.join(tempdir, "arcs.gcode")
+        write_gcode(gcode_fname, options.arcs)
+        for name, extra in TESTS:
+            cpu_time, out_size = run_klippy(tempdir, name, extra, options,
+                                            gcode_fname, dict_fname)
+            print("%-10s arcs=%-6d host_cpu=%.3fs arcs/sec=%-8.1f"
+                  " mcu_bytes=%d" % (name, options.arcs, cpu_time,
+                                     options.arcs / cpu_time, out_size))
+    finally:
+        if options.keep:
+            print("Files kept in %s" % (tempdir,))
+        else:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python2
+# Benchmark bed_mesh move splitting against step generation adjustment
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, shutil, math
+KLIPPY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'klippy')
+sys.path.append(KLIPPY_DIR)
+import chelper
+from extras import bed_mesh
+import bench_stepgen
+
+CONFIG = """
+[stepper_x]
+step_pin: ar54
+dir_pin: ar55
+enable_pin: !ar38
+step_distance: .0125
+endstop_pin: ^ar3
+position_endstop: 0
+position_max: 200
+homing_speed: 50
+
+[stepper_y]
+step_pin: ar60
+dir_pin: !ar61
+enable_pin: !ar56
+step_distance: .0125
+endstop_pin: ^ar14
+position_endstop: 0
+position_max: 200
+homing_speed: 50
+
+[stepper_z]
+step_pin: ar46
+dir_pin: ar48
+enable_pin: !ar62
+step_distance: .0025
+endstop_pin: ^ar18
+position_endstop: 0.5
+position_max: 200
+
+[extruder]
+step_pin: ar26
+dir_pin: ar28
+enable_pin: !ar24
+step_distance: .002
+nozzle_diameter: 0.400
+filament_diameter: 1.750
+heater_pin: ar10
+sensor_type: EPCOS 100K B57560G104F
+sensor_pin: analog13
+control: pid
+pid_Kp: 22.2
+pid_Ki: 1.08
+pid_Kd: 114
+min_temp: 0
+max_temp: 250
+min_extrude_temp: 0
+
+[bed_mesh]
+mesh_min: 10,10
+mesh_max: 190,190
+probe_count: %(count)d,%(count)d
+algorithm: bicubic
+kinematic_transform: %(kinematic)s
+
+[bed_mesh default]
+version = 1
+points =
+%(points)s
+x_count = %(count)d
+y_count = %(count)d
+mesh_x_pps = 2
+mesh_y_pps = 2
+algo = bicubic
+tension = 0.2
+min_x = 10.0
+max_x = 190.0
+min_y = 10.0
+max_y = 190.0
+
+[mcu]
+serial: /dev/ttyACM0
+pin_map: arduino
+
+[printer]
+kinematics: cartesian
+max_velocity: 300
+max_accel: 3000
+max_z_velocity: 5
+max_z_accel: 100
+"""
+
+MESH_COUNT = 7
+MESH_WARP = .400
+
+
+######################################################################
+# Test file generation
+######################################################################
+
+def calc_warp(x, y):
+    # A bed that is bowed in the middle and twisted at the corners
+    u = (x - 100.) / 90.
+    v = (y - 100.) / 90.
+    return MESH_WARP * (.5 * (1. - u*u) * (1. - v*v) + .25 * u * v)
+
+def gen_mesh_points():
+    out = []
+    for j in range(MESH_COUNT):
+        y = 10. + 180. * j / (MESH_COUNT - 1)
+        out.append("  " + ", ".join([
+            "%.6f" % (calc_warp(10. + 180. * i / (MESH_COUNT - 1), y),)
+            for i in range(MESH_COUNT)]))
+    return "\n".join(out)
+
+def gen_moves(layers, lines):
+    # Zig-zag infill pattern covering most of the bed on each layer
+    moves = []
+    for layer in range(layers):
+        z = .2 + .2 * layer
+        moves.append((20., 20., z))
+        for i in range(lines):
+            y = 20. + 160. * i / (lines - 1)
+            if (i + layer) & 1:
+                moves.append((20., y, z))
+                moves.append((180., y, z))
+            else:
+                moves.append((180., y, z))
+                moves.append((20., y, z))
+    return moves
+
+def write_gcode(fname, moves):
+    f = open(fname, 'wb')
+    f.write("G28\nG1 Z5 F600\nM83\nG1 X20 Y20 F6000\n")
+    last = moves[0]
+    for x, y, z in moves:
+        dist = math.sqrt((x - last[0])**2 + (y - last[1])**2)
+        f.write("G1 X%.3f Y%.3f Z%.3f E%.5f F6000\n" % (x, y, z, dist * .03))
+        last = (x, y, z)
+    f.close()
+
+
+######################################################################
+# Move count calculation
+######################################################################
+
+class BenchConfig:
+    def getfloat(self, option, default, minval=None):
+        return default
+
+def build_zmesh():
+    params = {'min_x': 10., 'max_x': 190., 'min_y': 10., 'max_y': 190.,
+              'x_count': MESH_COUNT, 'y_count': MESH_COUNT,
+              'mesh_x_pps': 2, 'mesh_y_pps': 2, 'algo': 'bicubic',
+              'tension': .2}
+    zmesh = bed_mesh.ZMesh(params)
+    zmesh.build_mesh([[calc_warp(10. + 180. * i / (MESH_COUNT - 1),
+                                 10. + 180. * j / (MESH_COUNT - 1))
+                       for i in range(MESH_COUNT)]
+                      for j in range(MESH_COUNT)])
+    return zmesh
+
+def count_split_moves(moves):
+    zmesh = build_zmesh()
+    splitter = bed_mesh.MoveSplitter(BenchConfig(), None)
+    splitter.initialize(zmesh)
+    count = 0
+    last_pos = [moves[0][0], moves[0][1], moves[0][2], 0.]
+    for x, y, z in moves:
+        newpos = [x, y, z, 0.]
+        splitter.build_move(last_pos, newpos, 1.)
+        while splitter.split() is not None:
+            count += 1
+        last_pos = newpos
+    return count
+
+
+######################################################################
+# Step generation check
+######################################################################
+
+CHECK_STEP_DIST = .0025
+CHECK_FADE_START = 1.
+CHECK_FADE_END = 10.
+CHECK_TOLERANCE = .0005
+
+def check_kinematic_transform(tempdir):
+    # Generate the z steps of a single move along X (with accel,
+    # cruise, and decel parts) in the fade region of the mesh and
+    # compare the position of each step to ZMesh.calc_z().  A following
+    # move that wasn't queued by bed_mesh (such as a homing move) must
+    # not move the z stepper.
+    ffi_main, ffi_lib = chelper.get_ffi()
+    zmesh = build_zmesh()
+    start_x, end_x, y, gcode_z = 20., 180., 60., 2.
+    velocity, accel = 100., 1000.
+    factor = ((CHECK_FADE_END - gcode_z)
+              / (CHECK_FADE_END - CHECK_FADE_START))
+    def calc_toolhead_z(x):
+        return gcode_z + factor * zmesh.calc_z(x, y)
+    # The host only adds the mesh adjustment at the end of each move
+    tq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    ffi_lib.trapq_set_transformed(tq, 1)
+    accel_t = velocity / accel
+    accel_d = .5 * velocity * accel_t
+    dist = end_x - start_x
+    cruise_t = (dist - 2. * accel_d) / velocity
+    start_z, end_z = calc_toolhead_z(start_x), calc_toolhead_z(end_x)
+    move_d = math.sqrt(dist**2 + (end_z - start_z)**2)
+    print_time = 1.
+    ffi_lib.trapq_append(tq, print_time, accel_t, cruise_t, accel_t,
+                         start_x, y, start_z, dist / move_d, 0.,
+                         (end_z - start_z) / move_d, 0., velocity, accel)
+    move_t = 2. * accel_t + cruise_t
+    ffi_lib.trapq_set_transformed(tq, 0)
+    ffi_lib.trapq_append(tq, print_time + move_t, accel_t, cruise_t, accel_t,
+                         end_x, y, end_z, -1., 0., 0., 0., velocity, accel)
+    def calc_x(t):
+        t -= print_time
+        if t < accel_t:
+            return start_x + .5 * accel * t**2
+        if t < accel_t + cruise_t:
+            return start_x + accel_d + velocity * (t - accel_t)
+        t = min(2. * accel_t + cruise_t - t, accel_t)
+        return end_x - .5 * accel * t**2
+    # Generate the steps
+    orig_sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc('z'), ffi_lib.free)
+    sk = ffi_main.gc(ffi_lib.bed_mesh_alloc(), ffi_lib.bed_mesh_free)
+    ffi_lib.bed_mesh_set_sk(sk, orig_sk)
+    z_table = [z for line in zmesh.mesh_matrix for z in line]
+    ffi_lib.bed_mesh_set_mesh(sk, z_table, zmesh.mesh_x_count,
+                              zmesh.mesh_y_count, zmesh.mesh_x_min,
+                              zmesh.mesh_y_min, zmesh.mesh_x_max,
+                              zmesh.mesh_y_max)
+    ffi_lib.bed_mesh_set_fade(sk, CHECK_FADE_START, CHECK_FADE_END, 0.)
+    sc = ffi_main.gc(ffi_lib.stepcompress_alloc(0), ffi_lib.stepcompress_free)
+    ffi_lib.stepcompress_fill(sc, 0, 0, bench_stepgen.QUEUE_STEP_TAG,
+                              bench_stepgen.SET_NEXT_STEP_DIR_TAG)
+    ffi_lib.itersolve_set_trapq(sk, tq)
+    ffi_lib.itersolve_set_stepcompress(sk, sc, CHECK_STEP_DIST)
+    ffi_lib.itersolve_set_position(sk, start_x, y, start_z)
+    out_fname = os.path.join(tempdir, "check.serial")
+    bench_stepgen.flush_steps([(sk, sc)], print_time + 2. * move_t,
+                              out_fname)
+    steps, msg_count = bench_stepgen.decode_steps(out_fname)
+    # A step is taken when the stepper passes half a step distance
+    max_err = max_err_x = 0.
+    pos = start_z
+    z_steps = steps.get(0, [])
+    end_clock = (print_time + move_t) * bench_stepgen.MCU_FREQ
+    untagged_steps = len([c for c, sdir in z_steps if c > end_clock])
+    for clock, sdir in z_steps:
+        if clock > end_clock:
+            break
+        step_d = sdir and CHECK_STEP_DIST or -CHECK_STEP_DIST
+        x = calc_x(clock / bench_stepgen.MCU_FREQ)
+        err = abs(pos + .5 * step_d - calc_toolhead_z(x))
+        if err > max_err:
+            max_err, max_err_x = err, x
+        pos += step_d
+    print("kinematic_transform check: z_steps=%d max_error=%.4fmm at"
+          " X%.3f (accel ends at X%.3f) untagged_z_steps=%d" % (
+              len(z_steps) - untagged_steps, max_err, max_err_x,
+              start_x + accel_d, untagged_steps))
+    return max_err <= CHECK_TOLERANCE and not untagged_steps
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def run_klippy(tempdir, name, kinematic, gcode_fname, dict_fname):
+    cfg_fname = os.path.join(tempdir, name + ".cfg")
+    f = open(cfg_fname, 'wb')
+    f.write(CONFIG % {'count': MESH_COUNT, 'points': gen_mesh_points(),
+                      'kinematic': kinematic})
+    f.close()
+    output_fname = os.path.join(tempdir, name + ".serial")
+    log_fname = os.path.join(tempdir, name + ".log")
+    args = [sys.executable, os.path.join(KLIPPY_DIR, 'klippy.py'), cfg_fname,
+            '-i', gcode_fname, '-o', output_fname, '-d', dict_fname,
+            '-l', log_fname]
+    start = os.times()
+    res = subprocess.call(args)
+    end = os.times()
+    if res:
+        sys.stderr.write("klippy failed - see %s\n" % (log_fname,))
+        sys.exit(-1)
+    cpu_time = (end[2] - start[2]) + (end[3] - start[3])
+    return cpu_time, os.path.getsize(output_fname)
+
+def main():
+    usage = "%prog [options] <data dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-l", "--layers", type="int", dest="layers", default=5,
+                    help="number of layers in the test print (default 5)")
+    opts.add_option("-n", "--lines", type="int", dest="lines", default=200,
+                    help="infill lines per layer (default 200)")
+    opts.add_option("-k", "--keep", action="store_true", dest="keep",
+                    help="keep the generated files")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    dict_fname = os.path.abspath(args[0])
+    tempdir = tempfile.mkdtemp(prefix="bench_bed_mesh_")
+    try:
+        if not check_kinematic_transform(tempdir):
+            sys.stderr.write("kinematic_transform does not follow the"
+                             " mesh\n")
+            sys.exit(-1)
+        moves = gen_moves(options.layers, options.lines)
+        gcode_fname = os.path.join(tempdir, "warped.gcode")
+        write_gcode(gcode_fname, moves)
+        print("%d gcode moves on a bed with %.3fmm of warp" % (
+            len(moves), MESH_WARP))
+        tests = [("split", False, count_split_moves(moves)),
+                 ("kinematic", True, len(moves))]
+        for name, kinematic, move_count in tests:
+            cpu_time, out_size = run_klippy(tempdir, name, kinematic,
+                                            gcode_fname, dict_fname)
+            print("%-10s toolhead_moves=%-7d host_cpu=%.3fs mcu_bytes=%d" % (
+                name, move_count, cpu_time, out_size))
+    finally:
+        if options.keep:
+            print("Files kept in %s" % (tempdir,))
+        else:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
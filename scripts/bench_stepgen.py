@@ -0,0 +1,366 @@
+#!/usr/bin/env python2
+# Benchmark and verify host step generation
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, tempfile, shutil, time, math
+KLIPPY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'klippy')
+sys.path.append(KLIPPY_DIR)
+import chelper, msgproto
+
+MCU_FREQ = 16000000.
+STEP_DIST = .0125
+MAX_ACCEL = 3000.
+MAX_VELOCITY = 200.
+JUNCTION_V = 5.
+EXTRUDE_RATIO = .05
+PRESSURE_ADVANCE = .05
+PRESSURE_ADVANCE_SMOOTH_TIME = .040
+FLUSH_TIME = .050
+
+QUEUE_STEP_TAG = 1
+SET_NEXT_STEP_DIR_TAG = 2
+
+
+######################################################################
+# Test move generation
+######################################################################
+
+def gen_path(count, center_x, center_y, radius, z):
+    # Zig-zag infill lines followed by a circle made of short segments
+    path = [(center_x - radius, center_y - radius, z)]
+    for i in range(count):
+        y = center_y - radius + 2. * radius * i / (count - 1)
+        if i & 1:
+            path.extend([(center_x + radius, y, z), (center_x - radius, y, z)])
+        else:
+            path.extend([(center_x - radius, y, z), (center_x + radius, y, z)])
+    for i in range(count * 10 + 1):
+        angle = 2. * math.pi * i / (count * 10)
+        path.append((center_x + radius * math.cos(angle),
+                     center_y + radius * math.sin(angle), z))
+    return path
+
+def fill_trapq(ffi_lib, tq, path, extrude=False):
+    # Append a trapezoid move between each point on the path (or the
+    # matching extruder moves if 'extrude' is set)
+    print_time = 2.
+    lx, ly, lz = path[0]
+    e = 0.
+    for x, y, z in path[1:]:
+        dist = math.sqrt((x - lx)**2 + (y - ly)**2 + (z - lz)**2)
+        if not dist:
+            continue
+        v = JUNCTION_V
+        cruise_v = min(MAX_VELOCITY,
+                       math.sqrt(v*v + MAX_ACCEL * dist))
+        accel_t = (cruise_v - v) / MAX_ACCEL
+        accel_d = (v + cruise_v) * .5 * accel_t
+        cruise_t = (dist - 2. * accel_d) / cruise_v
+        if extrude:
+            r = EXTRUDE_RATIO
+            ffi_lib.trapq_append(tq, print_time, accel_t, cruise_t, accel_t,
+                                 e, 0., 0., 1., PRESSURE_ADVANCE, 0.,
+                                 v * r, cruise_v * r, MAX_ACCEL * r)
+            e += dist * r
+        else:
+            ffi_lib.trapq_append(tq, print_time, accel_t, cruise_t, accel_t,
+                                 lx, ly, lz, (x - lx) / dist,
+                                 (y - ly) / dist, (z - lz) / dist,
+                                 v, cruise_v, MAX_ACCEL)
+        print_time += 2. * accel_t + cruise_t
+        lx, ly, lz = x, y, z
+    return print_time
+
+
+######################################################################
+# Step generation
+######################################################################
+
+def delta_towers(arm, radius, angles):
+    return [(arm**2, math.cos(math.radians(a)) * radius,
+             math.sin(math.radians(a)) * radius) for a in angles]
+
+# Name: (alloc function, alloc parameters for each stepper,
+#        step distance, test path center_x/center_y/radius/z)
+KINEMATICS = {
+    'cartesian': ('cartesian_stepper_alloc', [('x',), ('y',)],
+                  STEP_DIST, (100., 100., 80., 0.)),
+    'corexy': ('corexy_stepper_alloc', [('+',), ('-',)],
+               STEP_DIST, (100., 100., 80., 0.)),
+    'delta': ('delta_stepper_alloc',
+              delta_towers(250., 140., [210., 330., 90.]), STEP_DIST,
+              (0., 0., 60., 20.)),
+    'rotary_delta': ('rotary_delta_stepper_alloc',
+                     [(33.9, 412.9, math.radians(a), 170., 320.)
+                      for a in [30., 150., 270.]],
+                     .0005, (0., 0., 40., 20.)),
+    'winch': ('winch_stepper_alloc',
+              [(0., -300., 0.), (260., 150., 0.), (-260., 150., 0.),
+               (0., 0., 400.)],
+              STEP_DIST, (0., 0., 80., 50.)),
+    # Extrusion with pressure advance along the cartesian test path
+    'extruder': ('extruder_stepper_alloc', [()],
+                 .002, (100., 100., 20., 0.)),
+}
+
+# Solver name: function used to select it (if not the iterative solver)
+SOLVERS = [
+    ('iterative', None),
+    ('closed', 'itersolve_set_closed_form'),
+    ('batch', 'itersolve_set_batch'),
+]
+
+# Input shapers (type, frequency) tested on the cartesian style kinematics
+SHAPERS = [('ei', 40.), ('3hump_ei', 40.)]
+SHAPED_KINEMATICS = ['cartesian', 'corexy']
+
+def setup_solver(ffi_lib, sk, solver):
+    # Returns False if the solver is not supported by the kinematics
+    ffi_lib.itersolve_set_closed_form(sk, 0)
+    ffi_lib.itersolve_set_batch(sk, 0)
+    func = dict(SOLVERS)[solver]
+    return func is None or not getattr(ffi_lib, func)(sk, 1)
+
+def setup_shaper(ffi_main, ffi_lib, orig_sk, shaper):
+    # Wrap the stepper kinematics with an input shaper on both axes
+    shaper_name, shaper_freq = shaper
+    shaper_type = getattr(ffi_lib, 'INPUT_SHAPER_' + shaper_name.upper())
+    sk = ffi_main.gc(ffi_lib.input_shaper_alloc(), ffi_lib.free)
+    ffi_lib.input_shaper_set_sk(sk, orig_sk)
+    ffi_lib.input_shaper_set_shaper_params(sk, shaper_type, shaper_type,
+                                           shaper_freq, shaper_freq, .1, .1)
+    return sk
+
+def gen_steps(kinematics, solver, path, max_error, out_fname, shaper=None):
+    # Generate the steps for each stepper and write the resulting
+    # queue_step messages to the given file (returns None if the
+    # solver is not supported by the kinematics)
+    ffi_main, ffi_lib = chelper.get_ffi()
+    tq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    is_extruder = kinematics == 'extruder'
+    end_time = fill_trapq(ffi_lib, tq, path, is_extruder)
+    alloc_func, alloc_params, step_dist, test_path = KINEMATICS[kinematics]
+    steppers = []
+    orig_sks = []
+    for oid, params in enumerate(alloc_params):
+        sk = ffi_main.gc(getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
+        if not setup_solver(ffi_lib, sk, solver):
+            return None
+        if shaper is not None:
+            # The original kinematics must outlive the shaper
+            orig_sks.append(sk)
+            sk = setup_shaper(ffi_main, ffi_lib, sk, shaper)
+        if is_extruder:
+            ffi_lib.extruder_set_smooth_time(sk, PRESSURE_ADVANCE_SMOOTH_TIME)
+        sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                         ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(sc, max_error, 0, QUEUE_STEP_TAG,
+                                  SET_NEXT_STEP_DIR_TAG)
+        ffi_lib.itersolve_set_trapq(sk, tq)
+        ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+        if is_extruder:
+            ffi_lib.itersolve_set_position(sk, 0., 0., 0.)
+        else:
+            ffi_lib.itersolve_set_position(sk, *path[0])
+        steppers.append((sk, sc))
+    solve_time, compress_time = flush_steps(steppers, end_time, out_fname)
+    positions = [ffi_lib.itersolve_get_commanded_pos(sk)
+                 for sk, sc in steppers]
+    return solve_time, compress_time, positions
+
+def flush_steps(steppers, end_time, out_fname):
+    # Generate the steps of a list of (stepper_kinematics, stepcompress)
+    # up to 'end_time' and write the queue_step messages to a file
+    ffi_main, ffi_lib = chelper.get_ffi()
+    f = open(out_fname, 'wb')
+    sq = ffi_lib.serialqueue_alloc(f.fileno(), 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000.,
+                                      ffi_lib.get_monotonic(), 0)
+    sc_list = ffi_main.new('struct stepcompress *[]',
+                           [sc for sk, sc in steppers])
+    ss = ffi_lib.steppersync_alloc(sq, sc_list, len(steppers), 1000)
+    ffi_lib.steppersync_set_time(ss, 0., MCU_FREQ)
+    # Run step generation (the solver and step compression times are
+    # reported separately)
+    solve_time = compress_time = 0.
+    flush_time = 0.
+    while flush_time < end_time + FLUSH_TIME:
+        flush_time += FLUSH_TIME
+        start = time.time()
+        for sk, sc in steppers:
+            ret = ffi_lib.itersolve_generate_steps(sk, flush_time)
+            if ret:
+                raise Exception("Internal error in stepcompress")
+        solve_time += time.time() - start
+        start = time.time()
+        ret = ffi_lib.steppersync_flush(ss, int(flush_time * MCU_FREQ))
+        if ret:
+            raise Exception("Internal error in stepcompress")
+        compress_time += time.time() - start
+    # Wait for the messages to be written to the output file
+    stats = ffi_main.new('char[4096]')
+    while 1:
+        ffi_lib.serialqueue_get_stats(sq, stats, len(stats))
+        params = dict([p.split('=', 1)
+                       for p in ffi_main.string(stats).split()])
+        if params['ready_bytes'] == params['stalled_bytes'] == '0':
+            break
+        time.sleep(.001)
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.steppersync_free(ss)
+    ffi_lib.serialqueue_free(sq)
+    f.close()
+    return solve_time, compress_time
+
+
+######################################################################
+# Step message decoding
+######################################################################
+
+def decode_steps(fname):
+    # Return a dictionary of oid to a list of (clock, dir) steps and
+    # the number of queue_step messages
+    queue_step = msgproto.MessageFormat(
+        QUEUE_STEP_TAG, "queue_step oid=%c interval=%u count=%hu add=%hi")
+    set_dir = msgproto.MessageFormat(
+        SET_NEXT_STEP_DIR_TAG, "set_next_step_dir oid=%c dir=%c")
+    f = open(fname, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    steps = {}
+    msg_count = 0
+    clocks = {}
+    dirs = {}
+    pos = 0
+    while pos < len(data):
+        msglen = data[pos + msgproto.MESSAGE_POS_LEN]
+        mpos = pos + msgproto.MESSAGE_HEADER_SIZE
+        mend = pos + msglen - msgproto.MESSAGE_TRAILER_SIZE
+        while mpos < mend:
+            msgid = data[mpos]
+            if msgid == QUEUE_STEP_TAG:
+                params, mpos = queue_step.parse(data, mpos)
+                msg_count += 1
+                oid = params['oid']
+                clock = clocks.get(oid, 0)
+                interval, add = params['interval'], params['add']
+                sdir = dirs.get(oid, 0)
+                out = steps.setdefault(oid, [])
+                for i in range(params['count']):
+                    clock += interval
+                    interval += add
+                    out.append((clock, sdir))
+                clocks[oid] = clock
+            elif msgid == SET_NEXT_STEP_DIR_TAG:
+                params, mpos = set_dir.parse(data, mpos)
+                dirs[params['oid']] = params['dir']
+            else:
+                raise Exception("Unknown message id %d" % (msgid,))
+        pos += msglen
+    return steps, msg_count
+
+def compare_steps(steps1, steps2, tolerance):
+    # Return the number of steps that do not match
+    errors = 0
+    for oid in sorted(set(steps1) | set(steps2)):
+        s1, s2 = steps1.get(oid, []), steps2.get(oid, [])
+        if len(s1) != len(s2):
+            sys.stderr.write("oid %d: %d steps vs %d steps\n" % (
+                oid, len(s1), len(s2)))
+            errors += abs(len(s1) - len(s2))
+        for (c1, d1), (c2, d2) in zip(s1, s2):
+            if d1 != d2 or abs(c1 - c2) > tolerance:
+                if not errors:
+                    sys.stderr.write("oid %d: step %d/%d vs %d/%d\n" % (
+                        oid, c1, d1, c2, d2))
+                errors += 1
+    return errors
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def run_test(tempdir, kinematics, solver, path, max_error, shaper=None):
+    # Run and report a single step generation test
+    name = solver
+    if shaper is not None:
+        name = shaper[0]
+    out_fname = os.path.join(tempdir, "%s_%s.serial" % (kinematics, name))
+    res = gen_steps(kinematics, solver, path, max_error, out_fname, shaper)
+    if res is None:
+        return None
+    solve_time, compress_time, positions = res
+    steps, msg_count = decode_steps(out_fname)
+    step_count = sum([len(s) for s in steps.values()])
+    print("%-12s %-10s steps=%-8d solve_time=%.3fs steps/sec=%.0f" % (
+        kinematics, name, step_count, solve_time, step_count / solve_time))
+    # Report the mcu link bandwidth used by the steps
+    print("%-12s %-10s queue_steps=%-7d steps/msg=%-6.1f compress_time=%.3fs"
+          " mcu_bytes=%d" % ('', '', msg_count,
+                             float(step_count) / max(1, msg_count),
+                             compress_time, os.path.getsize(out_fname)))
+    return name, steps, positions
+
+def check_positions(kinematics, name, base_pos, positions):
+    # Return 1 if the final stepper positions differ
+    if max([abs(p1 - p2) for p1, p2 in zip(base_pos, positions)]) > .000001:
+        sys.stderr.write("%s %s: final positions differ (%s vs %s)\n" % (
+            kinematics, name, base_pos, positions))
+        return 1
+    return 0
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--lines", type="int", dest="lines", default=100,
+                    help="infill lines in the test path (default 100)")
+    opts.add_option("-e", "--max-error", type="int", dest="max_error",
+                    default=0,
+                    help="stepcompress max_error in mcu ticks (default 0)")
+    options, args = opts.parse_args()
+    if len(args) != 0:
+        opts.error("Incorrect number of arguments")
+    # All solvers place each step within 1nm of the ideal position.
+    # At low stepper speeds that can be a few mcu ticks, so allow a
+    # small difference on top of the compression error.
+    tolerance = 2 * options.max_error + 5
+    tempdir = tempfile.mkdtemp(prefix="bench_stepgen_")
+    errors = 0
+    try:
+        for kinematics in sorted(KINEMATICS):
+            path = gen_path(options.lines, *KINEMATICS[kinematics][3])
+            results = [run_test(tempdir, kinematics, solver, path,
+                                options.max_error)
+                       for solver, func in SOLVERS]
+            results = [res for res in results if res is not None]
+            # Compare the results against the iterative solver
+            base_solver, base_steps, base_pos = results[0]
+            for solver, steps, positions in results[1:]:
+                mismatch = compare_steps(base_steps, steps, tolerance)
+                mismatch += check_positions(kinematics, solver,
+                                            base_pos, positions)
+                if mismatch:
+                    sys.stderr.write("%s %s: %d step timing mismatches\n" % (
+                        kinematics, solver, mismatch))
+                errors += mismatch
+            if kinematics not in SHAPED_KINEMATICS:
+                continue
+            # Shaped steps differ from the unshaped steps, but the
+            # final positions must be the same
+            for shaper in SHAPERS:
+                name, steps, positions = run_test(
+                    tempdir, kinematics, 'iterative', path,
+                    options.max_error, shaper)
+                errors += check_positions(kinematics, name,
+                                          base_pos, positions)
+    finally:
+        shutil.rmtree(tempdir)
+    if errors:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
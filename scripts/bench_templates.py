@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+# Benchmark rendering of the default display templates
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, collections
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import configfile
+from extras import gcode_macro
+from extras.display import display, uc1701
+
+Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
+
+######################################################################
+# Simulated printer
+######################################################################
+
+class BenchStatus:
+    def __init__(self, status):
+        self.status = status
+    def get_status(self, eventtime):
+        return self.status
+
+class BenchGCode:
+    error = Exception
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        pass
+    def run_script_from_command(self, script):
+        pass
+
+class BenchReactor:
+    def monotonic(self):
+        return time.time()
+
+class BenchPrinter:
+    config_error = command_error = Exception
+    def __init__(self):
+        self.reactor = BenchReactor()
+        self.objects = collections.OrderedDict()
+        self.objects['gcode'] = BenchGCode()
+    def get_reactor(self):
+        return self.reactor
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=configfile.sentinel):
+        if name in self.objects:
+            return self.objects[name]
+        if default is configfile.sentinel:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def load_object(self, config, section):
+        if section not in self.objects:
+            self.objects[section] = gcode_macro.load_config(config)
+        return self.objects[section]
+
+class BenchIO:
+    def __init__(self):
+        self.bytes_sent = 0
+    def send(self, cmds, is_data=False):
+        self.bytes_sent += len(cmds)
+
+class BenchDisplay:
+    def __init__(self):
+        self.io = BenchIO()
+        self.lcd_chip = uc1701.DisplayBase(self.io)
+        self.lcd_chip.set_glyphs({})
+    draw_text = display.PrinterLCD.__dict__['draw_text']
+    draw_progress_bar = display.PrinterLCD.__dict__['draw_progress_bar']
+
+def setup_printer():
+    printer = BenchPrinter()
+    printer.add_object('gcode_macro', gcode_macro.PrinterGCodeMacro(
+        configfile.ConfigWrapper(printer, None, {}, 'gcode_macro')))
+    statuses = {
+        'toolhead': {'extruder': 'extruder', 'estimated_print_time': 0.,
+                     'position': Coord(10., 20., .3, 0.),
+                     'homed_axes': 'xyz'},
+        'extruder': {'temperature': 210., 'target': 210.},
+        'extruder1': {'temperature': 25., 'target': 0.},
+        'heater_bed': {'temperature': 60., 'target': 60.},
+        'fan': {'speed': .5},
+        'gcode_move': {'speed_factor': 1.},
+        'display_status': {'progress': .25, 'message': None},
+        'idle_timeout': {'state': 'Printing', 'printing_time': 1234.},
+        'configfile': {'settings': {
+            'stepper_%d' % (i,): {'step_pin': 'PA%d' % (i,),
+                                  'rotation_distance': 40.}
+            for i in range(32)}},
+    }
+    for name, status in statuses.items():
+        printer.add_object(name, BenchStatus(status))
+    return printer, statuses
+
+def load_display_config(printer):
+    pconfig = configfile.PrinterConfig(printer)
+    filename = os.path.join(os.path.dirname(display.__file__), 'display.cfg')
+    dconfig = pconfig.read_config(filename)
+    templates = {}
+    for c in dconfig.get_prefix_sections('display_template '):
+        dt = display.DisplayTemplate(c)
+        templates[dt.name] = dt
+    groups = collections.OrderedDict()
+    for c in dconfig.get_prefix_sections('display_data '):
+        groups.setdefault(c.get_name().split()[1], []).append(c)
+    dgroups = collections.OrderedDict()
+    for name, data_configs in groups.items():
+        dgroups[name] = display.DisplayGroup(dconfig, name, data_configs)
+    return templates, dgroups
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+def update_status(statuses, eventtime):
+    statuses['toolhead']['estimated_print_time'] = eventtime
+    statuses['extruder']['temperature'] = 205. + (eventtime * 7.) % 10.
+    statuses['idle_timeout']['printing_time'] = eventtime
+    statuses['display_status']['progress'] = (eventtime / 1000.) % 1.
+
+def run_group(dgroup, templates, statuses, count, is_static):
+    lcd = BenchDisplay()
+    eventtime = 1000.
+    shown_output = None
+    redraws = 0
+    start_time = time.time()
+    for i in range(count):
+        eventtime += .5
+        if not is_static:
+            update_status(statuses, eventtime)
+        output = []
+        dgroup.render(output, lcd, templates, eventtime)
+        if output == shown_output:
+            continue
+        lcd.lcd_chip.clear()
+        dgroup.draw(lcd, output, eventtime)
+        lcd.lcd_chip.flush()
+        shown_output = output
+        redraws += 1
+    return ((time.time() - start_time) / count, redraws,
+            lcd.io.bytes_sent / float(count))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=2000,
+                    help="number of screen updates per test (default 2000)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    printer, statuses = setup_printer()
+    templates, dgroups = load_display_config(printer)
+    for name, dgroup in dgroups.items():
+        for is_static in [False, True]:
+            res, redraws, sent = run_group(dgroup, templates, statuses,
+                                           options.count, is_static)
+            print("%-22s %-9s %8.3fms per screen update"
+                  " (%d redraws, %.1f bytes sent per update)" % (
+                      name, ["changing", "static"][is_static], res * 1000.,
+                      redraws, sent))
+
+if __name__ == '__main__':
+    main()
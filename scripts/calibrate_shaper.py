@@ -16,6 +16,11 @@ from shaper_calibrate import CalibrationData, ShaperCalibrate
 MAX_TITLE_LENGTH=65
 
 def parse_log(logname):
+    with open(logname, 'rb') as f:
+        if f.readline() == b"#accel_binary\n":
+            # Raw accelerometer data in binary format
+            f.readline()
+            return np.fromfile(f, dtype='<f8').reshape(-1, 4)
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
@@ -52,8 +57,11 @@ def calibrate_shaper(datas, csv_output, max_smoothing):
         for data in datas[1:]:
             calibration_data.join(helper.process_accelerometer_data(data))
         calibration_data.normalize_to_frequencies()
-    shaper, all_shapers = helper.find_best_shaper(
-            calibration_data, max_smoothing, print)
+    try:
+        shaper, all_shapers = helper.find_best_shaper(
+                calibration_data, max_smoothing, print)
+    finally:
+        helper.close()
     print("Recommended shaper is %s @ %.1f Hz" % (shaper.name, shaper.freq))
     if csv_output is not None:
         helper.save_calibration_data(
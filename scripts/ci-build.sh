@@ -66,3 +66,7 @@ done
 start_test klippy "Test invoke klippy"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy"
+
+start_test stepgen "Verify step generation"
+$PYTHON scripts/bench_stepgen.py -n 20
+finish_test stepgen "Verify step generation"
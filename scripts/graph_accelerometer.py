@@ -15,6 +15,11 @@ from shaper_calibrate import ShaperCalibrate
 MAX_TITLE_LENGTH=65
 
 def parse_log(logname, opts):
+    with open(logname, 'rb') as f:
+        if f.readline() == b"#accel_binary\n":
+            # Raw accelerometer data in binary format
+            f.readline()
+            return np.fromfile(f, dtype='<f8').reshape(-1, 4)
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
@@ -0,0 +1,235 @@
+#!/usr/bin/env python2
+# Report step timing statistics from a batch mode serial output file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, array, heapq
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto
+
+# Step benchmark results from docs/Benchmarks.md (mcu name prefix,
+# "1 stepper" ticks, "3 stepper" ticks)
+MCU_TICKS = [
+    ('atmega', 104, 472), ('at90usb', 104, 472),
+    ('sam3x8e', 388, 576), ('sam4s8c', 527, 638), ('sam4e8e', 519, 525),
+    ('samd21', 277, 664), ('samd51', 516, 520),
+    ('stm32f042', 247, 558), ('stm32f103', 347, 600),
+    ('stm32f407', 709, 709), ('stm32f446', 757, 757),
+    ('lpc1768', 448, 523), ('lpc1769', 525, 545),
+    ('pru', 861, 883), ('linux', 340, 450),
+]
+
+
+######################################################################
+# Step stream decoding
+######################################################################
+
+class StepperStream:
+    def __init__(self, oid, step_pin):
+        self.oid = oid
+        self.step_pin = step_pin
+        self.clock = 0
+        self.dir = 0
+        self.queue_steps = self.dir_changes = self.msg_bytes = 0
+        # Absolute step clocks (doubles are exact up to 2^53 ticks)
+        self.steps = array.array('d')
+        self.step_dirs = bytearray()
+    def reset_clock(self, clock):
+        # Extend the 32-bit clock using the last known step time
+        self.clock += (clock - self.clock) & 0xffffffff
+    def set_dir(self, sdir):
+        if sdir != self.dir:
+            self.dir_changes += 1
+        self.dir = sdir
+    def queue_step(self, interval, count, add, msg_bytes):
+        self.queue_steps += 1
+        self.msg_bytes += msg_bytes
+        clock = self.clock
+        steps = self.steps
+        for i in range(count):
+            clock += interval
+            interval += add
+            steps.append(clock)
+        self.step_dirs.extend(chr(self.dir) * count)
+        self.clock = clock
+
+def read_dictionary(filename):
+    f = open(filename, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    return mp
+
+def decode_file(mp, filename):
+    # Return a dictionary of oid to StepperStream and the file size
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    steppers = {}
+    pos = 0
+    while pos < len(data):
+        msglen = mp.check_packet(data[pos:pos+msgproto.MESSAGE_MAX])
+        if msglen <= 0:
+            raise mp.error("Invalid data at offset %d" % (pos,))
+        s = bytearray(data[pos:pos+msglen])
+        mpos = msgproto.MESSAGE_HEADER_SIZE
+        mend = msglen - msgproto.MESSAGE_TRAILER_SIZE
+        while mpos < mend:
+            mid = mp.messages_by_id.get(s[mpos], mp.unknown)
+            start_pos = mpos
+            params, mpos = mid.parse(s, mpos)
+            name = mid.name
+            if name == 'queue_step':
+                steppers[params['oid']].queue_step(
+                    params['interval'], params['count'], params['add'],
+                    mpos - start_pos)
+            elif name == 'set_next_step_dir':
+                steppers[params['oid']].set_dir(params['dir'])
+            elif name == 'reset_step_clock':
+                steppers[params['oid']].reset_clock(params['clock'])
+            elif name == 'config_stepper':
+                oid = params['oid']
+                step_pin = mid.format_params(params).split()[2]
+                steppers[oid] = StepperStream(oid, step_pin.split('=', 1)[1])
+        pos += msglen
+    return steppers, len(data)
+
+
+######################################################################
+# Statistics
+######################################################################
+
+def lookup_mcu_ticks(mcu_type):
+    for prefix, ticks1, ticks3 in MCU_TICKS:
+        if mcu_type.startswith(prefix):
+            return ticks1, ticks3
+    return None, None
+
+def find_peak_window(clocks, window):
+    # Return the maximum number of steps in any interval of 'window'
+    # ticks along with the clock of the first step in that interval
+    peak = peak_clock = 0
+    start = 0
+    for i, clock in enumerate(clocks):
+        while clock - clocks[start] >= window:
+            start += 1
+        if i - start + 1 > peak:
+            peak = i - start + 1
+            peak_clock = clocks[start]
+    return peak, peak_clock
+
+def find_min_interval(steps, limit):
+    # Return the minimum interval between two steps, the clock it
+    # occurs at, and the number of intervals below 'limit' ticks
+    min_interval = min_clock = None
+    below = 0
+    for i in range(1, len(steps)):
+        interval = steps[i] - steps[i-1]
+        if min_interval is None or interval < min_interval:
+            min_interval = interval
+            min_clock = steps[i]
+        if limit is not None and interval < limit:
+            below += 1
+    return min_interval, min_clock, below
+
+def compare_steps(ss, ideal_ss):
+    # Return the max and average step time deviation (in ticks)
+    steps, ideal_steps = ss.steps, ideal_ss.steps
+    if len(steps) != len(ideal_steps) or ss.step_dirs != ideal_ss.step_dirs:
+        return None, None
+    max_dev = total_dev = 0.
+    for clock, ideal_clock in zip(steps, ideal_steps):
+        dev = abs(clock - ideal_clock)
+        max_dev = max(max_dev, dev)
+        total_dev += dev
+    return max_dev, total_dev / max(1, len(steps))
+
+def main():
+    usage = "%prog [options] <data dictionary> <serial output>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--ticks", type="int", dest="ticks",
+                    help="minimum single stepper step interval in mcu ticks"
+                    " (default from docs/Benchmarks.md)")
+    opts.add_option("-T", "--ticks3", type="int", dest="ticks3",
+                    help="three stepper benchmark result in mcu ticks"
+                    " (default from docs/Benchmarks.md)")
+    opts.add_option("-w", "--window", type="float", dest="window",
+                    default=.001, help="peak rate window in seconds"
+                    " (default 0.001)")
+    opts.add_option("-b", "--baud", type="int", dest="baud", default=250000,
+                    help="serial baud rate (default 250000)")
+    opts.add_option("-c", "--compare", type="string", dest="compare",
+                    help="serial output of the same print generated with"
+                    " max_stepper_error set to zero")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    mp = read_dictionary(args[0])
+    freq = mp.get_constant_float('CLOCK_FREQ')
+    mcu_type = mp.get_constant('MCU', '')
+    ticks1, ticks3 = lookup_mcu_ticks(mcu_type)
+    if options.ticks is not None:
+        ticks1 = options.ticks
+    if options.ticks3 is not None:
+        ticks3 = options.ticks3
+    window = int(options.window * freq)
+    steppers, file_size = decode_file(mp, args[1])
+    ideal_steppers = {}
+    if options.compare is not None:
+        ideal_steppers = decode_file(mp, options.compare)[0]
+    ticks_us = 1000000. / freq
+    print("mcu=%s freq=%.0f single_stepper_ticks=%s three_stepper_ticks=%s"
+          % (mcu_type, freq, ticks1, ticks3))
+    # Per stepper report
+    for oid, ss in sorted(steppers.items()):
+        steps = ss.steps
+        print("oid=%d step_pin=%s steps=%d dir_changes=%d queue_steps=%d"
+              " steps/msg=%.1f bytes=%d" % (
+                  oid, ss.step_pin, len(steps), ss.dir_changes,
+                  ss.queue_steps, float(len(steps)) / max(1, ss.queue_steps),
+                  ss.msg_bytes))
+        if len(steps) < 2:
+            continue
+        min_interval, min_clock, below = find_min_interval(steps, ticks1)
+        peak, peak_clock = find_peak_window(steps, window)
+        print("  min_interval=%.0f ticks (%.1fus) at %.6fs"
+              " peak_rate=%.0f steps/s at %.6fs intervals_below_mcu=%d" % (
+                  min_interval, min_interval * ticks_us, min_clock / freq,
+                  peak / options.window, peak_clock / freq, below))
+        ideal_ss = ideal_steppers.get(oid)
+        if ideal_ss is not None:
+            max_dev, avg_dev = compare_steps(ss, ideal_ss)
+            if max_dev is None:
+                print("  step mismatch against ideal (%d vs %d steps)" % (
+                    len(steps), len(ideal_ss.steps)))
+            else:
+                print("  deviation from ideal: max=%.0f ticks (%.1fus)"
+                      " avg=%.1f ticks (%.1fus)" % (
+                          max_dev, max_dev * ticks_us,
+                          avg_dev, avg_dev * ticks_us))
+    # Combined report for all steppers on the mcu
+    all_steps = array.array('d', heapq.merge(
+        *[ss.steps for ss in steppers.values()]))
+    if len(all_steps) < 2:
+        return
+    duration = (all_steps[-1] - all_steps[0]) / freq
+    peak, peak_clock = find_peak_window(all_steps, window)
+    msg = "all steppers: steps=%d peak_rate=%.0f steps/s at %.6fs" % (
+        len(all_steps), peak / options.window, peak_clock / freq)
+    if ticks3 is not None:
+        load = peak * ticks3 / 3. / window
+        msg += " mcu_load=%.0f%%" % (load * 100.,)
+        if load > 1.:
+            msg += " (may exceed mcu step rate)"
+    print(msg)
+    if duration > 0.:
+        link_rate = file_size / duration
+        print("link: bytes=%d duration=%.3fs bytes/sec=%.0f"
+              " link_usage=%.1f%%" % (file_size, duration, link_rate,
+                                      link_rate * 1000. / options.baud))
+
+if __name__ == '__main__':
+    main()
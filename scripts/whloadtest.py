@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# Load test tool for the webhooks interface
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Example usage against a klippy instance writing to an output file:
+#   ~/klippy-env/bin/python ./klippy/klippy.py printer.cfg -o /dev/null \
+#       -d out/klipper.dict -a /tmp/klippy_uds
+#   ~/klippy-env/bin/python ./scripts/whloadtest.py -c 8 /tmp/klippy_uds
+import sys, optparse, socket, select, json, errno, time
+
+DEFAULT_REQUEST = {"method": "objects/query",
+                   "params": {"objects": {"toolhead": None,
+                                          "webhooks": None}}}
+
+def webhook_socket_create(uds_filename):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    while 1:
+        try:
+            sock.connect(uds_filename)
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                time.sleep(0.1)
+                continue
+            sys.stderr.write("Unable to connect socket %s [%d,%s]\n"
+                             % (uds_filename, e.errno,
+                                errno.errorcode[e.errno]))
+            sys.exit(-1)
+        break
+    return sock
+
+class LoadClient:
+    def __init__(self, client_id, uds_filename, request, rate, max_inflight):
+        self.client_id = client_id
+        self.sock = webhook_socket_create(uds_filename)
+        self.request = request
+        self.interval = 0.
+        if rate:
+            self.interval = 1. / rate
+        self.max_inflight = max_inflight
+        self.next_send_time = 0.
+        self.next_id = 0
+        self.inflight = {}
+        self.socket_data = self.send_data = ""
+        self.latencies = []
+        self.errors = 0
+    def fileno(self):
+        return self.sock.fileno()
+    def want_send(self, curtime):
+        return (len(self.inflight) < self.max_inflight
+                and curtime >= self.next_send_time)
+    def queue_request(self, curtime):
+        req = dict(self.request)
+        req['id'] = req_id = self.next_id
+        self.next_id += 1
+        self.inflight[req_id] = curtime
+        self.send_data += json.dumps(req, separators=(',', ':')) + "\x03"
+        self.next_send_time = max(self.next_send_time + self.interval,
+                                  curtime)
+    def flush(self):
+        while self.send_data:
+            try:
+                sent = self.sock.send(self.send_data)
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            self.send_data = self.send_data[sent:]
+    def process_socket(self, curtime):
+        data = self.sock.recv(4096)
+        if not data:
+            sys.stderr.write("Client %d: socket closed\n" % (self.client_id,))
+            sys.exit(-1)
+        parts = data.split('\x03')
+        parts[0] = self.socket_data + parts[0]
+        self.socket_data = parts.pop()
+        for line in parts:
+            msg = json.loads(line)
+            send_time = self.inflight.pop(msg.get('id'), None)
+            if send_time is None:
+                continue
+            if 'error' in msg:
+                self.errors += 1
+            self.latencies.append(curtime - send_time)
+    def get_report(self, duration):
+        lat = sorted(self.latencies)
+        count = len(lat)
+        if not count:
+            return "client %d: no responses" % (self.client_id,)
+        return ("client %d: requests=%d rate=%.1f/s errors=%d"
+                " avg=%.3fms p50=%.3fms p99=%.3fms max=%.3fms" % (
+                    self.client_id, count, count / duration, self.errors,
+                    1000. * sum(lat) / count, 1000. * lat[count // 2],
+                    1000. * lat[min(count - 1, int(count * .99))],
+                    1000. * lat[-1]))
+
+def run_test(clients, duration):
+    poll = select.poll()
+    fdmap = {}
+    for client in clients:
+        poll.register(client, select.POLLIN | select.POLLHUP)
+        fdmap[client.fileno()] = client
+    start_time = time.time()
+    end_time = start_time + duration
+    while 1:
+        curtime = time.time()
+        if curtime >= end_time:
+            break
+        for client in clients:
+            while client.want_send(curtime):
+                client.queue_request(curtime)
+            client.flush()
+        res = poll.poll(1.)
+        curtime = time.time()
+        for fd, event in res:
+            fdmap[fd].process_socket(curtime)
+    return time.time() - start_time
+
+def main():
+    usage = "%prog [options] <socket filename>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--clients", type="int", dest="clients", default=4,
+                    help="number of concurrent clients (default 4)")
+    opts.add_option("-t", "--time", type="float", dest="duration",
+                    default=10., help="test duration in seconds (default 10)")
+    opts.add_option("-r", "--rate", type="float", dest="rate", default=0.,
+                    help="requests per second per client (default unlimited)")
+    opts.add_option("-f", "--flood", type="int", dest="flood", default=0,
+                    help="number of clients that ignore the rate limit")
+    opts.add_option("-n", "--inflight", type="int", dest="inflight",
+                    default=1, help="max outstanding requests per client")
+    opts.add_option("-j", "--request", type="string", dest="request",
+                    help="json request to send (default objects/query)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    request = DEFAULT_REQUEST
+    if options.request is not None:
+        try:
+            request = json.loads(options.request)
+        except ValueError:
+            opts.error("Unable to parse request")
+    clients = []
+    for i in range(options.clients):
+        rate = options.rate
+        inflight = options.inflight
+        if i < options.flood:
+            rate = 0.
+            inflight = max(inflight, 64)
+        clients.append(LoadClient(i, args[0], request, rate, inflight))
+    sys.stderr.write("Running %d clients for %.1f seconds\n"
+                     % (len(clients), options.duration))
+    duration = run_test(clients, options.duration)
+    for client in clients:
+        sys.stdout.write(client.get_report(duration) + "\n")
+
+if __name__ == '__main__':
+    main()
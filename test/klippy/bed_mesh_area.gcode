@@ -0,0 +1,14 @@
+; Print area test file for bed_mesh PRINT_AREA
+
+; Relative extrusion is not changed by G90/G91
+M83
+G1 X50 Y50
+G91
+G1 Z1
+G90
+G1 X100 Y50 E1.0
+G1 X100 Y100 E0.5
+
+; The extents of an arc include its axis crossings
+G1 X100 Y100
+G2 X100 Y100 I20 J0 E5